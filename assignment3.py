@@ -1,62 +1,1893 @@
 import os
+import json
+import mmap
+import base64
+import time
+import heapq
+import random
+import zlib
+import hashlib
+import tempfile
+import threading
 import requests
-from flask import Flask, request, Response, jsonify
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, request, Response, jsonify, g
 
 app = Flask(__name__)
 SOCKET_ADDRESS = os.environ.get("SOCKET_ADDRESS")
 VIEW = os.environ.get("VIEW")
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "16"))
+POOL_SIZE = int(os.environ.get("POOL_SIZE", "10")) # keep-alive connections kept open per replica
+HINT_LIMIT = int(os.environ.get("HINT_LIMIT", "10000")) # missed writes kept for a replica before it needs a full transfer
+HANDOFF_RETRY_SECONDS = float(os.environ.get("HANDOFF_RETRY_SECONDS", "10")) # how long a rejoining replica is retried
+OPLOG_LIMIT = int(os.environ.get("OPLOG_LIMIT", "100000")) # write steps kept for replicas catching up
+RECOVERY_RETRIES = int(os.environ.get("RECOVERY_RETRIES", "3")) # times a broken recovery stream is resumed
+DATA_DIR = os.environ.get("DATA_DIR") # directory for the write-ahead log and snapshots; nothing is persisted when unset
+SNAPSHOT_EVERY = int(os.environ.get("SNAPSHOT_EVERY", "10000")) # write-ahead log records between snapshots
+SERVER = os.environ.get("SERVER", "threaded") # "threaded" for the multi-threaded WSGI server, "dev" for the Flask development server
+THREADS = int(os.environ.get("THREADS", "32")) # request threads of the threaded server
+HOST = os.environ.get("HOST", "0.0.0.0") # interface to listen on; the port comes from SOCKET_ADDRESS
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "1")) # seconds between heartbeats to each replica
+HEARTBEAT_MISSES = int(os.environ.get("HEARTBEAT_MISSES", "3")) # missed heartbeats before a replica is removed from the view
+REJOIN_DELAY = float(os.environ.get("REJOIN_DELAY", "5")) # seconds a replica must be reachable again before we rejoin its view
+CAUSAL_WAIT = float(os.environ.get("CAUSAL_WAIT", "1")) # seconds a request with unmet causal dependencies waits before 503
+MAX_WAITERS = int(os.environ.get("MAX_WAITERS", str(max(THREADS // 2, 1)))) # requests allowed to wait at the same time
+MERKLE_LEAVES = int(os.environ.get("MERKLE_LEAVES", "1024")) # leaves of the anti-entropy hash tree, a power of two
+ANTI_ENTROPY_INTERVAL = float(os.environ.get("ANTI_ENTROPY_INTERVAL", "10")) # longest pause, in seconds, between anti-entropy rounds
+ANTI_ENTROPY_MIN = float(os.environ.get("ANTI_ENTROPY_MIN", "1")) # shortest pause, used while rounds keep finding differences
+WIRE_PROTOCOL = os.environ.get("WIRE_PROTOCOL", "binary") # "binary" to send replicated writes in the compact encoding where the replica supports it, "json" to never do so
+COMPRESS_MIN = int(os.environ.get("COMPRESS_MIN", "1024")) # replication messages and recovery responses at least this many bytes are compressed
+WRITE_QUORUM = os.environ.get("WRITE_QUORUM", "all") # replicas, counting this one, that must hold a write before it is acknowledged, or "all"; the rest finish in the background
+READ_QUORUM = os.environ.get("READ_QUORUM", "1") # replicas, counting this one, whose answers a read merges
+SHARD_ID = os.environ.get("SHARD_ID") # shard this replica belongs to; keys are spread over shards when set, and every replica holds every key when unset
+SHARD_VNODES = int(os.environ.get("SHARD_VNODES", "64")) # points each shard gets on the consistent-hash ring
+FORWARD_TIMEOUT = float(os.environ.get("FORWARD_TIMEOUT", "5")) # seconds to wait for the owning shard of a forwarded request
+REBALANCE_BATCH = int(os.environ.get("REBALANCE_BATCH", "500")) # keys moved to another shard per request
+DELIVERY_TIMEOUT = float(os.environ.get("DELIVERY_TIMEOUT", "30")) # seconds a replicated write waits for its dependencies before it is applied anyway
+MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET", "0")) # bytes of keys and values kept in memory, counting those of the write logs, before cold values are spilled to disk; 0 for no limit
+SPILL_DIR = os.environ.get("SPILL_DIR") or DATA_DIR # directory for the spill file, which is deleted when the replica stops; the system temporary directory when unset
+SCAN_LIMIT = int(os.environ.get("SCAN_LIMIT", "100")) # keys in a page of GET /kvs scans when the request gives no limit
+SCAN_MAX = int(os.environ.get("SCAN_MAX", "1000")) # most keys a page of GET /kvs scans can have
+BOOTSTRAP_TIMEOUT = float(os.environ.get("BOOTSTRAP_TIMEOUT", "1")) # seconds to wait for each replica of VIEW to answer at startup
+BOOTSTRAP_RETRY = float(os.environ.get("BOOTSTRAP_RETRY", "30")) # seconds to keep announcing ourselves to replicas of VIEW that were not up yet
+WATCH_BUFFER = int(os.environ.get("WATCH_BUFFER", "1000")) # events a watcher may fall behind before its stream is reset
+MAX_WATCHERS = int(os.environ.get("MAX_WATCHERS", str(max(THREADS // 4, 1)))) # watch streams open at the same time; each holds a request thread
+WATCH_KEEPALIVE = float(os.environ.get("WATCH_KEEPALIVE", "15")) # seconds between keep-alive comments on an idle watch stream
+TRACING = os.environ.get("TRACING", "1") == "1" # record spans of client requests and of the replica calls they make
+TRACE_LIMIT = int(os.environ.get("TRACE_LIMIT", "10000")) # most recent spans kept in memory for GET /traces
+TRACE_FILE = os.environ.get("TRACE_FILE") # file every span is also appended to, one JSON object per line; none when unset
+SPILL_COMPACT_MIN = int(os.environ.get("SPILL_COMPACT_MIN", str(1 << 20))) # dead bytes in the spill file before it is rewritten
+KEY_WINDOW = int(os.environ.get("KEY_WINDOW", "8")) # latest write steps of each replica whose keys causal-metadata summarises; 0 to leave the key digests out
 
-kv_store = {} # in-memory key-value store using dictionary
+kv_store = None # ValueStore holding the keys and values, created below
 sa_store = {} # in-memory store for storing the set of replicas among which the store is replicated
-vector_clock = [0,0,0]
+vector_clock = {} # socket address -> number of writes originated by that replica which have been applied here
+applied_ahead = {} # socket address -> positions of writes from that replica applied before an earlier one of its writes arrived
+broadcast_pool = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) # worker threads used to contact every replica at once
+detector_pool = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) # worker threads for heartbeats and view changes
+peer_sessions = {} # socket address -> requests.Session whose connections are reused between calls
+peer_health = {} # socket address -> {"healthy", "failures", "last-seen", "up-since", "requests"} for that replica, guarded by peer_lock
+peer_lock = threading.Lock()
+replica_shards = {} # socket address -> shard of that replica, as it announced in PUT /view or GET /view
+ring_cache = (None, [], []) # (shards, sorted ring points, shard of each point) for the shards last seen in the view
+replica_moving = {} # socket address -> whether that replica is moving keys to another shard, as it said in GET /view
+moving_keys = False # whether this replica is moving keys that another shard now owns
+ring_changed = 0 # when the set of shards in the view last changed
+peer_protocols = {} # socket address -> "binary" or "json", whichever that replica was found to accept for replicated writes
+state_lock = None # ReadWriteLock around kv_store, the vector clock and the operation log, created below
+hinted_handoff = {} # socket address -> deque of writes a removed replica missed, replayed when it rejoins the view
+handoff_overflowed = set() # removed replicas that missed more than HINT_LIMIT writes
+handoff_replaying = set() # replicas whose missed writes are being replayed
+handoff_lock = threading.Lock()
+op_log = deque() # (origin, position, operations, bytes) for each write step applied here, in the order it was applied
+oplog_floor = {} # socket address -> write steps from that replica at or below this position are no longer in op_log
+oplog_dropped = 0 # write steps dropped from the front of op_log so far, so a walk of the log can find its place again
+absent = object() # stands in for a key that was removed while it was being read
+wal_file = None # open segment of the write-ahead log that records are appended to
+wal_generation = 0 # number of the open segment; a snapshot names the first segment that is not part of it
+wal_records = 0 # records appended to the open segment
+wal_written = 0 # sequence number of the last record appended
+wal_synced = 0 # sequence number of the last record known to be on disk
+wal_cond = threading.Condition() # guards the counters above and wakes writers once their record is on disk
+wal_io_lock = threading.Lock() # held while a segment is fsynced or replaced
+snapshot_running = threading.Event()
+bootstrapped = threading.Event() # set once this replica has caught up with the others and serves clients
+bootstrap_state = {"phase": "starting", "started": time.time(), "reachable": 0, "recovered-from": [], "duration": None}
+clock_advanced = threading.Condition() # notified whenever the vector clock moves forward
+clock_version = 0 # bumped on every notification so a waiter cannot miss one between its check and its wait
+waiters = 0 # requests currently waiting for their causal dependencies
+pending_writes = {} # (origin, position) -> (clock, operations, arrival time, bytes) for replicated writes whose dependencies have not arrived
+pending_index = {} # socket address -> heap of (count, origin, position) for pending writes waiting for that replica's entry to reach count
+merkle_tree = [0] * (2 * MERKLE_LEAVES) # node n is the XOR of nodes 2n and 2n+1, leaf i is node MERKLE_LEAVES + i, node 1 is the root
+merkle_keys = [set() for _ in range(MERKLE_LEAVES)] # keys whose hash falls in each leaf
+key_versions = {} # key -> clock of the writes that set or removed it here, while that clock is ahead of the vector clock
+recent_keys = {} # socket address -> deque of (position, key bits) for the latest consecutive write steps from that replica applied here
+log_bytes = {"op-log": 0, "hints": 0, "pending": 0} # bytes of keys and values held by op_log, hinted_handoff and pending_writes, counted when MEMORY_BUDGET is set
+anti_entropy_stats = {"rounds": 0, "in-sync": 0, "skipped": 0, "repaired-leaves": 0, "repaired-keys": 0, "interval": ANTI_ENTROPY_INTERVAL}
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # upper bounds, in seconds, of the latency histograms
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576) # upper bounds, in bytes, of the value size histogram
+INDEX_CHUNK = 1000 # keys per chunk of the key index; a chunk that grows to twice this is split
+STREAM_PAGE = 1000 # keys read under one hold of state_lock when a snapshot or a transfer walks the whole store
+request_latency = {} # (route, method) -> Histogram of the time spent handling requests
+request_counts = {} # (route, method, status) -> number of responses sent
+peer_latency = {} # socket address -> Histogram of broadcast round trips to that replica
+peer_failures = {} # socket address -> broadcasts that could not reach that replica
+causal_rejections = 0 # requests answered 503 because their causal dependencies were not satisfied
+metrics_lock = threading.Lock() # guards the dictionaries and counter above; each Histogram has its own lock
+watchers = set() # Watcher of every open GET /watch
+watch_lock = threading.Lock() # guards watchers
+trace_spans = deque(maxlen=TRACE_LIMIT) # spans recorded here, oldest first
+trace_local = threading.local() # .context is [trace id, current span id] of the request or broadcast this thread works for
+trace_lock = threading.Lock() # guards trace_spans and the trace file
+trace_file = open(TRACE_FILE, "a", buffering=1) if TRACE_FILE else None
+delivery_stats = {"delivered": 0, "buffered": 0, "duplicates": 0, "forced": 0, "max-depth": 0, "delayed": 0, "delay-total": 0.0, "delay-max": 0.0}
 
 
+# Many readers or one writer. "with lock:" takes the writer side, which the thread holding it may take again;
+# "with lock.reading():" takes the reader side, so reads run in parallel on every request thread.
+# Waiting writers keep new readers out so a steady stream of reads cannot starve writes.
+class ReadWriteLock:
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting_writers = 0
+        self.local = threading.local() # how deeply the current thread holds the reader side
 
-# Create a function to increment vector clock based on each replica to ensure the causal consistency
+    def __enter__(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.depth += 1
+                return self
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.depth = 1
+            return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.depth -= 1
+            if self.depth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        # A thread that already holds the writer side reads under it, and nested reads do not queue again
+        if self.writer == threading.get_ident():
+            with self:
+                yield self
+            return
+        depth = getattr(self.local, "depth", 0)
+        if not depth:
+            with self.cond:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+                self.readers += 1
+        self.local.depth = depth + 1
+        try:
+            yield self
+        finally:
+            self.local.depth = depth
+            if not depth:
+                with self.cond:
+                    self.readers -= 1
+                    if not self.readers:
+                        self.cond.notify_all()
+
+state_lock = ReadWriteLock()
+
+# Cumulative latency histogram in the Prometheus text format. observe() costs one bisect and one uncontended lock.
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def lines(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(dict(labels, le=str(bound)))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+# Create a function to format Prometheus labels, escaping the characters the text format reserves
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+# Create a function to get the trace context of the current thread, as a copy that can be handed to another thread
+def current_trace():
+    context = getattr(trace_local, "context", None)
+    return tuple(context) if context else None
+
+# Create a function to run <function> on a pool thread under the trace context <context> taken from the thread that submitted it
+def traced(context, function, *args, **kwargs):
+    trace_local.context = list(context) if context else None
+    try:
+        return function(*args, **kwargs)
+    finally:
+        trace_local.context = None
+
+# Create a function to record a finished span in memory and in the trace file
+def record_span(trace_id, span_id, parent, name, start, duration, attributes):
+    record = {"trace-id": trace_id, "span-id": span_id, "parent-id": parent, "name": name, "replica": SOCKET_ADDRESS,
+              "start": start, "duration": duration, "attributes": attributes}
+    with trace_lock:
+        trace_spans.append(record)
+        if trace_file is not None:
+            trace_file.write(json.dumps(record) + "\n")
+
+# Time the enclosed block as a child span of the thread's current span; does nothing when the thread is not tracing.
+# Yields the span's attributes so the block can add to them.
+@contextmanager
+def span(name, **attributes):
+    context = getattr(trace_local, "context", None)
+    if context is None:
+        yield attributes
+        return
+    parent, span_id = context[1], os.urandom(8).hex()
+    context[1] = span_id
+    start, begin = time.time(), time.perf_counter()
+    try:
+        yield attributes
+    except Exception as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        context[1] = parent
+        record_span(context[0], span_id, parent, name, start, time.perf_counter() - begin, attributes)
+
+# The key-value store. Behaves like the dict it replaces, but keeps at most <budget> bytes of keys and values in memory,
+# less the bytes reserved for the write logs, and spills the coldest values to an append-only file. Values in memory are evicted in CLOCK order: a read marks its key,
+# and the eviction hand gives a marked key a second pass instead of spilling it. A spilled key stays in the index as one
+# integer (offset << 32 | length), so only reading its value touches the disk, and reading it brings it back into memory.
+# Writers hold state_lock's writer side; the internal lock also orders the readers that bring values back.
+class ValueStore(MutableMapping):
+    def __init__(self, budget=0, directory=None):
+        self.budget = budget
+        self.directory = directory
+        self.hot = OrderedDict() # key -> (value, bytes) held in memory, in the order the eviction hand visits them
+        self.cold = {} # key -> offset << 32 | length of its value in the spill file
+        self.referenced = set() # keys in memory read since the hand last passed them
+        self.memory = 0 # bytes of the keys and values in memory
+        self.reserved = 0 # bytes of the budget held by the write logs instead
+        self.end = 0 # bytes written to the spill file
+        self.dead = 0 # bytes of the spill file that belong to overwritten, deleted or reloaded values
+        self.file = None
+        self.spills = 0
+        self.loads = 0
+        self.value_sizes = Histogram(SIZE_BUCKETS)
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def __contains__(self, key):
+        return key in self.hot or key in self.cold
+
+    def __iter__(self):
+        return iter(list(self.hot) + list(self.cold))
+
+    def __getitem__(self, key):
+        entry = self.hot.get(key)
+        if entry is not None:
+            self.referenced.add(key)
+            return entry[0]
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry is not None:
+                return entry[0]
+            value = self.read(self.cold[key])
+            self.keep(key, value, len(key) + (self.cold[key] & 0xFFFFFFFF))
+            return value
+
+    def __setitem__(self, key, value):
+        size = len(key) + len(json.dumps(value, separators=(",", ":")))
+        self.value_sizes.observe(size)
+        with self.lock:
+            self.keep(key, value, size)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.discard(key)
+
+    # Create a function to read a value without bringing it back into memory, for bulk reads that should not evict hot keys
+    def peek(self, key, default=None):
+        entry = self.hot.get(key)
+        if entry is not None:
+            return entry[0]
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry is not None:
+                return entry[0]
+            return self.read(self.cold[key]) if key in self.cold else default
+
+    def items(self):
+        with self.lock:
+            items = [(key, value) for key, (value, _) in self.hot.items()]
+            return items + [(key, self.read(location)) for key, location in self.cold.items()]
+
+    def stats(self):
+        with self.lock:
+            return {"memory-bytes": self.memory, "memory-keys": len(self.hot), "disk-bytes": self.end - self.dead,
+                    "disk-keys": len(self.cold), "spills": self.spills, "loads": self.loads}
+
+    # Create a function to set aside <reserved> bytes of the budget for the write logs, spilling values to make room
+    def reserve(self, reserved):
+        with self.lock:
+            self.reserved = reserved
+            if self.budget:
+                self.evict()
+
+    def keep(self, key, value, size):
+        self.discard(key)
+        self.hot[key] = (value, size)
+        self.memory += size
+        if self.budget:
+            self.evict()
+
+    def discard(self, key):
+        if key in self.hot:
+            self.memory -= self.hot.pop(key)[1]
+            self.referenced.discard(key)
+        elif key in self.cold:
+            self.dead += self.cold.pop(key) & 0xFFFFFFFF
+            if not self.cold:
+                # Nothing in the file is live, so it can start over
+                self.file.truncate(0)
+                self.end = self.dead = 0
+
+    def evict(self):
+        while self.memory > self.budget - self.reserved and self.hot:
+            key, (value, size) = self.hot.popitem(last=False)
+            if key in self.referenced:
+                self.referenced.discard(key)
+                self.hot[key] = (value, size)
+                continue
+            self.memory -= size
+            self.cold[key] = self.write(json.dumps(value, separators=(",", ":")).encode())
+            self.spills += 1
+        if self.dead > max(SPILL_COMPACT_MIN, self.end // 2):
+            self.compact()
+
+    def write(self, data):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.directory)
+        os.pwrite(self.file.fileno(), data, self.end)
+        self.end += len(data)
+        return (self.end - len(data)) << 32 | len(data)
+
+    def read(self, location):
+        self.loads += 1
+        return json.loads(os.pread(self.file.fileno(), location & 0xFFFFFFFF, location >> 32))
+
+    # Create a function to copy the live values into a new spill file once most of the old one is dead
+    def compact(self):
+        old = self.file
+        self.file, self.end, self.dead = None, 0, 0
+        for key, location in list(self.cold.items()):
+            self.cold[key] = self.write(os.pread(old.fileno(), location & 0xFFFFFFFF, location >> 32))
+        old.close()
+
+kv_store = ValueStore(MEMORY_BUDGET, SPILL_DIR)
+
+# The keys of kv_store in sorted order, for scans. Keys are kept in a list of sorted chunks of about <load> keys, with the
+# last key of each chunk in <maxes>, so adding or removing a key costs a binary search and a shift within one chunk
+# instead of shifting the whole index. The caller holds state_lock: the writer side to change it, either side to read it.
+class KeyIndex:
+    def __init__(self, load=INDEX_CHUNK):
+        self.load = load
+        self.chunks = [] # sorted lists of keys; every key of a chunk comes before those of the next one
+        self.maxes = [] # last key of each chunk
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def add(self, key):
+        if not self.chunks:
+            self.chunks.append([key])
+            self.maxes.append(key)
+        else:
+            i = min(bisect_left(self.maxes, key), len(self.chunks) - 1)
+            chunk = self.chunks[i]
+            insort(chunk, key)
+            self.maxes[i] = chunk[-1]
+            if len(chunk) >= 2 * self.load:
+                self.chunks[i:i + 1] = [chunk[:self.load], chunk[self.load:]]
+                self.maxes[i:i + 1] = [chunk[self.load - 1], chunk[-1]]
+        self.size += 1
+
+    def remove(self, key):
+        i = bisect_left(self.maxes, key)
+        chunk = self.chunks[i]
+        del chunk[bisect_left(chunk, key)]
+        self.size -= 1
+        if chunk:
+            self.maxes[i] = chunk[-1]
+        else:
+            del self.chunks[i]
+            del self.maxes[i]
+
+    # Create a function to iterate over the keys from <low> (after it unless <inclusive>) up to, but not including, <high>.
+    # None leaves that end open.
+    def irange(self, low=None, high=None, inclusive=True):
+        search = bisect_left if inclusive else bisect_right
+        i = 0 if low is None else search(self.maxes, low)
+        for chunk in islice(self.chunks, i, None):
+            for key in islice(chunk, 0 if low is None else search(chunk, low), None):
+                if high is not None and key >= high:
+                    return
+                yield key
+            low = None
+
+key_index = KeyIndex()
+
+# Create a function to walk the store in key order, after <after>, a page of STREAM_PAGE keys and values at a time.
+# Each page is read under state_lock's reader side with peek, so a walk of the whole store neither holds the lock,
+# nor holds more than a page of values in memory, nor evicts hot values. Writes made during the walk may or may not be seen.
+def store_pages(after=None):
+    while True:
+        with state_lock.reading():
+            page = [(key, kv_store.peek(key)) for key in islice(key_index.irange(after, inclusive=False), STREAM_PAGE)]
+        if not page:
+            return
+        yield page
+        after = page[-1][0]
+
+# Create a function to measure the keys and values of a write step the way ValueStore does, for the memory budget.
+# Nothing is measured when there is no budget.
+def operations_size(operations):
+    if not MEMORY_BUDGET:
+        return 0
+    return sum(len(operation["key"]) + len(json.dumps(operation.get("value"), separators=(",", ":"))) for operation in operations)
+
+# Create a function to count <size> more bytes held by the write log <log> and take them out of the store's budget.
+# Each of op_log, hinted_handoff and pending_writes may hold up to a quarter of MEMORY_BUDGET, and is trimmed beyond that.
+def count_log(log, size):
+    log_bytes[log] += size
+    if MEMORY_BUDGET:
+        kv_store.reserve(sum(log_bytes.values()))
+
+# Create a function to tell whether the write log <log> holds more than its share of MEMORY_BUDGET
+def log_over_budget(log):
+    return MEMORY_BUDGET and log_bytes[log] > MEMORY_BUDGET // 4
+
+# A subscriber of GET /watch for one key, or for every key with a prefix. Writers push events without waiting for it:
+# a watcher that falls WATCH_BUFFER events behind is marked overflowed instead of slowing writes down, and its stream is reset.
+class Watcher:
+    def __init__(self, key, prefix):
+        self.key = key
+        self.prefix = prefix
+        self.events = deque()
+        self.overflowed = False
+        self.cond = threading.Condition(threading.Lock())
+
+    def matches(self, key):
+        return key == self.key if self.key is not None else key.startswith(self.prefix)
+
+    def push(self, event):
+        with self.cond:
+            if len(self.events) >= WATCH_BUFFER:
+                self.overflowed = True
+            else:
+                self.events.append(event)
+            self.cond.notify()
+
+    # Wait up to <timeout> seconds for events, then hand over everything buffered
+    def take(self, timeout):
+        with self.cond:
+            if not self.events and not self.overflowed:
+                self.cond.wait(timeout)
+            events, self.events = list(self.events), deque()
+            return events, self.overflowed
+
+# Create a function to increment this replica's entry of the vector clock when it originates a write
 def inc_vector_clock():
-    if SOCKET_ADDRESS == "10.10.0.2:8090":
-        vector_clock[0] += 1
-    elif SOCKET_ADDRESS == "10.10.0.3:8090":
-        vector_clock[1] += 1
-    elif SOCKET_ADDRESS == "10.10.0.4:8090":
-        vector_clock[2] += 1
-        
+    vector_clock[SOCKET_ADDRESS] = vector_clock.get(SOCKET_ADDRESS, 0) + 1
+    notify_clock_advanced()
+
+# Create a function to check, in one pass over <v>, that every write <v> depends on has been applied here
 def compare_vector_clock(v):
-    if SOCKET_ADDRESS == "10.10.0.2:8090":
-        if vector_clock[0] < v[1] or vector_clock[0] < v[2]:
-            return 503
-    elif SOCKET_ADDRESS == "10.10.0.3:8090":
-        if vector_clock[1] < v[0] or vector_clock[1] < v[2]:
-            return 503
-    elif SOCKET_ADDRESS == "10.10.0.4:8090":
-        if vector_clock[2] < v[0] or vector_clock[2] < v[1]:
+    for replica, count in v.items():
+        if count > vector_clock.get(replica, 0):
             return 503
 
+# Create a function to check that every write <v> depends on that could affect <keys> has been applied here.
+# Only a missing write that touches one of the keys matters. A key whose version (see record_version) covers <v> was written
+# after every write in <v>, so none of them can change it. For the other keys, the client's key <digests> tell which keys the
+# latest write steps of each replica touched; a replica whose missing steps are not all in its digest, or whose digest may hold
+# one of the keys, has to be caught up with. The caller holds state_lock (either side). Returns 503 like compare_vector_clock.
+def compare_key_dependencies(v, keys, digests):
+    if compare_vector_clock(v) != 503:
+        return
+    exposed = [key for key in keys if key not in key_versions or any(count > key_versions[key].get(replica, 0) for replica, count in v.items())]
+    if not exposed:
+        return
+    bits = [key_bits(key) for key in exposed]
+    for replica, count in v.items():
+        if count > vector_clock.get(replica, 0):
+            first, digest = digests.get(replica, (None, 0))
+            if first is None or first > vector_clock.get(replica, 0) + 1 or any(digest & key == key for key in bits):
+                return 503
+
+# Create a function to merge two vector clocks into a new one
+def merge_clocks(v, clock):
+    merged = dict(v)
+    for replica, count in clock.items():
+        merged[replica] = max(merged.get(replica, 0), count)
+    return merged
+
+# Create a function to merge two causal-metadata objects: each entry takes the larger count, with a key digest that
+# was sent along with that count, the one reaching back furthest when both were
+def merge_metadata(v, w):
+    merged = merge_clocks(decode_vector_clock(v), decode_vector_clock(w))
+    digests = {}
+    for side in (v, w):
+        for replica, digest in decode_key_digests(side).items():
+            if side.get(replica) == merged.get(replica) and (replica not in digests or digest[0] < digests[replica][0]):
+                digests[replica] = digest
+    if digests:
+        merged["key-digests"] = {replica: [first, encode_digest(bits)] for replica, (first, bits) in digests.items()}
+    return merged
+
 # Create a function to update vector clock based on each replica to ensure eventual consistency
 def update_vector_clock(v):
-        vector_clock[0] = max(vector_clock[0], v[0])
-        vector_clock[1] = max(vector_clock[1], v[1])
-        vector_clock[2] = max(vector_clock[2], v[2])
-       
+    advanced = False
+    for replica, count in v.items():
+        if count > vector_clock.get(replica, 0):
+            vector_clock[replica] = count
+            advanced = True
+            if replica in applied_ahead:
+                settle_ahead(replica)
+    if advanced:
+        notify_clock_advanced()
+
+# Create a function to check whether the write at <position> from <replica> has been applied here, in order or ahead of its turn
+def has_applied(replica, position):
+    return position <= vector_clock.get(replica, 0) or position in applied_ahead.get(replica, ())
+
+# Create a function to record that the write at <position> from <origin> has been applied. The clock entry of <origin> only
+# counts writes applied without a gap, so a write applied ahead of an earlier one (see delivery_sweeper) is kept aside
+# until the earlier ones arrive. The caller holds state_lock.
+def advance_origin(origin, position):
+    applied_ahead.setdefault(origin, set()).add(position)
+    count = vector_clock.get(origin, 0)
+    settle_ahead(origin)
+    if vector_clock.get(origin, 0) > count:
+        notify_clock_advanced()
+
+# Create a function to move the positions of <replica> that are applied ahead into its clock entry once there is no gap before them
+def settle_ahead(replica):
+    count = vector_clock.get(replica, 0)
+    ahead = {position for position in applied_ahead.pop(replica) if position > count}
+    while count + 1 in ahead:
+        count += 1
+        ahead.remove(count)
+    vector_clock[replica] = count
+    if ahead:
+        applied_ahead[replica] = ahead
+
+# Create a function to wake the requests waiting for their causal dependencies
+def notify_clock_advanced():
+    global clock_version
+    with clock_advanced:
+        clock_version += 1
+        clock_advanced.notify_all()
+
+# Create a function to park a request until this replica has applied every write <v> depends on, or with <keys> only
+# those that could affect these keys according to the key <digests> (see compare_key_dependencies).
+# Waiters are woken each time the clock advances instead of polling. Gives up after CAUSAL_WAIT seconds,
+# or at once when MAX_WAITERS requests are already waiting; the caller's own check then answers 503.
+def wait_for_dependencies(v, keys=None, digests=None):
+    global waiters
+    with span("causal-wait"):
+        deadline = time.time() + CAUSAL_WAIT
+        with clock_advanced:
+            if waiters >= MAX_WAITERS:
+                return
+            waiters += 1
+        try:
+            while True:
+                with clock_advanced:
+                    version = clock_version
+                with state_lock.reading():
+                    if (compare_vector_clock(v) if keys is None else compare_key_dependencies(v, keys, digests)) != 503:
+                        return
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                with clock_advanced:
+                    if version == clock_version:
+                        clock_advanced.wait(remaining)
+        finally:
+            with clock_advanced:
+                waiters -= 1
+
+# Create a function to answer a request whose causal dependencies are not satisfied, counting it for /metrics
+def causal_rejection():
+    global causal_rejections
+    with metrics_lock:
+        causal_rejections += 1
+    return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
+
+# Create a function to answer a write that fewer replicas than its write quorum have applied. The write is kept here and
+# still reaches the other replicas in the background (or through hinted handoff), so its causal-metadata is returned too.
+# – Response code is 503 (Service Unavailable).
+# – Response body is JSON {"error": "Write quorum not reached", "causal-metadata": <V'>}.
+def quorum_failure(metadata):
+    return jsonify({"error": "Write quorum not reached", "causal-metadata": metadata}), 503
+
+# Create a function to encode the vector clock as causal-metadata.
+# The wire form is a JSON object {"<IP:PORT>": <count>, ...} that only lists replicas which have originated writes.
+def encode_vector_clock():
+    return {replica: count for replica, count in vector_clock.copy().items() if count}
+
+# Create a function to decode causal-metadata from a client or replica; null means no dependencies
+def decode_vector_clock(v):
+    if not isinstance(v, dict):
+        return {}
+    return {str(replica): count for replica, count in v.items() if isinstance(count, int) and count > 0}
+
+# Causal-metadata given to clients can also carry key digests, {"key-digests": {"<IP:PORT>": [<first>, "<bits>"], ...}}:
+# <bits> is a Bloom filter (DIGEST_BITS bits in unpadded URL-safe base64) of the keys of that replica's write steps from position
+# <first> up to its entry of the clock. Replicas use it to tell whether the writes a request depends on could affect its keys.
+DIGEST_BITS = 128
+
+# Create a function to write the bits of a key digest in their wire form
+def encode_digest(bits):
+    return base64.urlsafe_b64encode(bits.to_bytes(DIGEST_BITS // 8, "big")).rstrip(b"=").decode()
+
+# Create a function to read the bits of a key digest from their wire form. Raises ValueError when it is not valid.
+def decode_digest(text):
+    data = base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+    if len(data) != DIGEST_BITS // 8:
+        raise ValueError(text)
+    return int.from_bytes(data, "big")
+
+# Create a function to get the bits of <key> in a key digest
+def key_bits(key):
+    h = ring_hash(key)
+    return (1 << h % DIGEST_BITS) | (1 << (h >> 21) % DIGEST_BITS) | (1 << (h >> 42) % DIGEST_BITS)
+
+# Create a function to decode the key digests of causal-metadata into socket address -> (first, bits)
+def decode_key_digests(v):
+    if not isinstance(v, dict) or not isinstance(v.get("key-digests"), dict):
+        return {}
+    digests = {}
+    for replica, digest in v["key-digests"].items():
+        try:
+            first, bits = digest
+            digests[str(replica)] = (int(first), decode_digest(bits))
+        except (TypeError, ValueError):
+            continue
+    return digests
+
+# Create a function to add the keys of a write step from <origin> to the window of that replica's latest steps. The window
+# only holds consecutive positions, so it starts over after a gap (e.g. steps brought over by recovery). The caller holds state_lock.
+def remember_keys(origin, position, operations):
+    window = recent_keys.get(origin)
+    if window is None or window[-1][0] != position - 1:
+        window = recent_keys[origin] = deque(maxlen=KEY_WINDOW)
+    bits = 0
+    for operation in operations:
+        bits |= key_bits(operation["key"])
+    window.append((position, bits))
+
+# Create a function to build the key digests of <clock> from the windows of the replicas whose latest step applied here
+# is their entry of <clock>. The caller holds state_lock.
+def local_digests(clock):
+    digests = {}
+    for replica, window in recent_keys.items():
+        if window and window[-1][0] == clock.get(replica):
+            bits = 0
+            for _, step in window:
+                bits |= step
+            digests[replica] = [window[0][0], encode_digest(bits)]
+    return digests
+
+# Replicated writes sent to POST /replicate are encoded as
+#   b"KV1", flags, body                                    flags bit 0: body is zlib-compressed
+#   body = sender, clock entry count, (address, count)*, operation count, (code, key[, value])*
+# where strings are a varint length followed by UTF-8 bytes and counts are varints. PUT values that are not strings are sent as JSON.
+# A PUT that only creates its key (see apply_batch) has OP_IF_ABSENT added to its code.
+WIRE_TYPE = "application/x-kvs-replication"
+WIRE_MAGIC = b"KV1"
+OP_DELETE, OP_PUT_TEXT, OP_PUT_JSON = 0, 1, 2
+OP_IF_ABSENT = 4 # flag on a PUT that only creates the key
+
+# Create a function to append an unsigned integer to <out>, seven bits per byte
+def put_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+# Create a function to read an unsigned integer written by put_varint; returns it and the offset after it
+def get_varint(data, offset):
+    n = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+def put_text(out, text):
+    encoded = text.encode()
+    put_varint(out, len(encoded))
+    out += encoded
+
+def get_text(data, offset):
+    length, offset = get_varint(data, offset)
+    if offset + length > len(data):
+        raise IndexError("string runs past the end of the message")
+    return bytes(data[offset:offset + length]).decode(), offset + length
+
+# Create a function to encode a replicated write step, as broadcast to /kvs/_batch, for POST /replicate
+def encode_replication(payload):
+    out = bytearray()
+    put_text(out, payload.get("sender") or "")
+    clock = payload["causal-metadata"]
+    put_varint(out, len(clock))
+    for replica, count in clock.items():
+        put_text(out, replica)
+        put_varint(out, count)
+    put_varint(out, len(payload["operations"]))
+    for operation in payload["operations"]:
+        if operation["op"] == "DELETE":
+            out.append(OP_DELETE)
+            put_text(out, operation["key"])
+        elif isinstance(operation["value"], str):
+            out.append(OP_PUT_TEXT | (OP_IF_ABSENT if operation.get("if-absent") else 0))
+            put_text(out, operation["key"])
+            put_text(out, operation["value"])
+        else:
+            out.append(OP_PUT_JSON | (OP_IF_ABSENT if operation.get("if-absent") else 0))
+            put_text(out, operation["key"])
+            put_text(out, json.dumps(operation["value"], separators=(",", ":")))
+    flags, body = 0, bytes(out)
+    if len(body) >= COMPRESS_MIN:
+        packed = zlib.compress(body, 1)
+        if len(packed) < len(body):
+            flags, body = 1, packed
+    return WIRE_MAGIC + bytes([flags]) + body
+
+# Create a function to decode a message written by encode_replication back into the payload it was made from.
+# Raises ValueError when the message is not valid.
+def decode_replication(message):
+    if message[:3] != WIRE_MAGIC or len(message) < 4:
+        raise ValueError("not a replication message")
+    try:
+        data = zlib.decompress(message[4:]) if message[3] & 1 else message[4:]
+    except zlib.error as e:
+        raise ValueError("corrupt replication message") from e
+    try:
+        sender, offset = get_text(data, 0)
+        entries, offset = get_varint(data, offset)
+        clock = {}
+        for _ in range(entries):
+            replica, offset = get_text(data, offset)
+            clock[replica], offset = get_varint(data, offset)
+        count, offset = get_varint(data, offset)
+        operations = []
+        for _ in range(count):
+            code = data[offset]
+            key, offset = get_text(data, offset + 1)
+            if code == OP_DELETE:
+                operations.append({"op": "DELETE", "key": key})
+                continue
+            if code & ~OP_IF_ABSENT not in (OP_PUT_TEXT, OP_PUT_JSON):
+                raise ValueError(f"unknown operation code {code}")
+            value, offset = get_text(data, offset)
+            operation = {"op": "PUT", "key": key, "value": value if code & ~OP_IF_ABSENT == OP_PUT_TEXT else json.loads(value)}
+            if code & OP_IF_ABSENT:
+                operation["if-absent"] = True
+            operations.append(operation)
+    except (IndexError, UnicodeDecodeError) as e:
+        raise ValueError("truncated replication message") from e
+    if offset != len(data):
+        raise ValueError("trailing bytes after the replication message")
+    return {"sender": sender or None, "causal-metadata": clock, "operations": operations, "broadcasted": "true"}
+
+# Create a function to tell whether a message to a replica is a replicated write step, which can go over the binary encoding
+def is_replication(path, payload):
+    return WIRE_PROTOCOL == "binary" and path == "/kvs/_batch" and "broadcasted" in payload
+
+# Create a function to send a message to a replica, using the binary encoding for replicated write steps.
+# A replica that does not know POST /replicate answers 404 or 415; it is then sent JSON until it rejoins the view.
+def peer_send(method, replica, path, payload, timeout, encoded=None):
+    if is_replication(path, payload) and peer_protocols.get(replica) != "json":
+        if encoded is None:
+            encoded = encode_replication(payload)
+        r = peer_request("POST", replica, "/replicate", data=encoded, headers={"Content-Type": WIRE_TYPE}, timeout=timeout)
+        if r.status_code not in (404, 405, 415):
+            peer_protocols[replica] = "binary"
+            return r
+        peer_protocols[replica] = "json"
+    return peer_request(method, replica, path, json=payload, timeout=timeout)
+
+# Create a function to get the keep-alive session for a replica, creating its connection pool on first use
+def peer_session(replica):
+    with peer_lock:
+        if replica not in peer_sessions:
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+            peer_sessions[replica] = session
+            peer_health[replica] = {"healthy": True, "failures": 0, "last-seen": None, "up-since": None, "requests": 0}
+        return peer_sessions[replica]
+
+# Create a function to send a request to a replica through its pooled session and record its health.
+# Every replica-to-replica call goes through here so connections are reused instead of reopened.
+# A call made while tracing is a span of its own, and passes its id on in a traceparent header.
+def peer_request(method, replica, path, **kwargs):
+    session = peer_session(replica)
+    health = peer_health[replica]
+    with peer_lock:
+        health["requests"] += 1
+    with span(f"{method} {path}", peer=replica) as attributes:
+        context = getattr(trace_local, "context", None)
+        if context is not None:
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, traceparent=f"00-{context[0]}-{context[1]}-01")
+        try:
+            r = session.request(method, f"http://{replica}{path}", **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # A replica that is stopped keeps its connections open, so it shows up as a read timeout instead
+            with peer_lock:
+                health["healthy"] = False
+                health["failures"] += 1
+                health["up-since"] = None
+            raise
+        attributes["status"] = r.status_code
+    with peer_lock:
+        health["healthy"] = True
+        health["failures"] = 0
+        health["last-seen"] = time.time()
+        if health["up-since"] is None:
+            health["up-since"] = health["last-seen"]
+    return r
+
+# Create a function to report the connection reuse counters of every replica's pool
+def peer_stats():
+    stats = {}
+    for replica, session in list(peer_sessions.items()):
+        pools = session.get_adapter("http://").poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        with peer_lock:
+            health = dict(peer_health[replica])
+        stats[replica] = dict(health, connections=connections, reused=max(health["requests"] - connections, 0),
+                              hints=len(hinted_handoff.get(replica, ())))
+    return stats
+
+# Create a function to remember a write that a removed replica missed. The caller holds handoff_lock.
+# Once a replica misses more than HINT_LIMIT writes, or the hints outgrow their share of MEMORY_BUDGET, its hints are dropped,
+# since a full transfer is cheaper.
+def add_hint(replica, method, path, payload):
+    hints = hinted_handoff.setdefault(replica, deque())
+    if replica in handoff_overflowed:
+        return
+    size = operations_size(payload.get("operations", ()))
+    count_log("hints", size)
+    if len(hints) >= HINT_LIMIT or log_over_budget("hints"):
+        count_log("hints", -size - sum(hint[3] for hint in hints))
+        hints.clear()
+        handoff_overflowed.add(replica)
+        return
+    hints.append((method, path, payload, size))
+
+# Create a function to replay the writes a replica missed, in order, before adding it back to the view (or keeping it there).
+# Writes made while the replay runs are queued behind it, so the replica is only added once the queue is empty.
+# A rejoining replica announces itself before it starts serving, so failed sends are retried with backoff for a while.
+def replay_hints(replica):
+    backoff = 0.1
+    deadline = time.time() + HANDOFF_RETRY_SECONDS
+    while True:
+        with handoff_lock:
+            hints = hinted_handoff.get(replica)
+            if not hints:
+                hinted_handoff.pop(replica, None)
+                handoff_overflowed.discard(replica)
+                handoff_replaying.discard(replica)
+                sa_store[replica] = True
+                return
+            hint = hints[0]
+        method, path, payload, _ = hint
+        try:
+            peer_send(method, replica, path, payload, timeout=0.5)
+        except requests.exceptions.RequestException:
+            if time.time() + backoff < deadline:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 2)
+                continue
+            # The replica went away again; the remaining hints are kept for its next rejoin
+            with handoff_lock:
+                handoff_replaying.discard(replica)
+            return
+        with handoff_lock:
+            if hints and hints[0] is hint:
+                hints.popleft()
+                count_log("hints", -hint[3])
+
+# Create a function to send one broadcast message to a replica and record its round trip, or its failure, for /metrics
+def timed_peer_request(method, replica, path, payload, timeout, encoded=None):
+    start = time.perf_counter()
+    try:
+        r = peer_send(method, replica, path, payload, timeout, encoded)
+    except requests.exceptions.RequestException:
+        with metrics_lock:
+            peer_failures[replica] = peer_failures.get(replica, 0) + 1
+        raise
+    with metrics_lock:
+        histogram = peer_latency.get(replica) or peer_latency.setdefault(replica, Histogram())
+    histogram.observe(time.perf_counter() - start)
+    return r
+
+# Create a function to send the same request to every other replica in the view at the same time,
+# so the caller waits for the slowest replica instead of the sum of all of them.
+# Returns how many replicas confirmed the request with 200 (Ok); a replicated write that is only buffered (202),
+# or any error, is not a confirmation.
+# With handoff=True the write is also queued for every removed replica, and for any replica it fails to reach; the
+# failure detector sends those again once the replica answers a heartbeat, or removes it when it keeps missing them.
+# With shard=True only the replicas of our own shard are sent to.
+# With quorum=<n> it returns as soon as <n> replicas have confirmed; the others are settled in the background,
+# where a replica that cannot be reached is queued a hint.
+def broadcast(method, path, payload, timeout=0.5, handoff=False, shard=False, quorum=None):
+    with handoff_lock:
+        replicas = [replica for replica in sa_store.copy() if replica != SOCKET_ADDRESS]
+        missing = [replica for replica in hinted_handoff if replica not in sa_store]
+        if shard and SHARD_ID is not None:
+            replicas = [replica for replica in replicas if replica_shard(replica) == SHARD_ID]
+            missing = [replica for replica in missing if replica_shard(replica) == SHARD_ID]
+        if handoff:
+            for replica in missing:
+                add_hint(replica, method, path, payload)
+    # A replicated write is encoded once for all replicas
+    encoded = encode_replication(payload) if is_replication(path, payload) and replicas else None
+    context = current_trace()
+    futures = {broadcast_pool.submit(traced, context, timed_peer_request, method, replica, path, payload, timeout, encoded): replica
+               for replica in replicas}
+    # Returns the reply of a replica, or None when it could not be reached
+    def reached(future):
+        try:
+            return future.result()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # A pooled connection to a replica that went away times out instead of being refused
+            if handoff:
+                with handoff_lock:
+                    add_hint(futures[future], method, path, payload)
+            return None
+
+    confirmed, pending = 0, set(futures)
+    if quorum is None or quorum > 0:
+        for future in as_completed(futures):
+            pending.discard(future)
+            r = reached(future)
+            if r is not None and r.status_code == 200:
+                confirmed += 1
+            if quorum is not None and confirmed >= quorum:
+                break
+    for future in pending:
+        future.add_done_callback(reached)
+    return confirmed
+
+# Create a function to send a write step made here to every other replica of our shard, as one replicated batch.
+# Returns once <quorum> replicas, counting this one, have applied it (every reachable one when None), with whether the
+# quorum was reached.
+def replicate(operations, clock, quorum=None):
+    with span("replicate", quorum=quorum or "all"):
+        confirmed = broadcast("POST", "/kvs/_batch", {"operations": operations, "causal-metadata": clock, "sender": SOCKET_ADDRESS, "broadcasted": "true"},
+                                           handoff=True, shard=True, quorum=None if quorum is None else quorum - 1)
+    return quorum is None or confirmed + 1 >= quorum
+
+# Create a function to read a quorum from the X-Write-Quorum or X-Read-Quorum header of the request, or from <default>.
+# Returns a number of replicas, None for "all", or raises ValueError when the setting is not valid.
+def quorum_setting(header, default):
+    setting = request.headers.get(header, default).strip().lower()
+    if setting == "all":
+        return None
+    quorum = int(setting)
+    if quorum < 1:
+        raise ValueError(setting)
+    return quorum
+
+# Create a function to get the quorum headers of the request, which travel with it when it is forwarded to another shard
+def quorum_headers():
+    return {header: request.headers[header] for header in ("X-Write-Quorum", "X-Read-Quorum") if header in request.headers}
+
+# Create a function to record a write step in the operation log under the clock position of the replica it came from.
+# When persistence is on, the step is also appended to the write-ahead log; the returned sequence number
+# is passed to wait_durable before the write is acknowledged.
+def log_operations(operations, origin, position):
+    global oplog_dropped
+    if origin is None:
+        return 0
+    with state_lock:
+        size = operations_size(operations)
+        op_log.append((origin, position, operations, size))
+        count_log("op-log", size)
+        if KEY_WINDOW:
+            remember_keys(origin, position, operations)
+        if watchers:
+            publish(operations, encode_vector_clock())
+        while len(op_log) > OPLOG_LIMIT or (op_log and log_over_budget("op-log")):
+            dropped, dropped_position, _, dropped_size = op_log.popleft()
+            count_log("op-log", -dropped_size)
+            oplog_floor[dropped] = max(oplog_floor.get(dropped, 0), dropped_position)
+            oplog_dropped += 1
+        if DATA_DIR:
+            return wal_append({"origin": origin, "position": position, "operations": operations})
+    return 0
+
+# Create a function to hand the operations of a write step applied here to the watchers of their keys.
+# <clock> is the clock after the step, which a watcher can resume from. The caller holds state_lock.
+def publish(operations, clock):
+    with watch_lock:
+        current = list(watchers)
+    for watcher in current:
+        for operation in operations:
+            if watcher.matches(operation["key"]):
+                watcher.push(dict(operation, **{"causal-metadata": clock}))
+
+# Create a function to get the path of a write-ahead log segment or of the snapshot
+def data_path(name):
+    return os.path.join(DATA_DIR, name)
+
+# Create a function to append a record to the open write-ahead log segment. The record is only buffered here;
+# wal_flusher writes everything buffered with one fsync. Starts a snapshot once the segment has grown large.
+def wal_append(record):
+    global wal_written, wal_records
+    with wal_cond:
+        wal_file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        wal_written += 1
+        wal_records += 1
+        wal_cond.notify_all()
+        seq = wal_written
+        if wal_records >= SNAPSHOT_EVERY and not snapshot_running.is_set():
+            snapshot_running.set()
+            threading.Thread(target=take_snapshot, daemon=True).start()
+    return seq
+
+# Create a function to wait until the write-ahead log record <seq> is on disk
+def wait_durable(seq):
+    if not DATA_DIR or not seq:
+        return
+    with span("fsync"), wal_cond:
+        while wal_synced < seq:
+            wal_cond.wait()
+
+# Create a function that runs on its own thread and fsyncs the write-ahead log whenever records are waiting.
+# Records appended while an fsync is running are covered together by the next one (group commit).
+def wal_flusher():
+    global wal_synced
+    while True:
+        with wal_cond:
+            while wal_written == wal_synced:
+                wal_cond.wait()
+        with wal_io_lock:
+            with wal_cond:
+                target = wal_written
+                wal_file.flush()
+                f = wal_file
+            os.fsync(f.fileno())
+        with wal_cond:
+            wal_synced = max(wal_synced, target)
+            wal_cond.notify_all()
+
+# Create a function to close the open write-ahead log segment and start the next one. Returns the new segment number.
+def rotate_wal():
+    global wal_file, wal_generation, wal_records, wal_synced
+    with wal_io_lock:
+        with wal_cond:
+            if wal_file is not None:
+                wal_file.flush()
+                os.fsync(wal_file.fileno())
+                wal_file.close()
+            wal_generation += 1
+            wal_file = open(data_path(f"wal.{wal_generation:08d}"), "a")
+            wal_records = 0
+            wal_synced = wal_written
+            wal_cond.notify_all()
+            return wal_generation
+
+# Create a function to write a snapshot of kv_store and the vector clock, then delete the log segments it replaces.
+# The snapshot is one JSON header line followed by one line per key, so it can be read back through mmap.
+def take_snapshot():
+    try:
+        # Switching segments and reading the clock under the same lock gives the cut the snapshot starts from
+        with state_lock:
+            generation = rotate_wal()
+            clock = encode_vector_clock()
+            ahead = {replica: sorted(positions) for replica, positions in applied_ahead.items()}
+        temp = data_path("snapshot.tmp")
+        with open(temp, "w") as f:
+            f.write(json.dumps({"causal-metadata": clock, "applied-ahead": ahead, "wal": generation}) + "\n")
+            # The store is written a page at a time. A value written after the cut may be in the snapshot too, which is
+            # harmless: the log segments from the cut on are replayed over it in order, so every key ends at its last value.
+            for page in store_pages():
+                for key, value in page:
+                    f.write(json.dumps({"key": key, "value": value}, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, data_path("snapshot"))
+        directory = os.open(DATA_DIR, os.O_RDONLY)
+        os.fsync(directory)
+        os.close(directory)
+        for name in os.listdir(DATA_DIR):
+            if name.startswith("wal.") and int(name[4:]) < generation:
+                os.remove(data_path(name))
+    finally:
+        snapshot_running.clear()
+
+# Create a function to rebuild kv_store and the vector clock from the last snapshot and the log segments written after it
+def load_persisted_state():
+    global wal_generation
+    os.makedirs(DATA_DIR, exist_ok=True)
+    first = 0
+    if os.path.exists(data_path("snapshot")):
+        with open(data_path("snapshot"), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            header = json.loads(snapshot.readline())
+            for line in iter(snapshot.readline, b""):
+                item = json.loads(line)
+                store_put(item["key"], item["value"])
+        update_vector_clock(decode_vector_clock(header["causal-metadata"]))
+        for replica, positions in header.get("applied-ahead", {}).items():
+            applied_ahead[replica] = set(positions)
+        first = header["wal"]
+    segments = sorted(int(name[4:]) for name in os.listdir(DATA_DIR) if name.startswith("wal."))
+    for generation in segments:
+        if generation < first:
+            continue
+        with open(data_path(f"wal.{generation:08d}")) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record was only partly written before the replica stopped
+                    break
+                apply_batch(record["operations"])
+                if not has_applied(record["origin"], record["position"]):
+                    advance_origin(record["origin"], record["position"])
+    # Never append to a segment that may end in a torn record
+    wal_generation = max(segments + [first])
+    rotate_wal()
+    threading.Thread(target=wal_flusher, daemon=True).start()
+
+# Create a function to collect the write steps applied here that the clock <v> has not seen, in the order they were applied.
+# Returns None when the log has been truncated past <v> and a snapshot has to be sent instead.
+def operations_since(v):
+    if not isinstance(v, dict):
+        return None
+    v = decode_vector_clock(v)
+    with state_lock.reading():
+        for origin, floor in oplog_floor.items():
+            if v.get(origin, 0) < floor:
+                return None
+        return [[origin, position, operations] for origin, position, operations, _ in op_log if position > v.get(origin, 0)]
+
+# Create a function to count the write steps applied here that the clock <v> has not seen, without collecting them.
+# Returns None when the log has been truncated past <v>. The caller holds state_lock (either side).
+def count_steps_since(v):
+    if not isinstance(v, dict):
+        return None
+    v = decode_vector_clock(v)
+    for origin, floor in oplog_floor.items():
+        if v.get(origin, 0) < floor:
+            return None
+    return sum(1 for origin, position, _, _ in op_log if position > v.get(origin, 0))
+
+# Create a function to walk the write steps applied here that the clock <v> has not seen, in the order they were applied,
+# a page of STREAM_PAGE steps per hold of state_lock's reader side. <index> and <end> are the positions in the log
+# (counting dropped steps) of its start and end, i.e. oplog_dropped and oplog_dropped + len(op_log), read under the same
+# hold of the lock as the clock the walk goes with. Yields [<origin>, <position>, <operations>] for each step, and None,
+# after which it stops, when the steps still to come have been dropped from the log in the meantime.
+def steps_since(v, index, end):
+    v = decode_vector_clock(v)
+    while index < end:
+        with state_lock.reading():
+            skip = index - oplog_dropped
+            page = list(islice(op_log, skip, skip + min(STREAM_PAGE, end - index))) if skip >= 0 else None
+        if page is None:
+            yield None
+            return
+        index += len(page)
+        for origin, position, operations, _ in page:
+            if position > v.get(origin, 0):
+                yield [origin, position, operations]
+
+# Create a function to remove a replica from the view and start collecting the writes it misses.
+# Unless the removal was itself broadcast to us, the other replicas are told to remove it too.
+def remove_replica(replica, broadcasted=False):
+    with handoff_lock:
+        if replica not in sa_store:
+            return False
+        del sa_store[replica]
+        hinted_handoff.setdefault(replica, deque())
+    if not broadcasted:
+        broadcast("DELETE", "/view", {"socket-address": replica, "broadcasted": "true"}, timeout=0.2)
+    return True
+
+# Create a function to send one heartbeat (GET /view) to a replica and act on the answer.
+# A replica in our view that misses HEARTBEAT_MISSES heartbeats in a row is removed. A replica whose view has
+# not listed us for REJOIN_DELAY seconds while it answers gets a PUT /view from us, which replays what we missed.
+def heartbeat(replica, excluded_since):
+    try:
+        r = peer_request("GET", replica, "/view", timeout=min(0.5, HEARTBEAT_INTERVAL))
+        body = r.json()
+        view = list(body["view"])
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+        with peer_lock:
+            failures = peer_health[replica]["failures"] if replica in peer_health else 0
+        if replica in sa_store and failures >= HEARTBEAT_MISSES:
+            remove_replica(replica)
+        excluded_since.pop(replica, None)
+        return
+    learn_shard(replica, body)
+    # A failed request on another thread may clear up-since after this heartbeat got its answer; then it is not up yet
+    with peer_lock:
+        up_since = peer_health[replica]["up-since"]
+    with handoff_lock:
+        # Writes that the replica did not get while it stayed in the view are sent again, in order, once it has answered
+        # for REJOIN_DELAY seconds, as a removed replica would rejoin
+        if (replica in sa_store and replica in hinted_handoff and replica not in handoff_replaying
+                and up_since is not None and time.time() - up_since >= REJOIN_DELAY):
+            handoff_replaying.add(replica)
+            threading.Thread(target=replay_hints, args=(replica,), daemon=True).start()
+    if SOCKET_ADDRESS in view:
+        excluded_since.pop(replica, None)
+        return
+    since = excluded_since.setdefault(replica, time.time())
+    if time.time() - since >= REJOIN_DELAY:
+        excluded_since.pop(replica, None)
+        try:
+            peer_request("PUT", replica, "/view", json=view_announcement(), timeout=0.5)
+        except requests.exceptions.RequestException:
+            pass
+
+# Create a function that runs on its own thread and keeps the view up to date from heartbeats, off the client request path.
+# Replicas that were removed, or that are in the configured VIEW, are probed too, so a healed partition is noticed.
+def failure_detector():
+    excluded_since = {}
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        with handoff_lock:
+            replicas = set(sa_store) | set(hinted_handoff) | set(views)
+        replicas.discard(SOCKET_ADDRESS)
+        for future in [detector_pool.submit(heartbeat, replica, excluded_since) for replica in replicas]:
+            # A heartbeat that fails in an unexpected way is logged, and the loop goes on, so the view keeps being maintained
+            try:
+                future.result()
+            except Exception:
+                app.logger.exception("heartbeat failed")
+
 # Create a function to check if the length of the key <key> is more than 50 characters
 def is_key_valid(key):
     return len(key) < 50
 
-views = VIEW.split(",")
-for view in views:
-    if view != SOCKET_ADDRESS:
+# Create a function to place a string on the consistent-hash ring
+def ring_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+# Create a function to get the shard of a replica, or None if it has not told us yet
+def replica_shard(replica):
+    return SHARD_ID if replica == SOCKET_ADDRESS else replica_shards.get(replica)
+
+# Create a function to get the replicas of the view that belong to <shard>, in address order
+def shard_members(shard):
+    return sorted(replica for replica in sa_store.copy() if replica_shard(replica) == shard)
+
+# Create a function to get the consistent-hash ring over the shards that have a replica in the view.
+# Each shard owns SHARD_VNODES points, so a shard joining or leaving only moves the keys next to its own points.
+def shard_ring():
+    global ring_cache, ring_changed
+    shards = frozenset(replica_shard(replica) for replica in sa_store.copy()) - {None} | {SHARD_ID}
+    if ring_cache[0] != shards:
+        ring_changed = time.time()
+        points = sorted((ring_hash(f"{shard}#{i}"), shard) for shard in shards for i in range(SHARD_VNODES))
+        ring_cache = (shards, [point for point, _ in points], [shard for _, shard in points])
+    return ring_cache
+
+# Create a function to find the shard that owns <key>: the first shard point at or after the key on the ring
+def key_shard(key, ring=None):
+    _, points, owners = ring or shard_ring()
+    return owners[bisect_left(points, ring_hash(key)) % len(points)]
+
+# Create a function to keep only the entries of a vector clock that belong to this replica's shard.
+# Each shard keeps its own clock, so causal-metadata is the union of the clocks of the shards a client has used.
+def shard_entries(v):
+    if SHARD_ID is None:
+        return v
+    return {replica: count for replica, count in v.items() if replica_shard(replica) == SHARD_ID}
+
+# Create a function to build the causal-metadata returned to a client: this shard's <clock>, with its key digests,
+# merged into the client's causal-metadata <v>. The client keeps its dependencies on the other shards, and on the writes
+# of this shard that a request whose keys they do not affect (see compare_key_dependencies) did not wait for.
+# The caller holds state_lock (either side).
+def response_clock(v, clock):
+    return merge_metadata(v, dict(clock, **{"key-digests": local_digests(clock)}) if KEY_WINDOW else clock)
+
+# Create a function to send a request to a replica of <shard>, trying the next one when a replica cannot be reached.
+# Returns None when no replica of the shard answers.
+def send_to_shard(shard, method, path, payload, headers=None):
+    replicas = shard_members(shard)
+    random.shuffle(replicas)
+    for replica in replicas:
         try:
-            requests.put(f"http://{view}/view", json={"socket-address": SOCKET_ADDRESS}, timeout=0.2)
-        except requests.exceptions.ConnectionError:
-            pass
-        else:
-            sa_store[view] = True
-            r = requests.get(f"http://{view}/kvs", json={"socket-address": SOCKET_ADDRESS})
-            kv_store.update(r.json()["recovery_data"])
-            update_vector_clock(r.json()["causal-metadata"])
-    if view == SOCKET_ADDRESS:
-        sa_store[view] = True
-        pass
+            return peer_request(method, replica, path, json=payload, headers=dict(headers or {}, **{"X-Forwarded-Shard": SHARD_ID}),
+                                timeout=FORWARD_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            continue
+    return None
+
+# Create a function to answer a client request from the shard that owns its key.
+# – Response code is 503 (Service Unavailable) {"error": "No replica of the shard is reachable"} when none answers.
+def forward_to_shard(shard, method, path, payload):
+    r = send_to_shard(shard, method, path, payload, quorum_headers())
+    if r is None:
+        return jsonify({"error": "No replica of the shard is reachable"}), 503
+    return Response(r.content, status=r.status_code, mimetype="application/json")
+
+# Create a function to get the fields that tell other replicas our shard; empty when keys are not sharded
+def shard_info():
+    return {} if SHARD_ID is None else {"shard-id": SHARD_ID}
+
+# Create a function to build the body of PUT /view that announces this replica
+def view_announcement():
+    return dict(shard_info(), **{"socket-address": SOCKET_ADDRESS})
+
+# Create a function to remember the shard a replica announced in a PUT /view or GET /view body,
+# and whether it is moving keys to another shard
+def learn_shard(replica, body):
+    if isinstance(body, dict) and isinstance(body.get("shard-id"), str):
+        replica_shards[replica] = body["shard-id"]
+        replica_moving[replica] = body.get("moving") is True
+
+# Create a function to drop keys that were copied to their new shard, as one write step replicated to our shard.
+# A key written again since it was copied stays until the next pass.
+def drop_moved(moved):
+    with state_lock:
+        deletes = [{"op": "DELETE", "key": operation["key"]} for operation in moved
+                   if kv_store.peek(operation["key"], absent) == operation["value"]]
+        if not deletes:
+            return
+        inc_vector_clock()
+        apply_batch(deletes)
+        durable = log_operations(deletes, SOCKET_ADDRESS, vector_clock[SOCKET_ADDRESS])
+        clock = encode_vector_clock()
+    replicate(deletes, clock)
+    wait_durable(durable)
+
+# Create a function to copy every key that another shard now owns to that shard, REBALANCE_BATCH keys per request,
+# and drop it here. Returns False if a shard could not be reached, so the pass is tried again.
+# The copies only create keys, since a key the new shard already has was written there after it took the key over.
+def move_misplaced_keys():
+    ring = shard_ring()
+    misplaced = {}
+    with state_lock.reading():
+        for key in kv_store:
+            shard = key_shard(key, ring)
+            if shard != SHARD_ID:
+                misplaced.setdefault(shard, []).append(key)
+    for shard, keys in misplaced.items():
+        for start in range(0, len(keys), REBALANCE_BATCH):
+            with state_lock.reading():
+                moving = [{"op": "PUT", "key": key, "value": kv_store.peek(key), "if-absent": True} for key in keys[start:start + REBALANCE_BATCH] if key in kv_store]
+            if not moving:
+                continue
+            r = send_to_shard(shard, "POST", "/kvs/_batch", {"operations": moving, "causal-metadata": None})
+            if r is None or r.status_code != 200:
+                return False
+            drop_moved(moving)
+    return True
+
+# Create a function that runs on its own thread and moves keys to their new shard after the set of shards in the view changes.
+# Only the replica of our shard with the smallest address moves keys; the others drop them when its deletes reach them.
+# While it moves keys it says so in GET /view, so the new shard reads the keys it does not have yet from here.
+def rebalancer():
+    global moving_keys
+    settled = None
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        members = shard_members(SHARD_ID)
+        state = (shard_ring()[0], members[0] if members else SOCKET_ADDRESS)
+        if state == settled:
+            continue
+        if state[1] != SOCKET_ADDRESS:
+            settled = state
+            continue
+        moving_keys = True
+        if move_misplaced_keys():
+            settled = state
+            moving_keys = False
+
+# Create a function to find the leaf of the hash tree that covers <key>
+def key_leaf(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big") % MERKLE_LEAVES
+
+# Create a function to hash one key-value pair for the hash tree
+def entry_hash(key, value):
+    entry = json.dumps([key, value], sort_keys=True, separators=(",", ":"))
+    return int.from_bytes(hashlib.blake2b(entry.encode(), digest_size=8).digest(), "big")
+
+# Create a function to fold <delta> into a leaf and every node above it. Nodes are XORs of entry hashes,
+# so a write updates the tree in log(MERKLE_LEAVES) steps instead of rehashing a range.
+def merkle_update(leaf, delta):
+    node = MERKLE_LEAVES + leaf
+    while node >= 1:
+        merkle_tree[node] ^= delta
+        node //= 2
+
+# Create a function to record that the writes with clock <version> set or removed <key>. A version is only kept while the
+# vector clock has not caught up with it: a write whose dependencies were all applied here tells nothing the clock does not,
+# except that it keeps the version of a key written earlier. <version> None, for a value copied from another replica's store,
+# forgets it. The caller holds state_lock.
+def record_version(key, version):
+    if version is None:
+        key_versions.pop(key, None)
+    elif key in key_versions:
+        key_versions[key] = merge_clocks(key_versions[key], version)
+    elif compare_vector_clock(version) == 503:
+        key_versions[key] = version
+
+# Create a function to set <key> in kv_store and update the hash tree, the key index and the key's version. The caller holds state_lock.
+def store_put(key, value, version=None):
+    old = kv_store.peek(key, absent)
+    leaf = key_leaf(key)
+    delta = entry_hash(key, value)
+    if old is absent:
+        merkle_keys[leaf].add(key)
+        key_index.add(key)
+    else:
+        delta ^= entry_hash(key, old)
+    kv_store[key] = value
+    merkle_update(leaf, delta)
+    record_version(key, version)
+
+# Create a function to remove <key> from kv_store, the hash tree and the key index, and update its version. The caller holds state_lock.
+def store_delete(key, version=None):
+    record_version(key, version)
+    value = kv_store.peek(key)
+    del kv_store[key]
+    key_index.remove(key)
+    leaf = key_leaf(key)
+    merkle_keys[leaf].discard(key)
+    merkle_update(leaf, entry_hash(key, value))
+
+# Create a function to apply a list of batch operations to kv_store in order and collect one result per operation.
+# <version> is the clock of the write step, when it is known. A PUT with "if-absent" only creates its key: every replica
+# leaves a key it already has as it is, so a write that reached it first is kept.
+def apply_batch(operations, version=None):
+    results = []
+    with state_lock:
+        for operation in operations:
+            key = operation["key"]
+            if operation["op"] == "PUT" and operation.get("if-absent") and key in kv_store:
+                results.append({"key": key, "result": "kept"})
+            elif operation["op"] == "PUT":
+                results.append({"key": key, "result": "created" if key not in kv_store else "replaced"})
+                store_put(key, operation["value"], version)
+            elif key not in kv_store:
+                results.append({"key": key, "error": "Key does not exist"})
+            elif operation["op"] == "GET":
+                results.append({"key": key, "result": "found", "value": kv_store[key]})
+            else:
+                store_delete(key, version)
+                results.append({"key": key, "result": "deleted"})
+    return results
+
+# Create a function to find the clock entry that a write replicated from <origin> is still waiting for, as (replica, count),
+# or None when it can be applied: it must be the next write from <origin>, and every other write it depends on must be applied here.
+def missing_dependency(origin, clock):
+    if not has_applied(origin, clock.get(origin, 0) - 1):
+        return origin, clock[origin] - 1
+    for replica, count in clock.items():
+        if replica != origin and not has_applied(replica, count):
+            return replica, count
+    return None
+
+# Create a function to apply a replicated write step and advance the clock entry of <origin>. A write that arrives after a
+# write depending on it was applied anyway (see delivery_sweeper) leaves out the keys that write has already overwritten,
+# so a late write is applied rather than discarded without putting back an older value. The caller holds state_lock.
+def deliver(origin, clock, operations):
+    if origin is None:
+        update_vector_clock(clock)
+    else:
+        position = clock.get(origin, 0)
+        operations = [operation for operation in operations if key_versions.get(operation["key"], {}).get(origin, 0) < position]
+        advance_origin(origin, position)
+    apply_batch(operations, clock)
+    delivery_stats["delivered"] += 1
+    return log_operations(operations, origin, clock.get(origin, 0))
+
+# Create a function to buffer a replicated write step until the clock entry <dependency> is reached. The caller holds state_lock.
+def buffer_write(origin, position, clock, operations, dependency, arrived):
+    size = operations_size(operations)
+    pending_writes[(origin, position)] = (clock, operations, arrived, size)
+    count_log("pending", size)
+    heapq.heappush(pending_index.setdefault(dependency[0], []), (dependency[1], origin, position))
+
+# Create a function to take the write step of <origin> at <position> out of the buffer, as (clock, operations, arrival time),
+# or None when it is not buffered. The caller holds state_lock.
+def take_pending(origin, position):
+    entry = pending_writes.pop((origin, position), None)
+    if entry is None:
+        return None
+    count_log("pending", -entry[3])
+    return entry[:3]
+
+# Create a function to record how long a buffered write waited before it was applied. The caller holds state_lock.
+def record_delay(delay):
+    delivery_stats["delayed"] += 1
+    delivery_stats["delay-total"] += delay
+    delivery_stats["delay-max"] = max(delivery_stats["delay-max"], delay)
+
+# Create a function to apply every buffered write whose dependencies have now been applied, in causal order.
+# Each buffered write is indexed under the one clock entry it waits for, so only the writes whose entry moved are looked at.
+# The caller holds state_lock. Returns the write-ahead log sequence number to wait for.
+def deliver_pending():
+    durable = 0
+    progress = True
+    while progress:
+        progress = False
+        for replica, waiting in list(pending_index.items()):
+            while waiting and waiting[0][0] <= vector_clock.get(replica, 0):
+                _, origin, position = heapq.heappop(waiting)
+                entry = take_pending(origin, position)
+                if entry is None:
+                    continue
+                clock, operations, arrived = entry
+                if has_applied(origin, position):
+                    delivery_stats["duplicates"] += 1
+                    continue
+                dependency = missing_dependency(origin, clock)
+                if dependency is not None:
+                    buffer_write(origin, position, clock, operations, dependency, arrived)
+                    continue
+                record_delay(time.time() - arrived)
+                durable = max(durable, deliver(origin, clock, operations))
+                progress = True
+            if not waiting:
+                pending_index.pop(replica, None)
+    return durable
+
+# Create a function to apply the buffered writes whose dependency was applied ahead of its turn, which the index of
+# deliver_pending does not see since that clock entry has not moved, and then the writes waiting for them.
+# The caller holds state_lock.
+def deliver_unblocked():
+    progress = True
+    while progress:
+        progress = False
+        for (origin, position), (clock, operations, arrived, _) in sorted(pending_writes.items(), key=lambda item: sum(item[1][0].values())):
+            if (origin, position) not in pending_writes or missing_dependency(origin, clock) is not None:
+                continue
+            take_pending(origin, position)
+            if has_applied(origin, position):
+                delivery_stats["duplicates"] += 1
+                continue
+            record_delay(time.time() - arrived)
+            deliver(origin, clock, operations)
+            progress = True
+        deliver_pending()
+
+# Create a function to take in a write step replicated from <origin> with the clock of that replica after the write.
+# Steps are applied in causal order: one that arrives before a write it depends on is buffered until that write has been
+# applied, and one that was already applied (e.g. replayed from hinted handoff) is ignored.
+# Returns "delivered", "buffered" or "duplicate", the write-ahead log sequence number to wait for, and the clock.
+def receive_replicated(origin, clock, operations):
+    with state_lock:
+        if origin is None:
+            return "delivered", deliver(origin, clock, operations), encode_vector_clock()
+        position = clock.get(origin, 0)
+        if has_applied(origin, position) or (origin, position) in pending_writes:
+            delivery_stats["duplicates"] += 1
+            return "duplicate", 0, encode_vector_clock()
+        # Until this replica has caught up, writes are held back so that recovery cannot overwrite them;
+        # bootstrap delivers them once it is done
+        dependency = missing_dependency(origin, clock) if bootstrapped.is_set() else (origin, position - 1)
+        if dependency is not None:
+            buffer_write(origin, position, clock, operations, dependency, time.time())
+            delivery_stats["buffered"] += 1
+            delivery_stats["max-depth"] = max(delivery_stats["max-depth"], len(pending_writes))
+            # A buffer that outgrows its share of MEMORY_BUDGET applies its oldest writes without waiting any longer
+            if log_over_budget("pending") and bootstrapped.is_set():
+                oldest = sorted((sum(entry[0].values()),) + waiting for waiting, entry in pending_writes.items())
+                durable = 0
+                while oldest and log_over_budget("pending"):
+                    durable = max(durable, force_delivery([oldest.pop(0)], time.time()))
+                deliver_unblocked()
+                return ("delivered" if has_applied(origin, position) else "buffered"), durable, encode_vector_clock()
+            return "buffered", 0, encode_vector_clock()
+        durable = deliver(origin, clock, operations)
+        durable = max(durable, deliver_pending())
+        return "delivered", durable, encode_vector_clock()
+
+# Create a function to answer a replicated PUT, DELETE or batch once its write step has been taken in.
+# – Response code is 200 (Ok) when the step was applied or had been already, 202 (Accepted) when it is buffered.
+# – Response body is JSON {"result": "delivered"|"duplicate"|"buffered", "causal-metadata": <V>}.
+def handle_replicated(data, operations):
+    result, durable, clock = receive_replicated(data.get("sender"), decode_vector_clock(data.get("causal-metadata")), operations)
+    wait_durable(durable)
+    return jsonify({"result": result, "causal-metadata": clock}), 202 if result == "buffered" else 200
+
+# Create a function that runs on its own thread and applies buffered writes whose dependencies have not arrived within
+# DELIVERY_TIMEOUT seconds, oldest clock first, e.g. because the replica holding them dropped its hints. The store then
+# keeps making progress as it did before replicated writes were ordered. The clock is not moved past the missing writes,
+# so they are still applied if they arrive later (see deliver). Key versions the clock has caught up with are dropped.
+def delivery_sweeper():
+    while True:
+        time.sleep(min(DELIVERY_TIMEOUT, 1))
+        with state_lock:
+            now = time.time()
+            expired = sorted((sum(clock.values()), origin, position) for (origin, position), (clock, _, arrived, _) in pending_writes.items()
+                             if now - arrived >= DELIVERY_TIMEOUT)
+            force_delivery(expired, now)
+            if expired:
+                deliver_unblocked()
+            for key, version in list(key_versions.items()):
+                if compare_vector_clock(version) != 503:
+                    del key_versions[key]
+
+# Create a function to apply the buffered writes <expired>, given as (clock sum, origin, position), without waiting for their
+# dependencies any longer. The caller holds state_lock. Returns the write-ahead log sequence number to wait for.
+def force_delivery(expired, now):
+    durable = 0
+    for _, origin, position in expired:
+        clock, operations, arrived = take_pending(origin, position)
+        if has_applied(origin, position):
+            delivery_stats["duplicates"] += 1
+            continue
+        delivery_stats["forced"] += 1
+        record_delay(now - arrived)
+        durable = max(durable, deliver(origin, clock, operations))
+    return durable
+
+# Create a function to decide whether to take <replica>'s contents, given its clock <v>. It must have applied every write
+# applied here; when both clocks are equal the stores can still differ by the order of concurrent writes, and the replica
+# with the larger socket address wins so that all replicas settle on the same values. The caller holds state_lock.
+def should_adopt(replica, v):
+    if any(count > v.get(origin, 0) for origin, count in vector_clock.items()):
+        return False
+    return v != encode_vector_clock() or replica > SOCKET_ADDRESS
+
+# Create a function to run one anti-entropy round against <replica>: walk both hash trees down from the root, one level per
+# request, following only the nodes that differ, then fetch and take the keys of the differing leaves. The work done is
+# proportional to the drift, not to the size of the store. Returns the number of leaves repaired.
+def reconcile_with(replica):
+    anti_entropy_stats["rounds"] += 1
+    with state_lock.reading():
+        start = encode_vector_clock()
+    nodes, clock = [1], None
+    while True:
+        r = peer_request("GET", replica, "/anti-entropy/tree", json={"socket-address": SOCKET_ADDRESS, "nodes": nodes}, timeout=1)
+        if r.status_code != 200:
+            anti_entropy_stats["skipped"] += 1
+            return 0
+        body = r.json()
+        if clock is None:
+            clock = decode_vector_clock(body["causal-metadata"])
+            with state_lock.reading():
+                if not should_adopt(replica, clock):
+                    anti_entropy_stats["skipped"] += 1
+                    return 0
+        with state_lock.reading():
+            nodes = [node for node, theirs in zip(nodes, body["hashes"]) if merkle_tree[node] != theirs]
+        if not nodes:
+            anti_entropy_stats["in-sync"] += 1
+            return 0
+        if nodes[0] >= MERKLE_LEAVES:
+            break
+        nodes = [child for node in nodes for child in (2 * node, 2 * node + 1)]
+    r = peer_request("GET", replica, "/anti-entropy/leaves", json={"leaves": [node - MERKLE_LEAVES for node in nodes]}, timeout=5)
+    body = r.json()
+    with state_lock:
+        # Either store moved while the trees were compared, so the differing leaves may be stale; try again next round
+        if encode_vector_clock() != start or decode_vector_clock(body["causal-metadata"]) != clock:
+            anti_entropy_stats["skipped"] += 1
+            return 0
+        repaired = 0
+        for leaf, items in zip(body["leaves"], body["keys"]):
+            for key in [key for key in merkle_keys[leaf] if key not in items]:
+                store_delete(key)
+                repaired += 1
+            for key, value in items.items():
+                if kv_store.peek(key, absent) != value:
+                    store_put(key, value)
+                    repaired += 1
+        update_vector_clock(clock)
+        # The repaired keys are not in the operation log, so replicas behind this clock need a full transfer from us
+        for origin, count in clock.items():
+            oplog_floor[origin] = max(oplog_floor.get(origin, 0), count)
+        deliver_pending()
+    anti_entropy_stats["repaired-leaves"] += len(nodes)
+    anti_entropy_stats["repaired-keys"] += repaired
+    # The repaired keys are not in the write-ahead log either, so persist them with a snapshot
+    if DATA_DIR:
+        with wal_cond:
+            if not snapshot_running.is_set():
+                snapshot_running.set()
+                threading.Thread(target=take_snapshot, daemon=True).start()
+    return len(nodes)
+
+# Create a function that runs on its own thread and reconciles with a random replica of the view now and then,
+# repairing writes that were missed for good. Rounds come more often while they keep finding differences.
+def anti_entropy():
+    interval = ANTI_ENTROPY_INTERVAL
+    while True:
+        time.sleep(interval)
+        replicas = [replica for replica in shard_members(SHARD_ID) if replica != SOCKET_ADDRESS]
+        if not replicas:
+            continue
+        try:
+            repaired = reconcile_with(random.choice(replicas))
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            continue
+        interval = max(interval / 2, ANTI_ENTROPY_MIN) if repaired else min(interval * 2, ANTI_ENTROPY_INTERVAL)
+        anti_entropy_stats["interval"] = interval
+
+# Create a function to report the state of the delivery buffer
+def delivery_report():
+    with state_lock.reading():
+        now = time.time()
+        report = dict(delivery_stats, depth=len(pending_writes),
+                      oldest=max((now - arrived for _, _, arrived, _ in pending_writes.values()), default=0.0),
+                      waiting={replica: len(waiting) for replica, waiting in pending_index.items()})
+    report["delay-mean"] = report["delay-total"] / report["delayed"] if report["delayed"] else 0.0
+    return report
+
+# Create a function to delete the keys of this replica's store that come after <low> and before <high> in key order
+# (None for no bound), which a full recovery stream went past without listing. The caller holds state_lock.
+def drop_unlisted(low, high):
+    for key in list(key_index.irange(low, high, inclusive=False)):
+        store_delete(key)
+
+# Create a function to pull the state this replica is missing from <view> through its recovery stream.
+# Lines are applied as they arrive so the whole store is never held as one document, and a broken
+# stream is resumed after the last key that was received.
+# The whole store is only taken from a replica that has applied every write we have, and keys it does not list were deleted there.
+def recover_from(view):
+    after, clock, full = None, None, False
+    for attempt in range(RECOVERY_RETRIES):
+        try:
+            r = peer_request("GET", view, "/recovery", stream=True, timeout=5,
+                             json={"socket-address": SOCKET_ADDRESS, "causal-metadata": encode_vector_clock(), "after": after})
+            # A replica that is itself still starting up has nothing to offer
+            if r.status_code != 200:
+                return False
+            for line in r.iter_lines():
+                item = json.loads(line)
+                # Requests are already being served while this runs, so every line is applied under the lock
+                with state_lock:
+                    if "key" in item:
+                        if full:
+                            drop_unlisted(after, item["key"])
+                        store_put(item["key"], item["value"])
+                        after = item["key"]
+                    elif "operations" in item:
+                        apply_batch(item["operations"])
+                    elif "causal-metadata" in item:
+                        # A resumed stream starts with the clock <view> has now, which does not hold for the keys
+                        # already received, so the clock of the first attempt is kept
+                        if after is None:
+                            clock = decode_vector_clock(item["causal-metadata"])
+                            full = item.get("keys") is True
+                            # Values carry no versions, so they can only replace ours when <view> has applied every write
+                            # we have. From a replica that is concurrent with us, only its missing write steps are taken;
+                            # the rest comes through replication and anti-entropy (see should_adopt).
+                            if full and any(count > clock.get(replica, 0) for replica, count in vector_clock.items()):
+                                r.close()
+                                return False
+                    elif item.get("done"):
+                        if full:
+                            drop_unlisted(after, None)
+                        update_vector_clock(clock)
+                        return True
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+            continue
+    return False
+
+# Create a function to announce this replica to <view> with PUT /view. Returns whether <view> could be reached, and its clock
+# when it holds our keys: an empty clock when it belongs to another shard, and None when it did not tell (e.g. while it
+# replays our hints and has not added us to its view yet).
+def announce(view):
+    try:
+        r = peer_request("PUT", view, "/view", json=view_announcement(), timeout=BOOTSTRAP_TIMEOUT)
+    except requests.exceptions.RequestException:
+        return False, None
+    sa_store[view] = True
+    learn_shard(view, r.json())
+    # Only the replicas of our own shard hold our keys
+    if replica_shard(view) != SHARD_ID:
+        return True, {}
+    try:
+        r = peer_request("GET", view, "/anti-entropy/tree", json={"socket-address": SOCKET_ADDRESS, "nodes": []}, timeout=BOOTSTRAP_TIMEOUT)
+        return True, decode_vector_clock(r.json()["causal-metadata"]) if r.status_code == 200 else None
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        return True, None
+
+# Create a function to keep announcing this replica to the replicas of VIEW that could not be reached at startup,
+# since replicas started together come up at about the same time. Gives up after BOOTSTRAP_RETRY seconds.
+# Whatever they hold that we do not is brought over by anti-entropy.
+def announce_later(views):
+    backoff, deadline = 0.1, time.time() + BOOTSTRAP_RETRY
+    while views and time.time() < deadline:
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 1)
+        views = [view for view in views if view not in sa_store and not announce(view)[0]]
+
+# Create a function that runs on its own thread while the replica already answers requests, and catches up with the others.
+# Every replica of VIEW is announced to at once. The state is then pulled from the most advanced replica, and from any other
+# that has writes it did not; clients get 503 until this is done (see require_ready).
+def bootstrap():
+    # Restore what this replica had on disk, so only the writes made since it stopped are fetched from the other replicas
+    if DATA_DIR:
+        bootstrap_state["phase"] = "loading"
+        load_persisted_state()
+    bootstrap_state["phase"] = "announcing"
+    sa_store[SOCKET_ADDRESS] = True
+    others = [view for view in views if view != SOCKET_ADDRESS]
+    answers = dict(zip(others, broadcast_pool.map(announce, others)))
+    clocks = {view: clock for view, (reached, clock) in answers.items() if reached}
+    bootstrap_state["reachable"] = len(clocks)
+    threading.Thread(target=announce_later, args=([view for view in others if view not in clocks],), daemon=True).start()
+    bootstrap_state["phase"] = "recovering"
+    for view in sorted(clocks, key=lambda view: -1 if clocks[view] is None else sum(clocks[view].values()), reverse=True):
+        with state_lock.reading():
+            behind = clocks[view] is None or compare_vector_clock(clocks[view]) == 503
+        if behind and recover_from(view):
+            bootstrap_state["recovered-from"].append(view)
+    with state_lock:
+        # Write steps from before we joined were never recorded here, so the log only reaches back to our current clock.
+        # Merging the clocks of the other replicas also restores our own entry, so our new writes continue after our old ones.
+        oplog_floor.update(vector_clock)
+        # Then the writes replicated to us while we were catching up
+        durable = deliver_pending()
+    wait_durable(durable)
+    # What was fetched from the other replicas is not in the write-ahead log, so persist it with a snapshot
+    if DATA_DIR:
+        snapshot_running.set()
+        take_snapshot()
+    threading.Thread(target=failure_detector, daemon=True).start()
+    threading.Thread(target=delivery_sweeper, daemon=True).start()
+    threading.Thread(target=anti_entropy, daemon=True).start()
+    if SHARD_ID is not None:
+        threading.Thread(target=rebalancer, daemon=True).start()
+    bootstrap_state["phase"] = "ready"
+    bootstrap_state["duration"] = time.time() - bootstrap_state["started"]
+    bootstrapped.set()
+
+views = VIEW.split(",")
+threading.Thread(target=bootstrap, daemon=True).start()
     
 # View operations - “view” refers to the current set of replicas among which the store is replicated.
 @app.route('/view', methods=['GET', 'PUT', 'DELETE'])
@@ -65,19 +1896,40 @@ def handle_view():
         # Return the current view of the store.
         # – Response code is 200 (Ok).
         # – Response body is JSON {"view": ["<IP:PORT>", "<IP:PORT>", ...]}.
+        # In sharded mode the body also has {"shard-id": <shard>, "shards": {"<IP:PORT>": <shard>, ...}, "moving": <bool>},
+        # where "moving" tells whether this replica is moving keys that another shard now owns.
+        if SHARD_ID is not None:
+            return jsonify({"view": list(sa_store.keys()), "shard-id": SHARD_ID,
+                            "shards": {replica: replica_shard(replica) for replica in sa_store.copy()}, "moving": moving_keys}), 200
         return jsonify({"view": list(sa_store.keys())}), 200
         
     if request.method == 'PUT':
         # Add a new replica <socket-address> to the view.
         # – Response code is 200 (Ok).
         # – Response body is JSON {"result": "added"}.
+        # In sharded mode the request also carries "shard-id", and the response does too.
         data = request.get_json()
         replica = data['socket-address']
-        if replica in sa_store:
-            return jsonify({"result": "already present"}), 200
-        else:
+        learn_shard(replica, data)
+        # The replica just reached us, so heartbeats it missed while it was starting no longer count against it
+        with peer_lock:
+            if replica in peer_health:
+                peer_health[replica]["failures"] = 0
+            # It may have been upgraded while it was away, so the binary encoding is tried again
+            peer_protocols.pop(replica, None)
+        with handoff_lock:
+            if replica in sa_store:
+                return jsonify(dict(shard_info(), result="already present")), 200
+            # A replica that was removed gets the writes it missed replayed first; it is added to the view afterwards
+            if hinted_handoff.get(replica) and replica not in handoff_overflowed:
+                if replica not in handoff_replaying:
+                    handoff_replaying.add(replica)
+                    threading.Thread(target=replay_hints, args=(replica,), daemon=True).start()
+                return jsonify(dict(shard_info(), result="added")), 201
+            hinted_handoff.pop(replica, None)
+            handoff_overflowed.discard(replica)
             sa_store[replica] = True
-            return jsonify({"result": "added"}), 201
+            return jsonify(dict(shard_info(), result="added")), 201
             
     if request.method == 'DELETE':
         # Delete an existing replica <socket-address> from the view.
@@ -85,22 +1937,286 @@ def handle_view():
         # – Response body is JSON {"result": "deleted"}.
         data = request.get_json()
         replica = data['socket-address']
-        if replica in sa_store:
-            del sa_store[replica]
-            if "broadcasted" in data:
-                return jsonify({"result": "deleted"}), 200
-            #broadcasts DELETE-view requests to other replicas
-            for view in sa_store:
-                if view != SOCKET_ADDRESS:
-                    url = f"http://{view}/view"
-                    try:
-                        requests.delete(url, json={"socket-address": replica, "broadcasted": "true"}, timeout=0.2)
-                    except requests.exceptions.ConnectionError:
-                        pass
+        # Start collecting the writes this replica misses so they can be replayed when it rejoins,
+        # and broadcast the DELETE-view request to other replicas unless this one was broadcast to us
+        if remove_replica(replica, broadcasted="broadcasted" in data):
             return jsonify({"result": "deleted"}), 200
         else:
             return jsonify({"result": "View has no such replica"}), 404
 
+# Tell whether this replica has caught up with the others and serves clients.
+# – Response code is 200 (Ok) once it has, and 503 (Service Unavailable) while it is still starting.
+# – Response body is JSON {"ready": <bool>, "phase": "loading"|"announcing"|"recovering"|"ready", "reachable": <n>,
+#   "recovered-from": ["<IP:PORT>", ...], "started": <epoch seconds>, "duration": <seconds or null>}.
+@app.route('/health/ready', methods=['GET'])
+def handle_ready():
+    return jsonify(dict(bootstrap_state, ready=bootstrapped.is_set())), 200 if bootstrapped.is_set() else 503
+
+# Report the connection pool and health state kept for each replica.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"peers": {"<IP:PORT>": {"healthy": <bool>, "requests": <n>, "connections": <n>, "reused": <n>, ...}}}.
+@app.route('/view/peers', methods=['GET'])
+def handle_peers():
+    return jsonify({"peers": peer_stats()}), 200
+
+# Report the buffer of replicated writes waiting for their causal dependencies.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"delivery": {"depth": <n>, "max-depth": <n>, "delivered": <n>, "buffered": <n>, "duplicates": <n>,
+#   "forced": <n>, "delayed": <n>, "delay-mean": <seconds>, "delay-max": <seconds>, "oldest": <seconds>, "waiting": {"<IP:PORT>": <n>, ...}}}.
+@app.route('/delivery', methods=['GET'])
+def handle_delivery():
+    return jsonify({"delivery": delivery_report()}), 200
+
+# List the traces that started on this replica, most recent first.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"traces": [{"trace-id": <id>, "name": <root span>, "start": <epoch seconds>, "duration": <seconds>}, ...]}.
+@app.route('/traces', methods=['GET'])
+def list_traces():
+    with trace_lock:
+        roots = [record for record in trace_spans if record["parent-id"] is None]
+    return jsonify({"traces": [{"trace-id": record["trace-id"], "name": record["name"], "start": record["start"],
+                                "duration": record["duration"]} for record in reversed(roots)]}), 200
+
+# Return the spans of one trace, from this replica and every other replica in the view, ordered by start time.
+# The parent ids link the spans of all replicas into one tree, from which the critical path of a write can be read.
+# With ?local=true only this replica's spans are returned.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"spans": [{"trace-id", "span-id", "parent-id", "name", "replica", "start", "duration", "attributes"}, ...],
+#   "unreachable": ["<IP:PORT>", ...]}.
+@app.route('/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    with trace_lock:
+        spans = [record for record in trace_spans if record["trace-id"] == trace_id]
+    unreachable = []
+    if request.args.get("local") != "true":
+        replicas = [replica for replica in sa_store.copy() if replica != SOCKET_ADDRESS]
+        futures = {broadcast_pool.submit(peer_request, "GET", replica, f"/traces/{trace_id}?local=true", timeout=2): replica
+                   for replica in replicas}
+        for future, replica in futures.items():
+            try:
+                spans += future.result().json()["spans"]
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                unreachable.append(replica)
+    return jsonify({"spans": sorted(spans, key=lambda record: record["start"]), "unreachable": unreachable}), 200
+
+# Watch the PUT and DELETE events of a key, or of every key that starts with a prefix, as Server-Sent Events.
+# Events are pushed as writes are applied here, whether they were made here or replicated from another replica.
+# Query parameters: "key" or "prefix" (every key when neither is given), and "since", causal-metadata as JSON to resume from.
+# A reconnecting EventSource sends the id of the last event it got in the Last-Event-ID header, which is used instead.
+# – Response code is 200 (Ok) with a text/event-stream. The first event is "ready" and each write is a "put" or "delete":
+#     id: <V>
+#     event: put
+#     data: {"key": <key>, "value": <value>, "causal-metadata": <V>}
+#   where <V> is the causal-metadata after the write and the token to resume from. Writes applied here after "since" are
+#   sent first. When the operation log no longer reaches back to "since", or the watcher falls WATCH_BUFFER events behind,
+#   a "reset" event ends the stream: read the current values again and watch from the causal-metadata of that read.
+# With "poll=<seconds>" the request is a long poll instead, which waits up to that long for events.
+# – Response body is JSON {"events": [{"op": "PUT", "key": <key>, "value": <value>, "causal-metadata": <V>}, ...],
+#   "reset": <bool>, "causal-metadata": <V>}, where <V> is the token for the next poll.
+# – Response code is 400 (Bad Request) {"error": "Watch parameters are not valid"} for a malformed "since" or "poll".
+# – Response code is 503 (Service Unavailable) {"error": "Too many watchers"} when MAX_WATCHERS watches are open.
+# In sharded mode a key is watched on its own shard, which the request is redirected to; a prefix only covers this shard's keys.
+@app.route('/watch', methods=['GET'])
+def handle_watch():
+    key, prefix = request.args.get("key"), request.args.get("prefix", "")
+    try:
+        since = request.headers.get("Last-Event-ID") or request.args.get("since")
+        since = decode_vector_clock(json.loads(since)) if since else None
+        poll = float(request.args["poll"]) if "poll" in request.args else None
+    except ValueError:
+        return jsonify({"error": "Watch parameters are not valid"}), 400
+    if key is not None and SHARD_ID is not None:
+        shard = key_shard(key)
+        if shard != SHARD_ID and shard_members(shard):
+            return Response(status=307, headers={"Location": f"http://{random.choice(shard_members(shard))}{request.full_path}"})
+
+    watcher = Watcher(key, prefix)
+    # Registering under the lock that writes publish under means no write is both replayed and pushed, or neither
+    with state_lock.reading():
+        with watch_lock:
+            if len(watchers) >= MAX_WATCHERS:
+                return jsonify({"error": "Too many watchers"}), 503
+            watchers.add(watcher)
+        missing = operations_since(since) if since is not None else []
+        clock = encode_vector_clock()
+    replay, reset = [], missing is None
+    if missing:
+        token = dict(since)
+        for origin, position, operations in missing:
+            token[origin] = max(token.get(origin, 0), position)
+            replay += [dict(operation, **{"causal-metadata": dict(token)}) for operation in operations if watcher.matches(operation["key"])]
+
+    if poll is not None:
+        try:
+            events, overflowed = ([], False) if replay or reset else watcher.take(min(poll, WATCH_KEEPALIVE))
+        finally:
+            with watch_lock:
+                watchers.discard(watcher)
+        events = replay + events
+        return jsonify({"events": events, "reset": reset or overflowed,
+                        "causal-metadata": events[-1]["causal-metadata"] if events else clock}), 200
+
+    def generate():
+        try:
+            # A client that goes away during the replay resumes from where the replay started
+            yield watch_event("ready", {"causal-metadata": since if replay else clock})
+            for event in replay:
+                yield watch_event(event["op"].lower(), event)
+            if reset:
+                yield watch_event("reset", {"causal-metadata": clock})
+                return
+            while True:
+                events, overflowed = watcher.take(WATCH_KEEPALIVE)
+                for event in events:
+                    yield watch_event(event["op"].lower(), event)
+                if overflowed:
+                    yield watch_event("reset", {"causal-metadata": events[-1]["causal-metadata"] if events else clock})
+                    return
+                if not events:
+                    # Writing to a closed connection is how a watcher that went away is noticed
+                    yield ": keep-alive\n\n"
+        finally:
+            with watch_lock:
+                watchers.discard(watcher)
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Create a function to format one Server-Sent Event; its id is the causal-metadata to resume from
+def watch_event(name, event):
+    data = {name: value for name, value in event.items() if name != "op"}
+    return f"id: {json.dumps(event['causal-metadata'], separators=(',', ':'))}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+# Time every request for the per-route latency histograms, and start or continue its trace
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    start_trace()
+
+@app.after_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.get("start", time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    with metrics_lock:
+        histogram = request_latency.get((route, request.method)) or request_latency.setdefault((route, request.method), Histogram())
+        key = (route, request.method, response.status_code)
+        request_counts[key] = request_counts.get(key, 0) + 1
+    histogram.observe(elapsed)
+    context = getattr(trace_local, "context", None)
+    if context is not None:
+        parent, start = g.trace
+        record_span(context[0], context[1], parent, f"{request.method} {route}", start, elapsed, {"status": response.status_code})
+        response.headers["traceparent"] = f"00-{context[0]}-{context[1]}-01"
+        trace_local.context = None
+    return response
+
+# Create a function to continue the trace of an incoming request from its W3C traceparent header
+# ("00-<trace id>-<parent span id>-<flags>"), or start a new one for client requests to /kvs and changes to the view.
+# Heartbeats and other background calls between replicas are only traced when the sender was tracing.
+def start_trace():
+    trace_local.context = None
+    if not TRACING:
+        return
+    parts = request.headers.get("traceparent", "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        trace_id, parent = parts[1], parts[2]
+    elif request.endpoint in ("handle_key", "handle_batch") or (request.endpoint == "handle_view" and request.method != "GET"):
+        trace_id, parent = os.urandom(16).hex(), None
+    else:
+        return
+    trace_local.context = [trace_id, os.urandom(8).hex()]
+    g.trace = (parent, time.time())
+
+# Until bootstrap has caught up, clients and replicas recovering from us would only see part of the store, so they are
+# told to retry. Writes replicated from other replicas are still taken in; they are held back until bootstrap is done.
+# – Response code is 503 (Service Unavailable) {"error": "Replica is not ready; try again later"}, with a Retry-After header.
+@app.before_request
+def require_ready():
+    if bootstrapped.is_set() or request.endpoint not in ("handle_key", "handle_batch", "get_key_list", "stream_recovery", "handle_watch"):
+        return None
+    if "broadcasted" in (request.get_json(silent=True) or {}):
+        return None
+    return jsonify({"error": "Replica is not ready; try again later"}), 503, {"Retry-After": "1"}
+
+# Create a function to render every metric in the Prometheus text format
+def render_metrics():
+    lines = ["# HELP kvs_request_duration_seconds Time spent handling a request.", "# TYPE kvs_request_duration_seconds histogram"]
+    with metrics_lock:
+        latencies, counts = sorted(request_latency.items()), sorted(request_counts.items())
+        peers, failures, rejections = sorted(peer_latency.items()), sorted(peer_failures.items()), causal_rejections
+    for (route, method), histogram in latencies:
+        lines += histogram.lines("kvs_request_duration_seconds", {"route": route, "method": method})
+    lines += ["# HELP kvs_requests_total Responses sent, by route, method and status.", "# TYPE kvs_requests_total counter"]
+    lines += [f"kvs_requests_total{format_labels({'route': route, 'method': method, 'status': status})} {count}"
+              for (route, method, status), count in counts]
+    lines += ["# HELP kvs_causal_rejections_total Requests answered 503 because their causal dependencies were not satisfied.",
+              "# TYPE kvs_causal_rejections_total counter", f"kvs_causal_rejections_total {rejections}"]
+    lines += ["# HELP kvs_broadcast_rtt_seconds Round trip of broadcast messages, by replica.", "# TYPE kvs_broadcast_rtt_seconds histogram"]
+    for replica, histogram in peers:
+        lines += histogram.lines("kvs_broadcast_rtt_seconds", {"peer": replica})
+    lines += ["# HELP kvs_broadcast_failures_total Broadcast messages that could not reach a replica.", "# TYPE kvs_broadcast_failures_total counter"]
+    lines += [f"kvs_broadcast_failures_total{format_labels({'peer': replica})} {count}" for replica, count in failures]
+    with state_lock.reading():
+        keys, clock, depth, store, versions = len(kv_store), encode_vector_clock(), len(pending_writes), kv_store.stats(), len(key_versions)
+        logs = dict(log_bytes)
+    lines += ["# HELP kvs_keys Keys in the store.", "# TYPE kvs_keys gauge", f"kvs_keys {keys}",
+              "# HELP kvs_key_versions Keys written here while writes they depend on are still missing.",
+              "# TYPE kvs_key_versions gauge", f"kvs_key_versions {versions}",
+              "# HELP kvs_watchers Open watch streams and long polls.", "# TYPE kvs_watchers gauge", f"kvs_watchers {len(watchers)}",
+              "# HELP kvs_view_replicas Replicas in the view.", "# TYPE kvs_view_replicas gauge", f"kvs_view_replicas {len(sa_store)}",
+              "# HELP kvs_delivery_buffer_depth Replicated writes waiting for their causal dependencies.",
+              "# TYPE kvs_delivery_buffer_depth gauge", f"kvs_delivery_buffer_depth {depth}",
+              "# HELP kvs_vector_clock Entries of this replica's vector clock.", "# TYPE kvs_vector_clock gauge"]
+    lines += [f"kvs_vector_clock{format_labels({'replica': replica})} {count}" for replica, count in sorted(clock.items())]
+    lines += ["# HELP kvs_store_bytes Bytes of keys and values held in memory, and of values spilled to disk.", "# TYPE kvs_store_bytes gauge",
+              f'kvs_store_bytes{{tier="memory"}} {store["memory-bytes"]}', f'kvs_store_bytes{{tier="disk"}} {store["disk-bytes"]}',
+              "# HELP kvs_log_bytes Bytes of keys and values held by the write logs, counted when MEMORY_BUDGET is set.", "# TYPE kvs_log_bytes gauge"]
+    lines += [f"kvs_log_bytes{format_labels({'log': log})} {size}" for log, size in sorted(logs.items())]
+    lines += ["# HELP kvs_store_keys Keys whose values are held in memory or spilled to disk.", "# TYPE kvs_store_keys gauge",
+              f'kvs_store_keys{{tier="memory"}} {store["memory-keys"]}', f'kvs_store_keys{{tier="disk"}} {store["disk-keys"]}',
+              "# HELP kvs_store_spills_total Values moved from memory to disk.", "# TYPE kvs_store_spills_total counter",
+              f"kvs_store_spills_total {store['spills']}",
+              "# HELP kvs_store_loads_total Values read back from disk.", "# TYPE kvs_store_loads_total counter",
+              f"kvs_store_loads_total {store['loads']}",
+              "# HELP kvs_value_bytes Size of the keys and values written, in bytes.", "# TYPE kvs_value_bytes histogram"]
+    lines += kv_store.value_sizes.lines("kvs_value_bytes", {})
+    return "\n".join(lines) + "\n"
+
+# Return nodes of the anti-entropy hash tree.
+# Request body is JSON {"socket-address": <IP:PORT>, "nodes": [<n>, ...]}; node 1 is the root and the children of node n are 2n and 2n+1.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"hashes": [<hash>, ...], "causal-metadata": <V>, "stats": {...}}.
+# A replica that is not in our view gets the writes it missed from hinted handoff when it rejoins, not from here.
+# – Response code is 409 (Conflict).
+# – Response body is JSON {"error": "Replica is not in the view"}.
+@app.route('/anti-entropy/tree', methods=['GET'])
+def handle_tree():
+    data = request.get_json(silent=True) or {}
+    if "socket-address" in data and data["socket-address"] not in sa_store:
+        return jsonify({"error": "Replica is not in the view"}), 409
+    nodes = [node for node in data.get("nodes", [1]) if isinstance(node, int) and 1 <= node < 2 * MERKLE_LEAVES]
+    with state_lock.reading():
+        return jsonify({"hashes": [merkle_tree[node] for node in nodes], "causal-metadata": encode_vector_clock(),
+                        "stats": anti_entropy_stats}), 200
+
+# Return the keys and values covered by leaves of the anti-entropy hash tree.
+# Request body is JSON {"leaves": [<i>, ...]}.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"leaves": [<i>, ...], "keys": [{"key1": "value1", ...}, ...], "causal-metadata": <V>}.
+@app.route('/anti-entropy/leaves', methods=['GET'])
+def handle_leaves():
+    data = request.get_json(silent=True) or {}
+    leaves = [leaf for leaf in data.get("leaves", []) if isinstance(leaf, int) and 0 <= leaf < MERKLE_LEAVES]
+    with state_lock.reading():
+        return jsonify({"leaves": leaves, "keys": [{key: kv_store.peek(key) for key in merkle_keys[leaf]} for leaf in leaves],
+                        "causal-metadata": encode_vector_clock()}), 200
+
+# Report request latencies, broadcast round trips and failures per replica, causal rejections and the store size for Prometheus.
+# – Response code is 200 (Ok).
+# – Response body is the Prometheus text exposition format.
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
 # check the request type and process with HTTP status code and JSON body
 @app.route('/kvs/<key>', methods=['PUT', 'GET', 'DELETE'])
 def handle_key(key):
@@ -113,54 +2229,64 @@ def handle_key(key):
     if not is_key_valid(key):
         return jsonify({"error": "Key is too long"}), 400
 
+    # In sharded mode a key is served by the replicas of the shard that owns it on the hash ring
+    if SHARD_ID is not None and "X-Forwarded-Shard" not in request.headers:
+        shard = key_shard(key)
+        if shard != SHARD_ID:
+            return forward_to_shard(shard, request.method, f"/kvs/{key}", request.get_json(silent=True))
+
+    # How many replicas must confirm a write, and how many a read consults, can be set per request
+    # with the X-Write-Quorum and X-Read-Quorum headers ("all" or a number).
+    # – Response code is 400 (Bad Request) {"error": "Quorum is not valid"} otherwise.
+    try:
+        write_quorum = quorum_setting("X-Write-Quorum", WRITE_QUORUM)
+        read_quorum = quorum_setting("X-Read-Quorum", READ_QUORUM)
+    except ValueError:
+        return jsonify({"error": "Quorum is not valid"}), 400
+
     # PUT HTTP method
     # This endpoint is used to create or update key-value mappings in the store.
     # It is dictionary operations which add a new key.
     if request.method == 'PUT':          
         try:
-            data = request.get_json()
-            value = data["value"]
+            with span("parse"):
+                data = request.get_json()
+                value = data["value"]
 
         except (TypeError, KeyError):
             return jsonify({"error": "PUT request does not specify a value"}), 400
 
-        causal_metadata = data.get('causal-metadata')
+        # A replicated write carries the clock of the replica it came from, which already counts this write
         if "broadcasted" in data:
-            inc_vector_clock()
-        else:
+            return handle_replicated(data, [{"op": "PUT", "key": key, "value": value}])
+
+        client_metadata = data.get('causal-metadata')
+        causal_metadata = shard_entries(decode_vector_clock(client_metadata))
+        digests = decode_key_digests(client_metadata)
+        # Only the missing writes that could affect <key> hold the PUT back
+        if causal_metadata:
+            wait_for_dependencies(causal_metadata, [key], digests)
+        # The causal check, the clock increment and the store update happen as one step
+        with span("store", key=key), state_lock:
             if causal_metadata:
-                if compare_vector_clock(causal_metadata) == 503:
-                    return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-                update_vector_clock(causal_metadata)
+                if compare_key_dependencies(causal_metadata, [key], digests) == 503:
+                    return causal_rejection()
             inc_vector_clock()
-        
-        if causal_metadata:
-            if compare_vector_clock(causal_metadata) == 503:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-            update_vector_clock(causal_metadata)
-        result = "created" if key not in kv_store else "replaced"
-        kv_store[key] = value
+            # The write carries the client's dependencies even when some are not applied here yet,
+            # so that the other replicas apply it after them
+            clock = merge_clocks(causal_metadata, encode_vector_clock())
+            result = "created" if key not in kv_store else "replaced"
+            store_put(key, value, clock)
+            durable = log_operations([{"op": "PUT", "key": key, "value": value}], SOCKET_ADDRESS, vector_clock[SOCKET_ADDRESS])
+            metadata = response_clock(client_metadata, clock)
 
-        if "broadcasted" in data:
-            return jsonify({"result": result, "causal-metadata": vector_clock}), 200 if result == "replaced" else 201
-        
-        # This variable makes it so we can modify the size of the dictionary while iterating over it
-        temp_sa_store = sa_store.copy()
+        # Send the write to every replica at once and wait for the write quorum; the local fsync overlaps with the broadcast
+        stored = replicate([{"op": "PUT", "key": key, "value": value}], clock, write_quorum)
 
-        for replica in temp_sa_store:
-            if replica != SOCKET_ADDRESS:
-                try:
-                    url = f"http://{replica}/kvs/{key}"
-                    r = requests.put(url, json={"value": value, "causal-metadata": vector_clock, "broadcasted": "true"}, timeout=0.5)
-                    # update vector clock after request is returned
-                    if r and (r.status_code == 200 or r.status_code == 201):
-                        update_vector_clock(r.json()["causal-metadata"])
-                
-                except requests.exceptions.ConnectionError:
-                    url = f"http://{SOCKET_ADDRESS}/view"
-                    requests.delete(url, json={"socket-address": replica, "on-operation": "PUT", "key": key, "value": value})
-            
-        return jsonify({"result": result, "causal-metadata": vector_clock}), 200 if result == "replaced" else 201
+        wait_durable(durable)
+        if not stored:
+            return quorum_failure(metadata)
+        return jsonify({"result": result, "causal-metadata": metadata}), 200 if result == "replaced" else 201
         # If the request body is not a JSON object with key "value", then return an error.
         # – Response code is 400 (Bad Request).
         # – Response body is JSON {"error": "PUT request does not specify a value"}
@@ -181,23 +2307,15 @@ def handle_key(key):
         # – The <V> is null when the client does not know of prior writes.
         # – 503 (Service Unavailable) {"error": "Causal dependencies not satisfied; try again later"}
         data = request.get_json()
-        causal_metadata = data.get('causal-metadata')
-
-        if causal_metadata:
-            if compare_vector_clock(causal_metadata) == 503:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-
-        # If the key <key> exists in the store, then return the mapped value in the response.
-        # – Response code is 200 (Ok).
-        # – Response body is JSON {"result": "found", "value": "<value>", "causal-metadata": <V'>}
-        #    ∗ The <V'> indicates a causal dependency on the PUT of <key>,<value>.
-        if key in kv_store:
-            return jsonify({"result": "found", "value": kv_store[key], "causal-metadata": vector_clock}), 200
-        # Otherwise, If the key does not exist in the store, then return an error.
-        # – Response code is 404 (Not Found).
-        # – Response body is JSON {"error": "Key does not exist"}.
+        client_metadata = data.get('causal-metadata')
+        if read_quorum == 1:
+            response = read_key(key, client_metadata)
         else:
-            return jsonify({"error": "Key does not exist"}), 404
+            response = quorum_read(key, client_metadata, read_quorum)
+        # A key that another shard has not moved here yet is read from that shard
+        if response[1] == 404 and SHARD_ID is not None and "X-Moving-Read" not in request.headers:
+            return read_moving(key, client_metadata) or response
+        return response
 
     # DELETE HTTP method
     # This endpoint is used to remove key-value mappings from the store. 
@@ -209,40 +2327,38 @@ def handle_key(key):
         # happen. Think about why.
         # – 503 (Service Unavailable) {"error": "Causal dependencies not satisfied; try again later"}
         data = request.get_json()
-        causal_metadata = data.get('causal-metadata')
+        # A replicated delete carries the clock of the replica it came from, which already counts this delete
         if "broadcasted" in data:
-            inc_vector_clock()
-        else:
-            if causal_metadata:
-                if compare_vector_clock(causal_metadata) == 503:
-                    return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-                update_vector_clock(causal_metadata)
-            inc_vector_clock()
+            return handle_replicated(data, [{"op": "DELETE", "key": key}])
+
+        client_metadata = data.get('causal-metadata')
+        causal_metadata = shard_entries(decode_vector_clock(client_metadata))
+        digests = decode_key_digests(client_metadata)
         if causal_metadata:
-            if compare_vector_clock(causal_metadata) == 503:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-            update_vector_clock(causal_metadata)
+            wait_for_dependencies(causal_metadata, [key], digests)
+        # The causal check, the clock increment and the store update happen as one step
+        with span("store", key=key), state_lock:
+            if causal_metadata:
+                if compare_key_dependencies(causal_metadata, [key], digests) == 503:
+                    return causal_rejection()
+            found = key in kv_store
+            if found:
+                inc_vector_clock()
+                clock = merge_clocks(causal_metadata, encode_vector_clock())
+                store_delete(key, clock)
+                durable = log_operations([{"op": "DELETE", "key": key}], SOCKET_ADDRESS, vector_clock[SOCKET_ADDRESS])
+                metadata = response_clock(client_metadata, clock)
         # If the key <key> exists in the store, then remove it.
         # – Response code is 200 (Ok).
         # – Response body is JSON {"result": "deleted", "causal-metadata": <V'>}.
         # ∗ The <V'> indicates a causal dependency on <V> and this DELETE
-        if key in kv_store:
-            del kv_store[key]
-            if "broadcasted" in data:
-                return jsonify({"result": "deleted", "causal-metadata": vector_clock, "broadcasted": "true"}), 200
-            
-            # This variable makes it so we can modify the size of the dictionary while iterating over it
-            temp_sa_store = sa_store.copy()
-            
-            for replica in temp_sa_store:
-                try: 
-                    url = f"http://{replica}/kvs/{key}"
-                    requests.delete(url, json={"value": None, "causal-metadata": vector_clock, "broadcasted": "true"}, timeout=0.5)
-                except requests.exceptions.ConnectionError:
-                    url = f"http://{SOCKET_ADDRESS}/view"
-                    requests.delete(url, json={"socket-address": replica})
-                    pass
-                return jsonify({"result": "deleted", "causal-metadata": vector_clock, "broadcasted": "true"}), 200
+        if found:
+            # Send the delete to every replica at once
+            stored = replicate([{"op": "DELETE", "key": key}], clock, write_quorum)
+            wait_durable(durable)
+            if not stored:
+                return quorum_failure(metadata)
+            return jsonify({"result": "deleted", "causal-metadata": metadata, "broadcasted": "true"}), 200
         # If the key <key> does not exist in the store, then return an error.
         # – Response code is 404 (Not Found).
         # – Response body is JSON {"error": "Key does not exist"}.
@@ -250,22 +2366,365 @@ def handle_key(key):
             return jsonify({"error": "Key does not exist"}), 404
         
         
+# Create a function to read <key> from this replica's store
+def read_key(key, client_metadata):
+    causal_metadata = shard_entries(decode_vector_clock(client_metadata))
+    digests = decode_key_digests(client_metadata)
+    if causal_metadata:
+        wait_for_dependencies(causal_metadata, [key], digests)
+    # Reads only need the reader side, so they run in parallel with each other
+    with span("read", key=key), state_lock.reading():
+        if causal_metadata:
+            if compare_key_dependencies(causal_metadata, [key], digests) == 503:
+                return causal_rejection()
+        value = kv_store.get(key, absent)
+        clock = response_clock(client_metadata, encode_vector_clock())
+
+    # If the key <key> exists in the store, then return the mapped value in the response.
+    # – Response code is 200 (Ok).
+    # – Response body is JSON {"result": "found", "value": "<value>", "causal-metadata": <V'>}
+    #    ∗ The <V'> indicates a causal dependency on the PUT of <key>,<value>.
+    if value is not absent:
+        return jsonify({"result": "found", "value": value, "causal-metadata": clock}), 200
+    # Otherwise, If the key does not exist in the store, then return an error.
+    # – Response code is 404 (Not Found).
+    # – Response body is JSON {"error": "Key does not exist"}.
+    #   A read that sets X-Read-Quorum also gets the "causal-metadata", so a quorum read can order it against the other answers.
+    if "X-Read-Quorum" in request.headers:
+        return jsonify({"error": "Key does not exist", "causal-metadata": clock}), 404
+    return jsonify({"error": "Key does not exist"}), 404
+
+# Create a function to read <key> from the shards that are still moving keys to other shards, for a key that this shard now
+# owns but has not been sent yet. Right after the ring changes, before the other shards can have said so, every shard is asked.
+# Returns the first answer that found the key, or None.
+def read_moving(key, client_metadata):
+    if time.time() - ring_changed < 2 * HEARTBEAT_INTERVAL:
+        shards = set(shard_ring()[0]) - {SHARD_ID}
+    else:
+        shards = {replica_shard(replica) for replica, moving in list(replica_moving.items()) if moving and replica in sa_store} - {SHARD_ID}
+    for shard in shards:
+        r = send_to_shard(shard, "GET", f"/kvs/{key}", {"causal-metadata": client_metadata}, {"X-Moving-Read": "true", "X-Read-Quorum": "1"})
+        if r is not None and r.status_code == 200:
+            return Response(r.content, status=200, mimetype="application/json")
+    return None
+
+# Create a function to read <key> from <quorum> replicas of our shard (all of them when None), counting this one, and answer
+# with the most recent answer by vector clock: one whose clock covers another's has the larger sum of entries.
+# Replicas that cannot be reached, or have not caught up with the client, are left out; the read only fails when none can answer.
+def quorum_read(key, client_metadata, quorum):
+    peers = [replica for replica in shard_members(SHARD_ID) if replica != SOCKET_ADDRESS]
+    random.shuffle(peers)
+    if quorum is not None:
+        peers = peers[:max(quorum - 1, 0)]
+    headers = dict(shard_info() and {"X-Forwarded-Shard": SHARD_ID}, **{"X-Read-Quorum": "1"})
+    context = current_trace()
+    futures = [broadcast_pool.submit(traced, context, peer_request, "GET", replica, f"/kvs/{key}", json={"causal-metadata": client_metadata},
+                                     headers=headers, timeout=CAUSAL_WAIT + 0.5) for replica in peers]
+    response, status = read_key(key, client_metadata)
+    answers = [(status, response.get_json())]
+    for future in futures:
+        try:
+            r = future.result()
+            answers.append((r.status_code, r.json()))
+        except (requests.exceptions.RequestException, ValueError):
+            continue
+    answers = [(status, body) for status, body in answers if status in (200, 404)]
+    if not answers:
+        return response, status
+    status, body = max(answers, key=lambda answer: sum(decode_vector_clock(answer[1].get("causal-metadata")).values()))
+    if status == 404:
+        return jsonify({"error": "Key does not exist"}), 404
+    return jsonify(body), 200
+
+# Apply several PUT/GET/DELETE operations as a single causal step.
+# Request body is JSON {"operations": [{"op": "PUT", "key": <key>, "value": <value>}, {"op": "GET", "key": <key>}, ...],
+#                       "causal-metadata": <V>}.
+# – A PUT with "if-absent": true only creates its key, and gets {"key": <key>, "result": "kept"} when the key exists.
+# – The vector clock is advanced once for the whole batch and the writes are replicated in one message per replica.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"results": [{"key": <key>, "result": "created"|"replaced"|"kept"|"found"|"deleted", ...}, ...],
+#   "causal-metadata": <V'>}. Operations on missing keys get {"key": <key>, "error": "Key does not exist"}.
+@app.route('/kvs/_batch', methods=['POST'])
+def handle_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("operations"), list):
+        return jsonify({"error": "Batch request does not specify operations"}), 400
+    operations = data["operations"]
+
+    # Reject the whole batch if any operation is malformed so that nothing is applied partially
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get("op") not in ("PUT", "GET", "DELETE") or not isinstance(operation.get("key"), str):
+            return jsonify({"error": "Batch operation is not valid"}), 400
+        if not is_key_valid(operation["key"]):
+            return jsonify({"error": "Key is too long"}), 400
+        if operation["op"] == "PUT" and "value" not in operation:
+            return jsonify({"error": "PUT request does not specify a value"}), 400
+
+    if "broadcasted" in data:
+        return handle_replicated(data, operations)
+
+    try:
+        write_quorum = quorum_setting("X-Write-Quorum", WRITE_QUORUM)
+    except ValueError:
+        return jsonify({"error": "Quorum is not valid"}), 400
+    client_metadata = data.get('causal-metadata')
+    # In sharded mode the operations on each shard's keys run on that shard
+    if SHARD_ID is not None and "X-Forwarded-Shard" not in request.headers:
+        ring = shard_ring()
+        groups = {}
+        for index, operation in enumerate(operations):
+            groups.setdefault(key_shard(operation["key"], ring), []).append(index)
+        if set(groups) != {SHARD_ID}:
+            return split_batch(operations, groups, client_metadata, write_quorum)
+    return run_batch(operations, client_metadata, write_quorum)
+
+# Create a function to apply a batch to this replica's store as one causal step and replicate its writes to <quorum> replicas
+def run_batch(operations, client_metadata, quorum=None):
+    causal_metadata = shard_entries(decode_vector_clock(client_metadata))
+    digests = decode_key_digests(client_metadata)
+    writes = [operation for operation in operations if operation["op"] != "GET"]
+    keys = [operation["key"] for operation in operations]
+    if causal_metadata:
+        wait_for_dependencies(causal_metadata, keys, digests)
+    with span("store", operations=len(operations)), state_lock:
+        if causal_metadata:
+            if compare_key_dependencies(causal_metadata, keys, digests) == 503:
+                return causal_rejection()
+        if writes:
+            inc_vector_clock()
+        clock = merge_clocks(causal_metadata, encode_vector_clock())
+        results = apply_batch(operations, clock)
+        durable = log_operations(writes, SOCKET_ADDRESS, vector_clock.get(SOCKET_ADDRESS, 0)) if writes else 0
+        metadata = response_clock(client_metadata, clock)
+
+    stored = True
+    if writes:
+        # Replicate only the writes, as one message to every replica
+        stored = replicate(writes, clock, quorum)
+    wait_durable(durable)
+    if not stored:
+        return quorum_failure(metadata)
+    return jsonify({"results": results, "causal-metadata": metadata}), 200
+
+# Create a function to run a batch whose keys belong to several shards. Each shard's operations run as one step on that
+# shard, one shard after another, each depending on the steps before it; the batch is therefore not atomic across shards.
+def split_batch(operations, groups, metadata, quorum):
+    results = [None] * len(operations)
+    for shard, indexes in groups.items():
+        part = [operations[index] for index in indexes]
+        if shard == SHARD_ID:
+            response, status = run_batch(part, metadata, quorum)
+            body = response.get_json()
+        else:
+            r = send_to_shard(shard, "POST", "/kvs/_batch", {"operations": part, "causal-metadata": metadata}, quorum_headers())
+            if r is None:
+                return jsonify({"error": "No replica of the shard is reachable"}), 503
+            body, status = r.json(), r.status_code
+        if status != 200:
+            return jsonify(body), status
+        metadata = body["causal-metadata"]
+        for index, result in zip(indexes, body["results"]):
+            results[index] = result
+    return jsonify({"results": results, "causal-metadata": metadata}), 200
+
+# Take in a replicated write step in the binary encoding (see encode_replication). Same as a replicated POST /kvs/_batch.
+# – Response code is 200 (Ok) or 202 (Accepted), with the body of handle_replicated.
+# – Response code is 415 (Unsupported Media Type) for any other content type, and 400 (Bad Request) for a malformed message.
+@app.route('/replicate', methods=['POST'])
+def handle_replicate():
+    if request.mimetype != WIRE_TYPE:
+        return jsonify({"error": "Replication message must be " + WIRE_TYPE}), 415
+    try:
+        data = decode_replication(request.get_data())
+    except ValueError:
+        return jsonify({"error": "Replication message is not valid"}), 400
+    return handle_replicated(data, data["operations"])
+
+# Create a function to send the text chunks <chunks> as a streamed response, compressed with gzip when the request accepts it
+def stream_response(chunks, mimetype):
+    if "gzip" not in request.headers.get("Accept-Encoding", ""):
+        return Response(chunks, mimetype=mimetype)
+
+    def generate_compressed():
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+        pending = 0
+        for text in chunks:
+            chunk = compressor.compress(text.encode())
+            pending += len(text)
+            # Flush now and then so the receiver can use what it got while the rest is still being compressed
+            if pending >= 64 * COMPRESS_MIN:
+                chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+                pending = 0
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+    response = Response(generate_compressed(), mimetype=mimetype)
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
 @app.route('/kvs', methods=['GET'])
 def get_key_list():
     # This method returns a list of all keys and values in the store.
     # – Response code is 200 (Ok).
-    # – Response body is JSON {"key1": "value1", "key2": "value2", ...}.
-    data = request.get_json()
+    # – Response body is JSON {"recovery_data": {"key1": "value1", "key2": "value2", ...}, "causal-metadata": <V>}.
+    # If the request carries the replica's "causal-metadata" and the operation log still reaches back to it,
+    # only the missing write steps are returned instead, when that is smaller than the whole store.
+    # – Response body is JSON {"recovery_ops": [[<origin>, <position>, [{"op": "PUT", "key": <key>, "value": <value>}, ...]], ...],
+    #   "causal-metadata": <V>}.
+    # Responses are gzip-compressed when the request accepts it.
+    # A request without "socket-address" is a client scan instead (see scan_keys).
+    data = request.get_json(silent=True) or {}
+    if "socket-address" not in data:
+        return scan_keys(data)
     replica = data['socket-address']
 
-    # Synchronize the vector clock
-    if replica == "10.10.0.2:8090":
-        vector_clock[0] = max(vector_clock[1], vector_clock[2])
-    elif replica == "10.10.0.3:8090":
-        vector_clock[1] = max(vector_clock[0], vector_clock[2])
-    elif replica == "10.10.0.4:8090":
-        vector_clock[2] = max(vector_clock[0], vector_clock[1])
-    return jsonify({"recovery_data": kv_store, "causal-metadata": vector_clock}), 200
-    
+    with state_lock.reading():
+        missing = count_steps_since(data.get("causal-metadata"))
+        clock = encode_vector_clock()
+        use_log = missing is not None and missing <= len(kv_store)
+        steps = steps_since(data.get("causal-metadata"), oplog_dropped, oplog_dropped + len(op_log)) if use_log else None
+
+    # The steps or the store are sent a page at a time (see steps_since and store_pages) instead of being copied into one body
+    def generate():
+        separator = ""
+        if use_log:
+            yield '{"recovery_ops":['
+            for step in steps:
+                if step is None:
+                    # The log was truncated while it was being sent; the body is left incomplete so the receiver asks again
+                    return
+                yield separator + json.dumps(step, separators=(",", ":"))
+                separator = ","
+            yield '],"causal-metadata":' + json.dumps(clock) + "}"
+            return
+        yield '{"recovery_data":{'
+        for page in store_pages():
+            yield separator + ",".join(json.dumps(key) + ":" + json.dumps(value, separators=(",", ":")) for key, value in page)
+            separator = ","
+        yield '},"causal-metadata":' + json.dumps(clock) + "}"
+    return stream_response(generate(), "application/json")
+
+# Scan the store in key order, a page at a time, from the sorted key index.
+# Query parameters: "prefix" (keys that start with it), "start" (the first key), "limit" (keys per page, at most SCAN_MAX)
+# and "cursor" (the "cursor" of the previous page). Request body, if any, is JSON {"causal-metadata": <V>}.
+# – Response code is 200 (Ok).
+# – Response body is JSON {"keys": [{"key": <key>, "value": <value>}, ...], "cursor": <cursor>, "causal-metadata": <V'>}.
+#    ∗ "cursor" is null on the last page.
+# – Response code is 400 (Bad Request) {"error": "Scan parameters are not valid"} when the limit is not a positive number.
+# – 503 (Service Unavailable) {"error": "Causal dependencies not satisfied; try again later"}
+# In sharded mode every shard is scanned and the pages are merged.
+# – Response code is 503 (Service Unavailable) {"error": "No replica of the shard is reachable"} when a shard does not answer.
+def scan_keys(data):
+    prefix, start, cursor = request.args.get("prefix", ""), request.args.get("start", ""), request.args.get("cursor")
+    try:
+        limit = min(int(request.args.get("limit", SCAN_LIMIT)), SCAN_MAX)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return jsonify({"error": "Scan parameters are not valid"}), 400
+    client_metadata = data.get("causal-metadata")
+    causal_metadata = shard_entries(decode_vector_clock(client_metadata))
+
+    futures = {}
+    if SHARD_ID is not None and "X-Forwarded-Shard" not in request.headers:
+        context = current_trace()
+        futures = {shard: broadcast_pool.submit(traced, context, send_to_shard, shard, "GET", "/kvs?" + request.query_string.decode(),
+                                                {"causal-metadata": client_metadata})
+                   for shard in sorted(shard_ring()[0] - {SHARD_ID})}
+    if causal_metadata:
+        wait_for_dependencies(causal_metadata)
+    with span("scan", prefix=prefix), state_lock.reading():
+        if causal_metadata:
+            if compare_vector_clock(causal_metadata) == 503:
+                return causal_rejection()
+        items, more = scan_store(prefix, start, cursor, limit)
+        clock = response_clock(client_metadata, encode_vector_clock())
+    if not futures:
+        return jsonify({"keys": items, "cursor": items[-1]["key"] if more else None, "causal-metadata": clock}), 200
+
+    for shard, future in futures.items():
+        r = future.result()
+        if r is None:
+            return jsonify({"error": "No replica of the shard is reachable"}), 503
+        if r.status_code != 200:
+            return Response(r.content, status=r.status_code, mimetype="application/json")
+        body = r.json()
+        items += body["keys"]
+        more = more or body["cursor"] is not None
+        clock = merge_metadata(clock, body["causal-metadata"])
+    items.sort(key=lambda item: item["key"])
+    more = more or len(items) > limit
+    items = items[:limit]
+    return jsonify({"keys": items, "cursor": items[-1]["key"] if more and items else None, "causal-metadata": clock}), 200
+
+# Create a function to collect up to <limit> keys and values of this replica's store, in key order, that start with <prefix>,
+# are not before <start> and come after <cursor>. Returns them and whether more keys match. The caller holds state_lock.
+def scan_store(prefix, start, cursor, limit):
+    # Keys still waiting to be moved to the shard that now owns them are listed by that shard
+    ring = shard_ring() if SHARD_ID is not None else None
+    low = max(prefix, start)
+    keys = key_index.irange(cursor, inclusive=False) if cursor is not None and cursor >= low else key_index.irange(low)
+    items = []
+    for key in keys:
+        if not key.startswith(prefix):
+            break
+        if ring is not None and key_shard(key, ring) != SHARD_ID:
+            continue
+        if len(items) == limit:
+            return items, True
+        items.append({"key": key, "value": kv_store[key]})
+    return items, False
+
+# Stream the state a recovering replica is missing as newline-delimited JSON, one line at a time.
+# Request body is JSON {"socket-address": <IP:PORT>, "causal-metadata": <V>, "after": <key> or null}.
+# – Response code is 200 (Ok).
+# – The first line is {"causal-metadata": <V>, "keys": <bool>}, the last line is {"done": true}.
+# – In between come either the missing write steps {"origin": <IP:PORT>, "position": <n>, "operations": [...]} when the operation
+#   log reaches back to <V>, or, with "keys": true, the store itself as {"key": <key>, "value": <value>} lines in key order.
+#   A receiver whose stream broke resumes the store lines by sending the last key it got as "after".
+# – The stream is gzip-compressed when the request accepts it.
+@app.route('/recovery', methods=['GET'])
+def stream_recovery():
+    data = request.get_json()
+    after = data.get("after")
+    with state_lock.reading():
+        missing = count_steps_since(data.get("causal-metadata")) if after is None else None
+        clock = encode_vector_clock()
+        use_log = missing is not None and missing <= len(kv_store)
+        # The steps or keys are walked a page at a time while they are sent, so the stream holds at most a page of either
+        steps = steps_since(data.get("causal-metadata"), oplog_dropped, oplog_dropped + len(op_log)) if use_log else None
+
+    def generate():
+        yield json.dumps({"causal-metadata": clock, "keys": not use_log}) + "\n"
+        if use_log:
+            for step in steps:
+                if step is None:
+                    # The log was truncated while it was being sent; without "done" the receiver asks again
+                    return
+                origin, position, operations = step
+                yield json.dumps({"origin": origin, "position": position, "operations": operations}) + "\n"
+        else:
+            for page in store_pages(after):
+                for key, value in page:
+                    yield json.dumps({"key": key, "value": value}) + "\n"
+        yield json.dumps({"done": True}) + "\n"
+
+    return stream_response(generate(), "application/x-ndjson")
+
+# Create a function to start serving on the port of SOCKET_ADDRESS.
+# The threaded mode uses waitress when it is installed and werkzeug's threaded server otherwise.
+def main():
+    port = int(SOCKET_ADDRESS.rsplit(":", 1)[1])
+    if SERVER == "dev":
+        app.run(host=HOST, port=port)
+        return
+    try:
+        from waitress import serve
+    except ImportError:
+        from werkzeug.serving import make_server
+        make_server(HOST, port, app, threaded=True).serve_forever()
+    else:
+        serve(app, host=HOST, port=port, threads=THREADS)
+
 if __name__=='__main__':
-    app.run(host='0.0.0.0', port=8090)
\ No newline at end of file
+    main()
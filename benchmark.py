@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import requests
+from collections import defaultdict
+
+#To Run: python3 benchmark.py --replicas 3 --concurrency 16 --duration 10 --mix PUT=50,GET=40,DELETE=10 --output bench.json
+# Starts the replicas as local processes on loopback ports, drives the workload against them and writes
+# throughput, latency percentiles and the 503 rate for each route as JSON.
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assignment3.py")
+
+# Create a function to parse a size distribution: "16" is always 16, "8-32" is uniform between 8 and 32
+def parse_size(spec):
+    low, _, high = spec.partition("-")
+    low = int(low)
+    high = int(high) if high else low
+    return lambda: random.randint(low, high)
+
+# Create a function to parse an operation mix such as "PUT=50,GET=40,DELETE=10" into methods and weights
+def parse_mix(spec):
+    methods, weights = [], []
+    for part in spec.split(","):
+        method, _, weight = part.partition("=")
+        methods.append(method.strip().upper())
+        weights.append(float(weight))
+    return methods, weights
+
+# Create a function to start <n> replicas together on consecutive loopback ports and wait until every one has caught up.
+# A DATA_DIR in <env> is the parent directory: each replica keeps its write-ahead log in its own subdirectory of it.
+def start_replicas(n, base_port, log_dir, env):
+    addresses = [f"127.0.0.1:{base_port + i}" for i in range(n)]
+    processes = []
+    for address in addresses:
+        port = address.rsplit(":", 1)[1]
+        log = open(os.path.join(log_dir, f"replica-{port}.log"), "w") if log_dir else subprocess.DEVNULL
+        replica_env = dict(os.environ, SOCKET_ADDRESS=address, VIEW=",".join(addresses), HOST="127.0.0.1", **env)
+        if env.get("DATA_DIR"):
+            replica_env["DATA_DIR"] = os.path.join(env["DATA_DIR"], f"replica-{port}")
+            os.makedirs(replica_env["DATA_DIR"], exist_ok=True)
+        processes.append(subprocess.Popen([sys.executable, SERVER], env=replica_env, stdout=log, stderr=log))
+    for address in addresses:
+        wait_until_serving(address)
+    return addresses, processes
+
+# Create a function to wait until GET /health/ready answers 200, which a replica does once it has caught up with the others
+def wait_until_serving(address, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"http://{address}/health/ready", timeout=0.5).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"replica {address} did not start")
+
+def stop_replicas(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+# Create a function to compute a latency percentile (in milliseconds) from sorted latencies in seconds
+def percentile(latencies, q):
+    if not latencies:
+        return None
+    return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 3)
+
+# One client: picks a random replica for every request and carries its causal-metadata forward like a real client
+def client(addresses, args, methods, weights, key_size, value_size, deadline, results, lock):
+    session = requests.Session()
+    metadata = None
+    samples = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    while time.time() < deadline:
+        method = random.choices(methods, weights)[0]
+        key = ("k%d" % random.randrange(args.keys)).ljust(min(key_size(), 49), "x")
+        body = {"causal-metadata": metadata}
+        if method == "PUT":
+            body["value"] = "v" * value_size()
+        address = random.choice(addresses)
+        route = f"{method} /kvs/<key>"
+        start = time.perf_counter()
+        try:
+            r = session.request(method, f"http://{address}/kvs/{key}", json=body, timeout=args.timeout)
+        except requests.exceptions.RequestException:
+            statuses[route]["error"] += 1
+            continue
+        samples[route].append(time.perf_counter() - start)
+        statuses[route][str(r.status_code)] += 1
+        if r.status_code in (200, 201):
+            metadata = r.json().get("causal-metadata", metadata)
+    with lock:
+        for route, latencies in samples.items():
+            results["latencies"][route].extend(latencies)
+        for route, counts in statuses.items():
+            for status, count in counts.items():
+                results["statuses"][route][status] += count
+
+# Create a function to drive the workload from <concurrency> client threads and summarise it per route
+def run_workload(addresses, args):
+    methods, weights = parse_mix(args.mix)
+    key_size, value_size = parse_size(args.key_size), parse_size(args.value_size)
+    results = {"latencies": defaultdict(list), "statuses": defaultdict(lambda: defaultdict(int))}
+    lock = threading.Lock()
+    start = time.time()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=client, args=(addresses, args, methods, weights, key_size, value_size, deadline, results, lock))
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    routes = {}
+    for route in sorted(results["statuses"]):
+        latencies = sorted(results["latencies"][route])
+        statuses = dict(results["statuses"][route])
+        total = sum(statuses.values())
+        routes[route] = {
+            "requests": total,
+            "throughput": round(len(latencies) / elapsed, 2),
+            "p50_ms": percentile(latencies, 0.50),
+            "p99_ms": percentile(latencies, 0.99),
+            "p999_ms": percentile(latencies, 0.999),
+            "rate_503": round(statuses.get("503", 0) / total, 4) if total else 0.0,
+            "statuses": statuses,
+        }
+    completed = sum(len(latencies) for latencies in results["latencies"].values())
+    unavailable = sum(route["statuses"].get("503", 0) for route in routes.values())
+    requested = sum(route["requests"] for route in routes.values())
+    return {
+        "config": {"replicas": len(addresses), "concurrency": args.concurrency, "duration": args.duration, "mix": args.mix,
+                   "keys": args.keys, "key_size": args.key_size, "value_size": args.value_size},
+        "elapsed": round(elapsed, 3),
+        "throughput": round(completed / elapsed, 2),
+        "rate_503": round(unavailable / requested, 4) if requested else 0.0,
+        "routes": routes,
+    }
+
+if __name__ =='__main__':
+    parser = argparse.ArgumentParser(description="Throughput and latency benchmark for a local group of replicas")
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--base-port", type=int, default=9100)
+    parser.add_argument("--concurrency", type=int, default=8, help="number of client threads")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the workload")
+    parser.add_argument("--mix", default="PUT=50,GET=40,DELETE=10", help="operation weights")
+    parser.add_argument("--keys", type=int, default=1000, help="number of distinct keys")
+    parser.add_argument("--key-size", default="8", help='key length, "N" or "MIN-MAX" (at most 49)')
+    parser.add_argument("--value-size", default="64", help='value length, "N" or "MIN-MAX"')
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--env", action="append", default=[], help="NAME=VALUE passed to every replica (DATA_DIR gets one subdirectory per replica)")
+    parser.add_argument("--log-dir", help="directory for replica logs")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+    addresses, processes = start_replicas(args.replicas, args.base_port, args.log_dir, env)
+    try:
+        report = run_workload(addresses, args)
+    finally:
+        stop_replicas(processes)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,220 @@
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+#To Use:
+#   from kvs_client import KVSClient
+#   client = KVSClient(["localhost:8082", "localhost:8083", "localhost:8084"])
+#   client.put("tea", "matcha")
+#   client.get("tea")
+# The client keeps the causal-metadata of everything it has read or written and sends it with every request, so its reads
+# always see its own writes and whatever they depended on, whichever replica answers.
+
+# 503 answers that mean the replica cannot serve the request yet, so another replica (or the same one, later) may.
+# Any other 503, such as "Write quorum not reached" for a write that was applied and is still being replicated, is final.
+RETRY_ERRORS = {"Causal dependencies not satisfied; try again later", "Replica is not ready; try again later"}
+
+# Raised for an answer the client cannot retry, or once every retry of a 503 or connection error has failed
+class KVSError(Exception):
+    def __init__(self, status, body):
+        super().__init__(f"{status}: {body}")
+        self.status = status
+        self.body = body
+
+class KVSClient:
+    def __init__(self, replicas, timeout=5, retries=5, backoff=0.05, pool_size=10, workers=8):
+        self.replicas = list(replicas)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.metadata = {} # merged causal-metadata of every answer so far
+        self.digests = {} # key digest that came with each entry of metadata, which lets replicas skip unrelated writes
+        self.lock = threading.Lock() # guards metadata and the routing state below
+        self.in_flight = {replica: 0 for replica in self.replicas} # requests waiting for an answer from each replica
+        self.latency = {replica: 0.0 for replica in self.replicas} # moving average of each replica's response time
+        self.avoid_until = {replica: 0.0 for replica in self.replicas} # time before which a failing replica is not picked
+        self.failures = {replica: 0 for replica in self.replicas} # failures in a row, for the backoff of each replica
+        self.known = {replica: {} for replica in self.replicas} # the latest clock each replica answered with
+        self.session = requests.Session()
+        # One keep-alive pool per replica, shared by every thread that uses this client
+        self.session.mount("http://", HTTPAdapter(pool_connections=len(self.replicas), pool_maxsize=pool_size))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Create a function to merge the causal-metadata from an answer of <replica> into the client's, keeping the key digest
+    # that came with each entry
+    def merge(self, replica, clock):
+        if not isinstance(clock, dict):
+            return
+        digests = clock.get("key-digests") or {}
+        with self.lock:
+            self.known[replica] = clock
+            for origin, count in clock.items():
+                if not isinstance(count, int):
+                    continue
+                if count > self.metadata.get(origin, 0):
+                    self.metadata[origin] = count
+                    self.digests.pop(origin, None)
+                if count == self.metadata[origin] and origin in digests and origin not in self.digests:
+                    self.digests[origin] = digests[origin]
+
+    # Create a function to pick the replica for the next request. Among the replicas that have not failed recently, those
+    # known to have seen the client's causal-metadata come first, since the others may have to wait for it or answer 503;
+    # then the one with the fewest requests in flight, then the fastest. When every replica has failed, the one that recovers first.
+    def pick(self, exclude=()):
+        now = time.time()
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica not in exclude] or self.replicas
+            healthy = [replica for replica in candidates if self.avoid_until[replica] <= now]
+            if not healthy:
+                return min(candidates, key=lambda replica: self.avoid_until[replica])
+            current = [replica for replica in healthy
+                       if all(self.known[replica].get(origin, 0) >= count for origin, count in self.metadata.items())]
+            return min(current or healthy, key=lambda replica: (self.in_flight[replica], self.latency[replica], random.random()))
+
+    # Create a function to record the outcome of a request for routing. A replica that failed is avoided with exponential backoff.
+    def record(self, replica, elapsed, failed):
+        with self.lock:
+            self.in_flight[replica] -= 1
+            if failed:
+                self.failures[replica] += 1
+                self.avoid_until[replica] = time.time() + min(self.backoff * 2 ** self.failures[replica], 5)
+            else:
+                self.failures[replica] = 0
+                self.avoid_until[replica] = 0.0
+                self.latency[replica] = elapsed if not self.latency[replica] else 0.8 * self.latency[replica] + 0.2 * elapsed
+
+    # Create a function to send one request with the client's causal-metadata and merge the metadata of the answer.
+    # A 503 because the replica is behind the client or still starting (see RETRY_ERRORS), or a connection error, is retried
+    # on another replica after a backoff. Returns the status code and the JSON body of the answer.
+    def request(self, method, path, body=None, params=None, headers=None):
+        tried = set()
+        for attempt in range(self.retries + 1):
+            replica = self.pick(exclude=tried)
+            tried.add(replica)
+            if len(tried) == len(self.replicas):
+                tried.clear()
+            with self.lock:
+                self.in_flight[replica] += 1
+                metadata = dict(self.metadata, **{"key-digests": dict(self.digests)}) if self.digests else dict(self.metadata)
+                payload = dict(body or {}, **{"causal-metadata": metadata or None})
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, f"http://{replica}{path}", json=payload, params=params, headers=headers,
+                                         timeout=self.timeout)
+                answer = r.json()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError):
+                self.record(replica, time.perf_counter() - start, True)
+                status, answer = None, None
+            else:
+                status = r.status_code
+                retry = status == 503 and ("Retry-After" in r.headers or answer.get("error") in RETRY_ERRORS)
+                self.record(replica, time.perf_counter() - start, retry)
+                if not retry:
+                    self.merge(replica, answer.get("causal-metadata"))
+                    return status, answer
+            if attempt < self.retries:
+                time.sleep(min(self.backoff * 2 ** attempt, 1) * random.uniform(0.5, 1))
+        raise KVSError(status or 503, answer or {"error": "No replica could be reached"})
+
+    # Create a function to set <key> to <value>. Returns "created" or "replaced".
+    def put(self, key, value):
+        status, answer = self.request("PUT", f"/kvs/{key}", {"value": value})
+        if status not in (200, 201):
+            raise KVSError(status, answer)
+        return answer["result"]
+
+    # Create a function to read <key>. Raises KeyError when it does not exist.
+    def get(self, key):
+        status, answer = self.request("GET", f"/kvs/{key}")
+        if status == 404:
+            raise KeyError(key)
+        if status != 200:
+            raise KVSError(status, answer)
+        return answer["value"]
+
+    # Create a function to remove <key>. Returns False when it did not exist.
+    def delete(self, key):
+        status, answer = self.request("DELETE", f"/kvs/{key}")
+        if status == 404:
+            return False
+        if status != 200:
+            raise KVSError(status, answer)
+        return True
+
+    # Create a function to run a list of operations {"op": "PUT"|"GET"|"DELETE", "key": <key>[, "value": <value>]}
+    # in one round trip, as one causal step. Returns one result per operation.
+    def batch(self, operations):
+        status, answer = self.request("POST", "/kvs/_batch", {"operations": operations})
+        if status != 200:
+            raise KVSError(status, answer)
+        return answer["results"]
+
+    # Create a function to list the keys and values that start with <prefix>, from <start> on, in key order, a page at a time
+    def scan(self, prefix="", start="", page=100):
+        cursor = None
+        while True:
+            params = {"prefix": prefix, "start": start, "limit": page}
+            if cursor is not None:
+                params["cursor"] = cursor
+            status, answer = self.request("GET", "/kvs", params=params)
+            if status != 200:
+                raise KVSError(status, answer)
+            for item in answer["keys"]:
+                yield item["key"], item["value"]
+            cursor = answer["cursor"]
+            if cursor is None:
+                return
+
+    # Create a function to run put, get, delete, batch or scan on the client's worker threads. Returns a Future.
+    # Requests submitted together are concurrent: each carries the causal-metadata known when it is sent,
+    # so use a pipeline when one operation has to see another.
+    def submit(self, name, *args):
+        return self.executor.submit(getattr(self, name), *args)
+
+    def pipeline(self):
+        return Pipeline(self)
+
+# Operations queued on a pipeline are sent together as one batch when it is executed (or when its with-block ends),
+# so a sequence of dependent operations costs one round trip instead of one per operation.
+class Pipeline:
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.results = None
+
+    def put(self, key, value):
+        self.operations.append({"op": "PUT", "key": key, "value": value})
+        return self
+
+    def get(self, key):
+        self.operations.append({"op": "GET", "key": key})
+        return self
+
+    def delete(self, key):
+        self.operations.append({"op": "DELETE", "key": key})
+        return self
+
+    def execute(self):
+        operations, self.operations = self.operations, []
+        self.results = self.client.batch(operations) if operations else []
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.execute()
@@ -65,7 +65,7 @@ def buildDockerImage():
     print('buildDockerImage:', ' '.join(command))
     subprocess.check_call(command)
 
-def runReplica(instance, view_replicas):
+def runReplica(instance, view_replicas, env=None):
     assert view_replicas, 'the view can\'t be empty because it must at least contain this replica'
     command = ['docker', 'run', '--rm', '--detach',
         '--publish={}:{}'.format(instance.host_port, containerPort),
@@ -73,8 +73,9 @@ def runReplica(instance, view_replicas):
         "--ip={}".format(instance.addr),
         "--name={}".format(instance.name),
         "-e=SOCKET_ADDRESS={}:{}".format(instance.addr, containerPort),
-        "-e=VIEW={}".format(viewStr(view_replicas)),
-        imageName]
+        "-e=VIEW={}".format(viewStr(view_replicas))]
+    command += ["-e={}={}".format(name, value) for name, value in (env or {}).items()]
+    command += [imageName]
     print('runReplica:', ' '.join(command))
     subprocess.check_call(command)
 
@@ -95,6 +96,15 @@ def killInstance(instance, required=True):
     subprocess.run(command, stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL, check=required)
 
+def restartReplicas(env):
+    for instance in all_replicas:
+        killInstance(instance)
+    sleep(1)
+    for instance in all_replicas:
+        runReplica(instance, all_replicas, env)
+        sleep(1)
+    sleep(2)
+
 def connectToNetwork(instance):
     command = ['docker', 'network', 'connect', subnetName, instance.name]
     print('connectToNetwork:', ' '.join(command))
@@ -389,6 +399,284 @@ class TestHW3(unittest.TestCase):
         metadata = response.json()['causal-metadata']
 
 
+    def test_batch_operations(self):
+        '''Does a batch apply as one causal step and replicate to every replica?'''
+        metadata = None
+
+        print('>>> Put fig:jam and plum:tart into the store as one batch')
+        response = requests.post('http://{}:{}/kvs/_batch'.format(hostname, alice.host_port),
+                json={'operations': [{'op': 'PUT', 'key': 'fig', 'value': 'jam'},
+                                     {'op': 'PUT', 'key': 'plum', 'value': 'tart'},
+                                     {'op': 'GET', 'key': 'fig'},
+                                     {'op': 'DELETE', 'key': 'kiwi'}],
+                      'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('results', response.json())
+        self.assertIn('causal-metadata', response.json())
+        results = response.json()['results']
+        self.assertEqual([r.get('result') for r in results], ['created', 'created', 'found', None])
+        self.assertEqual(results[2]['value'], 'jam')
+        self.assertIn('error', results[3])
+        metadata = response.json()['causal-metadata']
+
+        print('... Wait for replication')
+        sleep(5)
+
+        print('=== Check fig,plum at replicas {}'.format(','.join(r.name for r in all_replicas)))
+        for replica in all_replicas:
+            response = requests.post('http://{}:{}/kvs/_batch'.format(hostname, replica.host_port),
+                    json={'operations': [{'op': 'GET', 'key': 'fig'}, {'op': 'GET', 'key': 'plum'}],
+                          'causal-metadata': metadata})
+            self.assertEqual(response.status_code, 200, msg='at replica, {}'.format(replica))
+            self.assertEqual([r.get('value') for r in response.json()['results']], ['jam', 'tart'],
+                    msg='at replica, {}'.format(replica))
+            metadata = response.json()['causal-metadata']
+
+        print('>>> Send a batch with a PUT that has no value (it fails)')
+        response = requests.post('http://{}:{}/kvs/_batch'.format(hostname, bob.host_port),
+                json={'operations': [{'op': 'DELETE', 'key': 'fig'}, {'op': 'PUT', 'key': 'plum'}],
+                      'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+
+        print('=== Check fig is still at replica bob')
+        response = requests.get('http://{}:{}/kvs/{}'.format(hostname, bob.host_port, 'fig'),
+                json={'causal-metadata':metadata})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['value'], 'jam')
+
+    def test_scan_pagination(self):
+        '''Does a scan list the keys in order, a page at a time, at every replica?'''
+        fruits = ['fig', 'kiwi', 'lime', 'mango', 'pear', 'plum']
+        nuts = ['nut-almond', 'nut-pecan', 'nut-walnut']
+
+        print('>>> Put {} into the store as one batch'.format(','.join(fruits + nuts)))
+        response = requests.post('http://{}:{}/kvs/_batch'.format(hostname, alice.host_port),
+                json={'operations': [{'op': 'PUT', 'key': key, 'value': key.upper()} for key in nuts + fruits],
+                      'causal-metadata': None})
+        self.assertEqual(response.status_code, 200)
+        metadata = response.json()['causal-metadata']
+
+        print('... Wait for replication')
+        sleep(2)
+
+        for replica in all_replicas:
+            print('=== Scan the store at replica {}, two keys per page'.format(replica))
+            keys, cursor = [], None
+            while True:
+                params = {'limit': 2} if cursor is None else {'limit': 2, 'cursor': cursor}
+                response = requests.get('http://{}:{}/kvs'.format(hostname, replica.host_port),
+                        params=params, json={'causal-metadata': metadata})
+                self.assertEqual(response.status_code, 200, msg='at replica, {}'.format(replica))
+                page = response.json()['keys']
+                self.assertLessEqual(len(page), 2, msg='at replica, {}'.format(replica))
+                self.assertEqual([item['value'] for item in page], [item['key'].upper() for item in page])
+                keys += [item['key'] for item in page]
+                cursor = response.json()['cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(keys, sorted(fruits + nuts), msg='at replica, {}'.format(replica))
+
+        print('=== Scan the keys that start with nut- at replica bob')
+        response = requests.get('http://{}:{}/kvs'.format(hostname, bob.host_port),
+                params={'prefix': 'nut-'}, json={'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['key'] for item in response.json()['keys']], nuts)
+        self.assertIsNone(response.json()['cursor'])
+
+        print('>>> Delete mango at replica carol')
+        response = requests.delete('http://{}:{}/kvs/{}'.format(hostname, carol.host_port, 'mango'),
+                json={'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 200)
+        metadata = response.json()['causal-metadata']
+
+        print('=== Scan from lime at replica carol, three keys per page')
+        response = requests.get('http://{}:{}/kvs'.format(hostname, carol.host_port),
+                params={'start': 'lime', 'limit': 3}, json={'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['key'] for item in response.json()['keys']], ['lime', 'nut-almond', 'nut-pecan'])
+        self.assertEqual(response.json()['cursor'], 'nut-pecan')
+
+    def test_write_quorum(self):
+        '''Does a write that cannot reach its write quorum fail instead of being acknowledged?'''
+        metadata = None
+
+        for replica in [bob, carol]:
+            print('>>> Disconnect replica {}'.format(replica))
+            disconnectFromNetwork(replica)
+
+        print('... Wait for stabilization')
+        sleep(1)
+
+        print('>>> Put oat:milk into the store at replica alice with a write quorum of 3 (it fails)')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, alice.host_port, 'oat'),
+                json={'value':'milk', 'causal-metadata': metadata}, headers={'X-Write-Quorum': '3'})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('error', response.json())
+
+        print('>>> Put oat:cake into the store at replica alice with a write quorum of 1')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, alice.host_port, 'oat'),
+                json={'value':'cake', 'causal-metadata': metadata}, headers={'X-Write-Quorum': '1'})
+        self.assertIn(response.status_code, [200, 201])
+        self.assertIn('causal-metadata', response.json())
+        metadata = response.json()['causal-metadata']
+
+        print('=== Check oat at replica alice')
+        response = requests.get('http://{}:{}/kvs/{}'.format(hostname, alice.host_port, 'oat'),
+                json={'causal-metadata':metadata})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['value'], 'cake')
+
+    def test_unrelated_key_served(self):
+        '''With the default configuration, is a key that the missing writes do not touch served right away?'''
+        print('>>> Put lemon:curd into the store at replica carol')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, carol.host_port, 'lemon'),
+                json={'value':'curd', 'causal-metadata': None})
+        self.assertEqual(response.status_code, 201)
+        metadata = response.json()['causal-metadata']
+
+        print('... Wait for replication')
+        sleep(1)
+
+        print('>>> Disconnect replica {}'.format(bob))
+        disconnectFromNetwork(bob)
+        sleep(1)
+
+        print('>>> Put lime:pie into the store at replica alice')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, alice.host_port, 'lime'),
+                json={'value':'pie', 'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 201)
+        metadata = response.json()['causal-metadata']
+
+        print('>>> Connect replica {}'.format(bob))
+        connectToNetwork(bob)
+        sleep(1)
+
+        print('=== Check lemon at replica bob, which does not have lime yet')
+        response = requests.get('http://{}:{}/kvs/{}'.format(hostname, bob.host_port, 'lemon'),
+                json={'causal-metadata':metadata})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['value'], 'curd')
+
+        print('=== Check that a key no one wrote is missing at replica bob')
+        response = requests.get('http://{}:{}/kvs/{}'.format(hostname, bob.host_port, 'quince'),
+                json={'causal-metadata':metadata})
+        self.assertEqual(response.status_code, 404)
+
+    def test_key_digests_off(self):
+        '''With KEY_WINDOW=0, does a request wait for every missing write, even one that did not touch its key?'''
+        print('>>> Restart the replicas without key digests')
+        restartReplicas({'KEY_WINDOW': '0'})
+
+        print('>>> Put lemon:curd into the store at replica carol')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, carol.host_port, 'lemon'),
+                json={'value':'curd', 'causal-metadata': None})
+        self.assertEqual(response.status_code, 201)
+        metadata = response.json()['causal-metadata']
+        self.assertNotIn('key-digests', metadata)
+
+        print('... Wait for replication')
+        sleep(1)
+
+        print('>>> Disconnect replica {}'.format(bob))
+        disconnectFromNetwork(bob)
+        sleep(1)
+
+        print('>>> Put lime:pie into the store at replica alice')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, alice.host_port, 'lime'),
+                json={'value':'pie', 'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 201)
+        metadata = response.json()['causal-metadata']
+
+        print('>>> Connect replica {}'.format(bob))
+        connectToNetwork(bob)
+        sleep(1)
+
+        print('=== Check lemon at replica bob, which does not have lime yet (it fails)')
+        response = requests.get('http://{}:{}/kvs/{}'.format(hostname, bob.host_port, 'lemon'),
+                json={'causal-metadata':metadata})
+        self.assertEqual(response.status_code, 503)
+
+    def test_related_key_waits(self):
+        '''Does a key that a missing write touched still get 503?'''
+        print('>>> Disconnect replica {}'.format(bob))
+        disconnectFromNetwork(bob)
+        sleep(1)
+
+        print('>>> Put lime:pie into the store at replica alice')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, alice.host_port, 'lime'),
+                json={'value':'pie', 'causal-metadata': None})
+        self.assertEqual(response.status_code, 201)
+        metadata = response.json()['causal-metadata']
+
+        print('>>> Connect replica {}'.format(bob))
+        connectToNetwork(bob)
+        sleep(1)
+
+        print('=== Check lime at replica bob (it fails)')
+        response = requests.get('http://{}:{}/kvs/{}'.format(hostname, bob.host_port, 'lime'),
+                json={'causal-metadata':metadata})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('error', response.json())
+
+        print('>>> Put lime:soda into the store at bob (it fails)')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, bob.host_port, 'lime'),
+                json={'value':'soda', 'causal-metadata':metadata})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('error', response.json())
+
+    def test_write_served_ahead(self):
+        '''Is a write served ahead of a missing dependency applied after it on the other replicas?'''
+        print('>>> Put lemon:curd into the store at replica carol')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, carol.host_port, 'lemon'),
+                json={'value':'curd', 'causal-metadata': None})
+        self.assertEqual(response.status_code, 201)
+        metadata = response.json()['causal-metadata']
+
+        print('... Wait for replication')
+        sleep(1)
+
+        for replica in [bob, carol]:
+            print('>>> Disconnect replica {}'.format(replica))
+            disconnectFromNetwork(replica)
+        sleep(1)
+
+        print('>>> Put lime:pie into the store at replica alice')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, alice.host_port, 'lime'),
+                json={'value':'pie', 'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 201)
+        metadata = response.json()['causal-metadata']
+
+        for replica in [bob, carol]:
+            print('>>> Connect replica {}'.format(replica))
+            connectToNetwork(replica)
+        sleep(1)
+
+        print('>>> Put lemon:tart into the store at replica bob, which does not have lime yet')
+        response = requests.put('http://{}:{}/kvs/{}'.format(hostname, bob.host_port, 'lemon'),
+                json={'value':'tart', 'causal-metadata': metadata})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['result'], 'replaced')
+        metadata = response.json()['causal-metadata']
+
+        print('=== Check lemon at replica carol, which waits for lime before it applies lemon:tart')
+        response = requests.get('http://{}:{}/kvs/{}'.format(hostname, carol.host_port, 'lemon'),
+                json={'causal-metadata': None})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['value'], 'curd')
+
+        print('... Wait for lime to reach bob and carol')
+        sleep(8)
+
+        for replica in all_replicas:
+            print('=== Check lime and lemon at replica {}'.format(replica))
+            for key, value in [('lime', 'pie'), ('lemon', 'tart')]:
+                response = requests.get('http://{}:{}/kvs/{}'.format(hostname, replica.host_port, key),
+                        json={'causal-metadata': metadata})
+                self.assertEqual(response.status_code, 200, msg='for key, {}, at replica, {}'.format(key, replica))
+                self.assertEqual(response.json()['value'], value, msg='for key, {}, at replica, {}'.format(key, replica))
+
+
 if __name__ == '__main__':
     try:
         buildDockerImage()
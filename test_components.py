@@ -0,0 +1,368 @@
+import os
+import json
+import time
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+# assignment3 reads its settings when it is imported. These tests call its parts directly, in this process, on a replica
+# that is on its own and never serves requests.
+os.environ.setdefault("SOCKET_ADDRESS", "127.0.0.1:9398")
+os.environ.setdefault("VIEW", os.environ["SOCKET_ADDRESS"])
+import assignment3
+from assignment3 import encode_replication, decode_replication, ValueStore
+
+
+class TestReplicationCodec(unittest.TestCase):
+
+    def payload(self, operations, sender="10.10.0.2:8090"):
+        return {"sender": sender, "causal-metadata": {"10.10.0.2:8090": 3, "10.10.0.3:8090": 300},
+                "operations": operations, "broadcasted": "true"}
+
+    def test_round_trip(self):
+        operations = [
+            {"op": "PUT", "key": "tea", "value": "matcha"},
+            {"op": "PUT", "key": "count", "value": 42},
+            {"op": "PUT", "key": "ratio", "value": 0.5},
+            {"op": "PUT", "key": "flags", "value": [True, False, None]},
+            {"op": "PUT", "key": "nested", "value": {"a": {"b": [1, "two"]}}},
+            {"op": "PUT", "key": "nothing", "value": None},
+            {"op": "PUT", "key": "number-text", "value": "42"},
+            {"op": "PUT", "key": "empty", "value": ""},
+            {"op": "PUT", "key": "ключ", "value": "значение ☕"},
+            {"op": "DELETE", "key": "tea"},
+        ]
+        payload = self.payload(operations)
+        self.assertEqual(decode_replication(encode_replication(payload)), payload)
+
+    def test_if_absent(self):
+        payload = self.payload([
+            {"op": "PUT", "key": "moved", "value": "text", "if-absent": True},
+            {"op": "PUT", "key": "moved-json", "value": {"n": 1}, "if-absent": True},
+            {"op": "PUT", "key": "plain", "value": "text"},
+        ])
+        decoded = decode_replication(encode_replication(payload))
+        self.assertEqual(decoded, payload)
+        self.assertNotIn("if-absent", decoded["operations"][2])
+
+    def test_no_sender(self):
+        payload = self.payload([{"op": "DELETE", "key": "tea"}], sender=None)
+        self.assertEqual(decode_replication(encode_replication(payload)), payload)
+
+    def test_compressed(self):
+        small = encode_replication(self.payload([{"op": "PUT", "key": "tea", "value": "matcha"}]))
+        self.assertEqual(small[3], 0)
+
+        payload = self.payload([{"op": "PUT", "key": "key{}".format(i), "value": "value " * 20} for i in range(100)])
+        message = encode_replication(payload)
+        self.assertEqual(message[3], 1)
+        self.assertLess(len(message), len(json.dumps(payload)) // 4)
+        self.assertEqual(decode_replication(message), payload)
+
+    def test_truncated(self):
+        for payload in [self.payload([{"op": "PUT", "key": "tea", "value": "matcha"}, {"op": "PUT", "key": "n", "value": [1, 2]},
+                                      {"op": "DELETE", "key": "tea"}]),
+                        self.payload([{"op": "PUT", "key": "key{}".format(i), "value": "value " * 20} for i in range(100)])]:
+            message = encode_replication(payload)
+            for end in range(len(message)):
+                with self.assertRaises(ValueError, msg="cut at {} of {}".format(end, len(message))):
+                    decode_replication(message[:end])
+
+    def test_corrupted(self):
+        message = encode_replication(self.payload([{"op": "PUT", "key": "tea", "value": "matcha"}]))
+        compressed = encode_replication(self.payload([{"op": "PUT", "key": "key{}".format(i), "value": "value " * 20} for i in range(100)]))
+        json_put = encode_replication(self.payload([{"op": "PUT", "key": "n", "value": 12345}]))
+        bad = [
+            b"KV2" + message[3:],                                    # wrong magic
+            message + b"\x00",                                       # trailing bytes
+            message[:-6] + b"\xff\xfe\xfd\xfc\xfb\xfa",              # value is not UTF-8
+            compressed[:4] + bytes(b ^ 0x55 for b in compressed[4:]),  # compressed body is not zlib
+            message[:4] + b"\x01" + message[5:],                     # uncompressed body flagged as compressed
+            json_put[:-5] + b"{{{{{",                                # JSON value that does not parse
+        ]
+        # Operation code 3 is not defined
+        operation = message.index(bytes([assignment3.OP_PUT_TEXT, 3]) + b"tea")
+        bad.append(message[:operation] + b"\x03" + message[operation + 1:])
+        for index, data in enumerate(bad):
+            with self.assertRaises(ValueError, msg="case {}".format(index)):
+                decode_replication(data)
+
+
+class TestValueStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def size(self, key, value):
+        return len(key) + len(json.dumps(value, separators=(",", ":")))
+
+    # Check that the counters of <store> agree with its contents, which should be <expected>
+    def check(self, store, expected):
+        stats = store.stats()
+        self.assertEqual(stats["memory-bytes"], sum(size for _, size in store.hot.values()))
+        self.assertEqual(stats["memory-keys"] + stats["disk-keys"], len(expected))
+        self.assertEqual(stats["disk-bytes"], sum(location & 0xFFFFFFFF for location in store.cold.values()))
+        self.assertLessEqual(stats["memory-bytes"], max(store.budget - store.reserved, 0) or stats["memory-bytes"])
+        self.assertEqual(set(store), set(expected))
+        self.assertEqual(len(store), len(expected))
+
+    def test_budget(self):
+        store = ValueStore(1000, self.directory.name)
+        expected = {}
+        for i in range(200):
+            key, value = "key{}".format(i), {"n": i, "text": "x" * (i % 30)}
+            store[key] = expected[key] = value
+            self.assertLessEqual(store.stats()["memory-bytes"], 1000)
+        self.assertGreater(store.stats()["disk-keys"], 0)
+        self.check(store, expected)
+
+        print('>>> Values read back after they were spilled')
+        for key, value in expected.items():
+            self.assertEqual(store.peek(key), value)
+            self.assertEqual(store[key], value)
+        self.check(store, expected)
+
+        print('>>> Reserving part of the budget for the write logs spills more')
+        store.reserve(600)
+        self.assertLessEqual(store.stats()["memory-bytes"], 400)
+        self.check(store, expected)
+
+    def test_second_chance(self):
+        value = "x" * 10
+        store = ValueStore(3 * self.size("k0", value), self.directory.name)
+        for key in ["k0", "k1", "k2"]:
+            store[key] = value
+        self.assertEqual(store.stats()["disk-keys"], 0)
+
+        print('>>> k0 is read, so the hand passes it and spills k1 instead')
+        store["k0"]
+        store["k3"] = value
+        self.assertEqual(set(store.cold), {"k1"})
+
+        print('>>> k0 went behind k3, so k2 and k3 are spilled before it, and then k0, whose mark was used up')
+        store["k4"] = value
+        self.assertEqual(set(store.cold), {"k1", "k2"})
+        store["k5"] = value
+        self.assertEqual(set(store.cold), {"k1", "k2", "k3"})
+        store["k6"] = value
+        self.assertEqual(set(store.cold), {"k1", "k2", "k3", "k0"})
+
+    def test_reload_on_read(self):
+        value = "x" * 10
+        store = ValueStore(2 * self.size("k0", value), self.directory.name)
+        for key in ["k0", "k1", "k2"]:
+            store[key] = value
+        self.assertIn("k0", store.cold)
+
+        print('>>> peek leaves a spilled value on disk')
+        loads = store.stats()["loads"]
+        self.assertEqual(store.peek("k0"), value)
+        self.assertIn("k0", store.cold)
+        self.assertEqual(store.stats()["loads"], loads + 1)
+
+        print('>>> Reading it brings it back into memory')
+        self.assertEqual(store["k0"], value)
+        self.assertIn("k0", store.hot)
+        self.assertNotIn("k0", store.cold)
+        self.assertEqual(store.peek("missing", "default"), "default")
+        with self.assertRaises(KeyError):
+            store["missing"]
+        self.check(store, {"k0": value, "k1": value, "k2": value})
+
+    def test_truncate_when_empty(self):
+        store = ValueStore(50, self.directory.name)
+        expected = {}
+        for i in range(20):
+            store["key{}".format(i)] = expected["key{}".format(i)] = "value {}".format(i)
+        self.assertGreater(os.fstat(store.file.fileno()).st_size, 0)
+
+        print('>>> Deleting every spilled value empties the spill file')
+        for key in list(store.cold):
+            del store[key]
+            del expected[key]
+        self.assertEqual(os.fstat(store.file.fileno()).st_size, 0)
+        self.assertEqual(store.stats()["disk-bytes"], 0)
+        self.assertEqual((store.end, store.dead), (0, 0))
+        with self.assertRaises(KeyError):
+            del store["key1"]
+        self.check(store, expected)
+
+        print('>>> The file is used again from the start')
+        for i in range(20, 40):
+            store["key{}".format(i)] = expected["key{}".format(i)] = "value {}".format(i)
+        for key, value in expected.items():
+            self.assertEqual(store.peek(key), value)
+        self.check(store, expected)
+
+    def test_compact(self):
+        store = ValueStore(200, self.directory.name)
+        expected = {}
+        for i in range(100):
+            store["key{}".format(i)] = expected["key{}".format(i)] = ["value", i]
+        with mock.patch.object(assignment3, "SPILL_COMPACT_MIN", 0):
+            print('>>> Deleted spilled values leave dead bytes in the file, which is rewritten at the next eviction')
+            old_file, old_end = store.file, store.end
+            for key in list(store.cold)[:60]:
+                del store[key]
+                del expected[key]
+            self.assertGreater(store.dead, store.end // 2)
+            store["new"] = expected["new"] = ["value", "new"]
+            self.assertIsNot(store.file, old_file)
+            self.assertEqual(store.dead, 0)
+            self.assertLess(store.end, old_end // 2)
+        self.assertEqual(store.end - store.dead, sum(location & 0xFFFFFFFF for location in store.cold.values()))
+        for key, value in expected.items():
+            self.assertEqual(store.peek(key), value)
+        self.check(store, expected)
+
+        print('>>> Compacting directly keeps every value')
+        with store.lock:
+            store.compact()
+        self.assertEqual(store.dead, 0)
+        self.assertEqual(store.end, sum(location & 0xFFFFFFFF for location in store.cold.values()))
+        for key, value in expected.items():
+            self.assertEqual(store[key], value)
+        self.check(store, expected)
+
+    def test_random_operations(self):
+        generator = random.Random(138)
+        store = ValueStore(2000, self.directory.name)
+        expected = {}
+        with mock.patch.object(assignment3, "SPILL_COMPACT_MIN", 256):
+            for step in range(3000):
+                key = "key{}".format(generator.randrange(150))
+                action = generator.random()
+                if action < 0.5:
+                    value = generator.choice(["x" * generator.randrange(80), generator.randrange(10 ** 6), {"step": step}, None])
+                    store[key] = expected[key] = value
+                elif action < 0.8:
+                    if key in expected:
+                        self.assertEqual(store[key], expected[key])
+                    else:
+                        self.assertNotIn(key, store)
+                elif action < 0.9:
+                    self.assertEqual(store.peek(key, "absent"), expected.get(key, "absent"))
+                elif key in expected:
+                    del store[key]
+                    del expected[key]
+                if step % 100 == 0:
+                    store.reserve(generator.randrange(1000))
+                self.check(store, expected)
+        self.assertGreater(store.stats()["spills"], 0)
+        self.assertGreater(store.stats()["loads"], 0)
+
+
+class TestCausalDelivery(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Writes replicated to a replica that has not caught up yet are all held back, so wait for it to be ready
+        assert assignment3.bootstrapped.wait(10)
+
+    # Each test uses its own replicas and keys, so the state left by the other tests does not matter
+    def replica(self, name):
+        return "{}.{}:8090".format(self.id().rsplit(".", 1)[-1], name)
+
+    def receive(self, origin, clock, operations):
+        result, _, _ = assignment3.receive_replicated(origin, clock, operations)
+        return result
+
+    def put(self, key, value):
+        return [{"op": "PUT", "key": key, "value": value}]
+
+    def value(self, key):
+        with assignment3.state_lock.reading():
+            return assignment3.kv_store.peek(key, "absent")
+
+    def clock(self, replica):
+        with assignment3.state_lock.reading():
+            return assignment3.vector_clock.get(replica, 0)
+
+    def pending(self, *replicas):
+        with assignment3.state_lock.reading():
+            return sorted(position for (origin, position) in assignment3.pending_writes if origin in replicas)
+
+    # Apply the buffered writes of <replicas> without waiting for their dependencies, as delivery_sweeper does once they expire
+    def force(self, *replicas):
+        with assignment3.state_lock:
+            now = time.time()
+            expired = sorted((sum(clock.values()), origin, position)
+                             for (origin, position), (clock, _, _, _) in assignment3.pending_writes.items() if origin in replicas)
+            assignment3.force_delivery(expired, now)
+            assignment3.deliver_unblocked()
+
+    def test_out_of_order(self):
+        a, b = self.replica("a"), self.replica("b")
+        key = self.replica("key")
+
+        print('>>> Writes 3 and 2 of replica a arrive before write 1')
+        self.assertEqual(self.receive(a, {a: 3}, self.put(key, 3)), "buffered")
+        self.assertEqual(self.receive(a, {a: 2}, self.put(key, 2)), "buffered")
+        self.assertEqual(self.value(key), "absent")
+        self.assertEqual(self.pending(a), [2, 3])
+
+        print('>>> A write of replica b that depends on write 1 of a waits too')
+        self.assertEqual(self.receive(b, {a: 1, b: 1}, self.put(key + "b", "b1")), "buffered")
+
+        print('=== Write 1 arrives, and everything is applied in order')
+        self.assertEqual(self.receive(a, {a: 1}, self.put(key, 1)), "delivered")
+        self.assertEqual(self.value(key), 3)
+        self.assertEqual(self.value(key + "b"), "b1")
+        self.assertEqual((self.clock(a), self.clock(b)), (3, 1))
+        self.assertEqual(self.pending(a, b), [])
+
+    def test_duplicates(self):
+        a = self.replica("a")
+        key = self.replica("key")
+        duplicates = assignment3.delivery_stats["duplicates"]
+
+        print('>>> A write that was already applied is ignored')
+        self.assertEqual(self.receive(a, {a: 1}, self.put(key, "first")), "delivered")
+        self.assertEqual(self.receive(a, {a: 2}, self.put(key, "second")), "delivered")
+        self.assertEqual(self.receive(a, {a: 1}, self.put(key, "first")), "duplicate")
+        self.assertEqual(self.value(key), "second")
+
+        print('>>> So is a write that is already buffered')
+        self.assertEqual(self.receive(a, {a: 4}, self.put(key, "fourth")), "buffered")
+        self.assertEqual(self.receive(a, {a: 4}, self.put(key, "fourth")), "duplicate")
+        self.assertEqual(self.pending(a), [4])
+        self.assertEqual(self.receive(a, {a: 3}, self.put(key, "third")), "delivered")
+        self.assertEqual(self.value(key), "fourth")
+        self.assertEqual(self.clock(a), 4)
+        self.assertEqual(assignment3.delivery_stats["duplicates"], duplicates + 2)
+
+    def test_late_dependency(self):
+        a, b = self.replica("a"), self.replica("b")
+        x, y, z = self.replica("x"), self.replica("y"), self.replica("z")
+
+        print('>>> Write 2 of a, and a write of b that depends on it, arrive without write 1 of a')
+        self.assertEqual(self.receive(a, {a: 2}, self.put(x, "new")), "buffered")
+        self.assertEqual(self.receive(b, {a: 2, b: 1}, self.put(z, "b1")), "buffered")
+
+        print('>>> Write 1 does not arrive in time, so write 2 is applied anyway, and then the write waiting for it')
+        forced = assignment3.delivery_stats["forced"]
+        self.force(a)
+        self.assertEqual(assignment3.delivery_stats["forced"], forced + 1)
+        self.assertEqual((self.value(x), self.value(z)), ("new", "b1"))
+        self.assertEqual(self.pending(a, b), [])
+        # The clock does not move past the missing write, which can still be applied
+        self.assertEqual((self.clock(a), self.clock(b)), (0, 1))
+
+        print('=== Write 1 arrives late: it is applied, except to x, which write 2 already overwrote')
+        self.assertEqual(self.receive(a, {a: 1}, [{"op": "PUT", "key": x, "value": "old"}, {"op": "PUT", "key": y, "value": "old"}]),
+                         "delivered")
+        self.assertEqual((self.value(x), self.value(y)), ("new", "old"))
+        self.assertEqual(self.clock(a), 2)
+        with assignment3.state_lock.reading():
+            self.assertNotIn(a, assignment3.applied_ahead)
+
+        print('=== Neither write is applied again')
+        self.assertEqual(self.receive(a, {a: 1}, self.put(y, "again")), "duplicate")
+        self.assertEqual(self.receive(a, {a: 2}, self.put(x, "again")), "duplicate")
+        self.assertEqual((self.value(x), self.value(y)), ("new", "old"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+import requests
+from time import sleep
+from benchmark import start_replicas, stop_replicas
+from kvs_client import KVSClient, KVSError
+
+# These tests start replicas as local processes on loopback ports, as benchmark.py does, so they do not need Docker.
+BASE_PORT = 9300
+REPLICA_ENV = {"CAUSAL_WAIT": "0.5"} # answer 503 sooner, so the retry tests do not wait a full second each time
+UNREACHABLE = "127.0.0.1:9399" # nothing listens here
+
+class TestKVSClient(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses, self.processes = start_replicas(3, BASE_PORT, None, REPLICA_ENV)
+        sleep(2) # let every replica list the others before the first write
+
+    def tearDown(self):
+        stop_replicas(self.processes)
+
+    def test_read_your_writes(self):
+        with KVSClient(self.addresses) as client:
+            print('>>> Write through the client')
+            for i in range(20):
+                self.assertEqual(client.put('key{}'.format(i), i), 'created')
+            self.assertEqual(client.put('key0', 'new'), 'replaced')
+
+            print('>>> Read right away from each replica with the same causal-metadata')
+            for address in self.addresses:
+                with KVSClient([address]) as reader:
+                    reader.metadata.update(client.metadata)
+                    reader.digests.update(client.digests)
+                    self.assertEqual(reader.get('key0'), 'new')
+                    self.assertEqual(reader.get('key19'), 19)
+
+            print('>>> Delete and read back')
+            self.assertTrue(client.delete('key1'))
+            self.assertFalse(client.delete('key1'))
+            with self.assertRaises(KeyError):
+                client.get('key1')
+
+    def test_retry_on_connection_error(self):
+        with KVSClient(self.addresses[:2]) as client:
+            client.put('tea', 'matcha')
+
+            print('=== Stop the replica that answered')
+            answered = [address for address in client.replicas if client.known[address]][0]
+            other = [address for address in client.replicas if address != answered][0]
+            process = self.processes[self.addresses.index(answered)]
+            process.terminate()
+            process.wait()
+
+            print('>>> The client tries it first, then reads from the other one')
+            self.assertEqual(client.get('tea'), 'matcha')
+            self.assertEqual(client.failures[answered], 1)
+            self.assertEqual(client.failures[other], 0)
+
+    def test_retry_on_503(self):
+        print('=== Start a replica on its own, which never receives the write')
+        lone, lone_processes = start_replicas(1, BASE_PORT + 3, None, REPLICA_ENV)
+        try:
+            with KVSClient([self.addresses[0]]) as writer:
+                writer.put('tea', 'matcha')
+
+            print('>>> The lone replica is picked first, answers 503, and the read is retried on the group')
+            with KVSClient(lone + self.addresses) as client:
+                client.merge(lone[0], writer.metadata) # as though the lone replica had already seen the write
+                self.assertEqual(client.get('tea'), 'matcha')
+                self.assertEqual(client.failures[lone[0]], 1)
+
+            print('>>> With only the lone replica, the client gives up')
+            with KVSClient(lone, retries=1) as client:
+                client.merge(lone[0], writer.metadata)
+                with self.assertRaises(KVSError) as raised:
+                    client.get('tea')
+                self.assertEqual(raised.exception.status, 503)
+        finally:
+            stop_replicas(lone_processes)
+
+    def test_quorum_failure_not_retried(self):
+        print('=== Start replicas that need all three to acknowledge a write, and stop one of them')
+        addresses, processes = start_replicas(3, BASE_PORT + 4, None, dict(REPLICA_ENV, WRITE_QUORUM='3'))
+        try:
+            sleep(2)
+            with KVSClient(addresses[:2]) as client:
+                client.put('tea', 'matcha')
+                processes[2].terminate()
+                processes[2].wait()
+
+                print('>>> A write that misses its quorum fails once, with its causal-metadata, and is not sent again')
+                before = dict(client.metadata)
+                with self.assertRaises(KVSError) as raised:
+                    client.put('tea', 'sencha')
+                self.assertEqual(raised.exception.status, 503)
+                self.assertEqual(raised.exception.body['error'], 'Write quorum not reached')
+                self.assertNotEqual(client.metadata, before)
+                self.assertEqual(client.failures, {address: 0 for address in addresses[:2]})
+
+                print('>>> The delete was applied, so it is not retried into a 404')
+                with self.assertRaises(KVSError) as raised:
+                    client.delete('tea')
+                self.assertEqual(raised.exception.status, 503)
+                with self.assertRaises(KeyError):
+                    client.get('tea')
+        finally:
+            stop_replicas(processes)
+
+    def test_no_replica_reachable(self):
+        with KVSClient([UNREACHABLE], timeout=0.5, retries=2) as client:
+            with self.assertRaises(KVSError) as raised:
+                client.put('tea', 'matcha')
+            self.assertEqual(raised.exception.status, 503)
+            self.assertEqual(client.failures[UNREACHABLE], 3)
+
+    def test_pipeline(self):
+        with KVSClient(self.addresses) as client:
+            print('>>> Queue dependent operations and send them as one batch')
+            with client.pipeline() as p:
+                p.put('a', 1).put('b', 2).get('a').delete('b').get('b')
+            self.assertEqual(p.results, [
+                {'key': 'a', 'result': 'created'},
+                {'key': 'b', 'result': 'created'},
+                {'key': 'a', 'result': 'found', 'value': 1},
+                {'key': 'b', 'result': 'deleted'},
+                {'key': 'b', 'error': 'Key does not exist'},
+            ])
+
+            print('>>> The pipeline is empty again after it ran')
+            self.assertEqual(p.execute(), [])
+
+            print('>>> Nothing is sent when the with-block raises')
+            with self.assertRaises(ValueError):
+                with client.pipeline() as q:
+                    q.put('c', 3)
+                    raise ValueError('stop')
+            self.assertIsNone(q.results)
+            with self.assertRaises(KeyError):
+                client.get('c')
+
+            print('>>> Every replica has the pipeline\'s writes')
+            for address in self.addresses:
+                r = requests.get('http://{}/kvs/a'.format(address), json={'causal-metadata': client.metadata})
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(r.json()['value'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
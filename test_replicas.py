@@ -0,0 +1,392 @@
+import os
+import sys
+import json
+import glob
+import signal
+import subprocess
+import tempfile
+import unittest
+import requests
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor
+from benchmark import SERVER, start_replicas, stop_replicas, wait_until_serving
+
+# These tests start replicas as local processes on loopback ports, as benchmark.py does, so they do not need Docker.
+BASE_PORT = 9320
+
+class ReplicaTestCase(unittest.TestCase):
+
+    # Start <n> replicas on ports from <port> with the settings <env>, and stop them when the test ends
+    def start(self, n, port, env=None):
+        addresses, processes = start_replicas(n, port, None, env or {})
+        self.addCleanup(stop_replicas, processes)
+        return addresses, processes
+
+    # Start one replica at <address> whose configured view is <view>, for a group whose members differ in their settings
+    def start_one(self, address, view, env=None):
+        replica_env = dict(os.environ, SOCKET_ADDRESS=address, VIEW=','.join(view), HOST='127.0.0.1', **(env or {}))
+        process = subprocess.Popen([sys.executable, SERVER], env=replica_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(stop_replicas, [process])
+        wait_until_serving(address)
+        return process
+
+    def data_dir(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return directory.name
+
+    def put(self, address, key, value, metadata=None):
+        response = requests.put('http://{}/kvs/{}'.format(address, key), json={'value': value, 'causal-metadata': metadata})
+        self.assertIn(response.status_code, [200, 201])
+        return response.json()['causal-metadata']
+
+    def get(self, address, key, metadata=None):
+        return requests.get('http://{}/kvs/{}'.format(address, key), json={'causal-metadata': metadata})
+
+    # Wait up to <timeout> seconds for <condition> to hold
+    def wait_for(self, condition, timeout=10, message=None):
+        deadline = time() + timeout
+        while time() < deadline:
+            if condition():
+                return
+            sleep(0.1)
+        self.fail(message or 'condition not reached in {} seconds'.format(timeout))
+
+
+class TestDurability(ReplicaTestCase):
+
+    def test_restart_keeps_acknowledged_writes(self):
+        data_dir = self.data_dir()
+        env = {'DATA_DIR': data_dir}
+        addresses, processes = self.start(1, BASE_PORT, env)
+        address = addresses[0]
+
+        print('>>> Write from several clients at once, so log records are fsynced in groups')
+        def write(i):
+            metadata = self.put(address, 'key{}'.format(i), {'n': i})
+            if i % 3 == 0:
+                requests.delete('http://{}/kvs/key{}'.format(address, i), json={'causal-metadata': metadata})
+            return i
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            acknowledged = list(pool.map(write, range(200)))
+        metadata = self.put(address, 'last', 'write')
+
+        print('=== Kill the replica without letting it stop cleanly, and start it again')
+        processes[0].kill()
+        processes[0].wait()
+        self.start(1, BASE_PORT, env)
+        for i in acknowledged:
+            response = self.get(address, 'key{}'.format(i))
+            if i % 3 == 0:
+                self.assertEqual(response.status_code, 404, msg='key{}'.format(i))
+            else:
+                self.assertEqual(response.status_code, 200, msg='key{}'.format(i))
+                self.assertEqual(response.json()['value'], {'n': i})
+
+        print('=== Its clock went on from where it stopped')
+        after = self.put(address, 'after', 'restart', metadata)
+        self.assertEqual(after[address], metadata[address] + 1)
+
+    def test_snapshot_replaces_log(self):
+        data_dir = self.data_dir()
+        env = {'DATA_DIR': data_dir, 'SNAPSHOT_EVERY': '50'}
+        addresses, processes = self.start(1, BASE_PORT, env)
+        address = addresses[0]
+        metadata = None
+        for i in range(300):
+            metadata = self.put(address, 'key{}'.format(i), i, metadata)
+        for i in range(0, 300, 10):
+            requests.delete('http://{}/kvs/key{}'.format(address, i), json={'causal-metadata': metadata})
+
+        print('=== Snapshots replaced the older log segments')
+        replica_dir = os.path.join(data_dir, 'replica-{}'.format(BASE_PORT))
+        self.wait_for(lambda: len(glob.glob(os.path.join(replica_dir, 'wal.*'))) <= 2)
+        self.assertTrue(os.path.exists(os.path.join(replica_dir, 'snapshot')))
+        self.assertFalse(os.path.exists(os.path.join(replica_dir, 'wal.00000001')))
+
+        print('=== The snapshot and the log after it are loaded on restart')
+        stop_replicas(processes)
+        self.start(1, BASE_PORT, env)
+        for i in range(300):
+            response = self.get(address, 'key{}'.format(i))
+            self.assertEqual(response.status_code, 404 if i % 10 == 0 else 200, msg='key{}'.format(i))
+            if i % 10:
+                self.assertEqual(response.json()['value'], i)
+
+    def test_torn_record(self):
+        data_dir = self.data_dir()
+        env = {'DATA_DIR': data_dir}
+        addresses, processes = self.start(1, BASE_PORT, env)
+        address = addresses[0]
+        for i in range(20):
+            self.put(address, 'key{}'.format(i), i)
+        processes[0].kill()
+        processes[0].wait()
+
+        print('>>> Cut the last log record short, as a crash in the middle of a write would')
+        replica_dir = os.path.join(data_dir, 'replica-{}'.format(BASE_PORT))
+        with open(sorted(glob.glob(os.path.join(replica_dir, 'wal.*')))[-1], 'a') as f:
+            f.write('{"origin": "127.0.0.1:1", "position": 1, "operations": [{"op": "PUT", "key": "torn", "va')
+
+        print('=== The replica starts, with every complete record, and new writes go to a new segment')
+        addresses, processes = self.start(1, BASE_PORT, env)
+        for i in range(20):
+            self.assertEqual(self.get(address, 'key{}'.format(i)).json()['value'], i)
+        self.assertEqual(self.get(address, 'torn').status_code, 404)
+        self.put(address, 'after', 'restart')
+        stop_replicas(processes)
+        self.start(1, BASE_PORT, env)
+        self.assertEqual(self.get(address, 'after').json()['value'], 'restart')
+        self.assertEqual(self.get(address, 'key19').json()['value'], 19)
+
+
+# Settings that make the failure detector react within about a second, and keep anti-entropy out of the way
+FAST_DETECTION = {'HEARTBEAT_INTERVAL': '0.2', 'HEARTBEAT_MISSES': '3', 'REJOIN_DELAY': '1', 'ANTI_ENTROPY_INTERVAL': '600'}
+
+class TestFailures(ReplicaTestCase):
+
+    def view(self, address):
+        return requests.get('http://{}/view'.format(address)).json()['view']
+
+    def hints(self, address, replica):
+        return requests.get('http://{}/view/peers'.format(address)).json()['peers'][replica]['hints']
+
+    def test_hint_replay(self):
+        (alice, bob), processes = self.start(2, BASE_PORT, FAST_DETECTION)
+        sleep(1)
+
+        print('>>> Pause bob until alice removes it from the view')
+        processes[1].send_signal(signal.SIGSTOP)
+        self.addCleanup(processes[1].send_signal, signal.SIGCONT)
+        self.wait_for(lambda: bob not in self.view(alice))
+
+        print('>>> Write at alice while bob is away: each write is kept as a hint for bob')
+        metadata = None
+        for i in range(20):
+            metadata = self.put(alice, 'key{}'.format(i), i, metadata)
+        requests.delete('http://{}/kvs/key0'.format(alice), json={'causal-metadata': metadata})
+        self.assertEqual(self.hints(alice, bob), 21)
+
+        print('=== Resume bob: alice replays the hints to it, in order')
+        processes[1].send_signal(signal.SIGCONT)
+        self.wait_for(lambda: self.hints(alice, bob) == 0)
+        self.assertEqual(self.get(bob, 'key0', metadata).status_code, 404)
+        for i in range(1, 20):
+            response = self.get(bob, 'key{}'.format(i), metadata)
+            self.assertEqual(response.status_code, 200, msg='key{}'.format(i))
+            self.assertEqual(response.json()['value'], i)
+
+    def test_removal_and_rejoin(self):
+        (alice, bob, carol), processes = self.start(3, BASE_PORT, FAST_DETECTION)
+        sleep(1)
+
+        print('=== Kill bob: the others remove it from their views')
+        processes[1].kill()
+        processes[1].wait()
+        self.wait_for(lambda: bob not in self.view(alice) and bob not in self.view(carol))
+        self.assertEqual(sorted(self.view(alice)), sorted([alice, carol]))
+        metadata = self.put(alice, 'tea', 'matcha')
+        metadata = self.put(carol, 'coffee', 'mocha', metadata)
+
+        print('=== Start bob again, empty: it catches up and is added back to every view')
+        self.start_one(bob, [alice, bob, carol], FAST_DETECTION)
+        self.wait_for(lambda: bob in self.view(alice) and bob in self.view(carol))
+        self.assertEqual(sorted(self.view(bob)), sorted([alice, bob, carol]))
+        self.assertEqual(self.get(bob, 'tea', metadata).json()['value'], 'matcha')
+        self.assertEqual(self.get(bob, 'coffee', metadata).json()['value'], 'mocha')
+
+        print('>>> New writes reach bob again')
+        metadata = self.put(alice, 'juice', 'orange', metadata)
+        self.wait_for(lambda: self.get(bob, 'juice').status_code == 200)
+
+
+class TestAntiEntropy(ReplicaTestCase):
+
+    # Apply <operations> at <address> as a write that replica <origin> broadcast with clock <clock>, and that reached no other replica
+    def lose_write(self, address, origin, clock, operations):
+        response = requests.post('http://{}/kvs/_batch'.format(address),
+                                 json={'operations': operations, 'causal-metadata': clock, 'sender': origin, 'broadcasted': 'true'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_repair(self):
+        (alice, bob), processes = self.start(2, BASE_PORT, {'ANTI_ENTROPY_INTERVAL': '0.5', 'ANTI_ENTROPY_MIN': '0.2'})
+        metadata = self.put(alice, 'tea', 'matcha')
+        self.wait_for(lambda: self.get(bob, 'tea').status_code == 200)
+
+        print('>>> Bob alone gets a write and a delete from a replica that then goes away')
+        origin = '127.0.0.1:1'
+        self.lose_write(bob, origin, dict(metadata, **{origin: 1}), [{'op': 'PUT', 'key': 'coffee', 'value': 'mocha'}])
+        self.lose_write(bob, origin, dict(metadata, **{origin: 2}), [{'op': 'DELETE', 'key': 'tea'}])
+        self.assertEqual(self.get(alice, 'coffee').status_code, 404)
+
+        print('=== Alice finds the difference in the hash trees and takes both')
+        self.wait_for(lambda: self.get(alice, 'coffee').status_code == 200)
+        self.assertEqual(self.get(alice, 'coffee').json()['value'], 'mocha')
+        self.assertEqual(self.get(alice, 'tea').status_code, 404)
+        stats = requests.get('http://{}/anti-entropy/tree'.format(alice), json={'nodes': []}).json()['stats']
+        self.assertGreaterEqual(stats['repaired-keys'], 2)
+        self.assertEqual(self.put(alice, 'juice', 'orange')[origin], 2)
+
+
+class TestShards(ReplicaTestCase):
+
+    # Read <key> from <address>'s own store, without forwarding it to the shard that owns it
+    def held(self, address, key):
+        response = requests.get('http://{}/kvs/{}'.format(address, key), json={'causal-metadata': None},
+                                headers={'X-Forwarded-Shard': 'test', 'X-Moving-Read': 'true'})
+        return response.status_code == 200
+
+    def test_forwarding(self):
+        alice, bob = '127.0.0.1:{}'.format(BASE_PORT), '127.0.0.1:{}'.format(BASE_PORT + 1)
+        self.start_one(alice, [alice, bob], {'SHARD_ID': 'one'})
+        self.start_one(bob, [alice, bob], {'SHARD_ID': 'two'})
+        sleep(1)
+
+        print('>>> Write every key at alice: each is stored by the shard that owns it')
+        metadata = None
+        for i in range(40):
+            metadata = self.put(alice, 'key{}'.format(i), i, metadata)
+        at_alice = {i for i in range(40) if self.held(alice, 'key{}'.format(i))}
+        at_bob = {i for i in range(40) if self.held(bob, 'key{}'.format(i))}
+        self.assertEqual(at_alice | at_bob, set(range(40)))
+        self.assertFalse(at_alice & at_bob)
+        self.assertTrue(at_alice and at_bob)
+
+        print('>>> Every key can be read, and scanned, at either replica')
+        for address in [alice, bob]:
+            for i in range(40):
+                self.assertEqual(self.get(address, 'key{}'.format(i), metadata).json()['value'], i)
+            response = requests.get('http://{}/kvs?prefix=key&limit=100'.format(address), json={'causal-metadata': metadata})
+            self.assertEqual(len(response.json()['keys']), 40)
+
+    def test_rebalance(self):
+        alice, bob = '127.0.0.1:{}'.format(BASE_PORT), '127.0.0.1:{}'.format(BASE_PORT + 1)
+        env = {'HEARTBEAT_INTERVAL': '0.2'}
+        self.start_one(alice, [alice], dict(env, SHARD_ID='one'))
+        metadata = None
+        for i in range(100):
+            metadata = self.put(alice, 'key{}'.format(i), i, metadata)
+
+        print('=== Add a second shard: alice moves the keys it now owns to it')
+        self.start_one(bob, [alice, bob], dict(env, SHARD_ID='two'))
+        def settled():
+            at_bob = {i for i in range(100) if self.held(bob, 'key{}'.format(i))}
+            at_alice = {i for i in range(100) if self.held(alice, 'key{}'.format(i))}
+            return at_bob and not (at_alice & at_bob) and at_alice | at_bob == set(range(100))
+        self.wait_for(settled, timeout=20)
+
+        print('>>> Every key can still be read at either replica')
+        for address in [alice, bob]:
+            for i in range(100):
+                self.assertEqual(self.get(address, 'key{}'.format(i)).json()['value'], i)
+
+
+class TestTracing(ReplicaTestCase):
+
+    def test_trace_crosses_replicas(self):
+        (alice, bob), processes = self.start(2, BASE_PORT)
+        sleep(1)
+
+        print('>>> A write at alice starts a trace')
+        response = requests.put('http://{}/kvs/tea'.format(alice), json={'value': 'matcha', 'causal-metadata': None})
+        self.assertEqual(response.status_code, 201)
+        trace_id = response.headers['traceparent'].split('-')[1]
+        traces = requests.get('http://{}/traces'.format(alice)).json()['traces']
+        self.assertIn(trace_id, [trace['trace-id'] for trace in traces])
+
+        print('=== Its spans at alice link to the ones bob recorded for the replicated write')
+        body = requests.get('http://{}/traces/{}'.format(alice, trace_id)).json()
+        self.assertEqual(body['unreachable'], [])
+        spans = {record['span-id']: record for record in body['spans']}
+        roots = [record for record in spans.values() if record['parent-id'] is None]
+        self.assertEqual([record['replica'] for record in roots], [alice])
+        at_bob = [record for record in spans.values() if record['replica'] == bob]
+        self.assertTrue(at_bob)
+        for record in at_bob:
+            self.assertIn(record['parent-id'], spans)
+        self.assertIn(alice, {spans[record['parent-id']]['replica'] for record in at_bob})
+
+        print('>>> Bob returns only its own spans when asked for them alone')
+        local = requests.get('http://{}/traces/{}?local=true'.format(bob, trace_id)).json()['spans']
+        self.assertEqual({record['replica'] for record in local}, {bob})
+
+    def test_client_traceparent(self):
+        (alice, bob), processes = self.start(2, BASE_PORT)
+        sleep(1)
+
+        print('>>> A write that carries a traceparent continues the client\'s trace')
+        trace_id, client_span = '4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7'
+        response = requests.put('http://{}/kvs/tea'.format(alice), json={'value': 'matcha', 'causal-metadata': None},
+                                headers={'traceparent': '00-{}-{}-01'.format(trace_id, client_span)})
+        self.assertEqual(response.headers['traceparent'].split('-')[1], trace_id)
+        spans = requests.get('http://{}/traces/{}'.format(alice, trace_id)).json()['spans']
+        self.assertEqual([record['replica'] for record in spans if record['parent-id'] == client_span], [alice])
+        self.assertIn(bob, {record['replica'] for record in spans})
+
+class TestWatch(ReplicaTestCase):
+
+    def poll(self, address, since, seconds=1, **params):
+        params = dict(params, poll=seconds, since=json.dumps(since))
+        response = requests.get('http://{}/watch'.format(address), params=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    # Read the Server-Sent Events of a watch at <address> until the one named <last>
+    def stream(self, address, last, headers=None, **params):
+        events, name = [], None
+        with requests.get('http://{}/watch'.format(address), params=params, headers=headers, stream=True, timeout=10) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('event: '):
+                    name = line[len('event: '):]
+                elif line.startswith('data: '):
+                    events.append((name, json.loads(line[len('data: '):])))
+                    if name == last:
+                        return events
+        return events
+
+    def test_resume(self):
+        (alice, bob), processes = self.start(2, BASE_PORT)
+        sleep(1)
+        start = self.put(alice, 'tea', 'matcha')
+        metadata = self.put(alice, 'tea', 'sencha', start)
+        metadata = self.put(alice, 'coffee', 'mocha', metadata)
+        metadata = requests.delete('http://{}/kvs/tea'.format(alice), json={'causal-metadata': metadata}).json()['causal-metadata']
+        self.wait_for(lambda: self.get(bob, 'tea', metadata).status_code == 404)
+
+        print('>>> A poll at bob from an earlier token replays the writes of the key made since, replicated from alice')
+        body = self.poll(bob, start, key='tea')
+        self.assertFalse(body['reset'])
+        self.assertEqual([(event['op'], event.get('value')) for event in body['events']], [('PUT', 'sencha'), ('DELETE', None)])
+
+        print('>>> The next poll from the returned token waits for the next write')
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self.poll, bob, body['causal-metadata'], 5, key='tea')
+            sleep(0.5)
+            self.put(alice, 'tea', 'gyokuro')
+            later = future.result()
+        self.assertEqual([(event['op'], event['value']) for event in later['events']], [('PUT', 'gyokuro')])
+
+        print('>>> An event stream resumed with Last-Event-ID replays the same writes')
+        events = self.stream(bob, 'delete', headers={'Last-Event-ID': json.dumps(start)}, key='tea')
+        self.assertEqual([name for name, _ in events], ['ready', 'put', 'delete'])
+
+    def test_reset(self):
+        (alice,), processes = self.start(1, BASE_PORT, {'OPLOG_LIMIT': '10'})
+        start = self.put(alice, 'tea', 'matcha')
+        metadata = start
+        for i in range(30):
+            metadata = self.put(alice, 'key{}'.format(i), i, metadata)
+
+        print('=== The operation log no longer reaches back to the token: the watcher is told to read again')
+        body = self.poll(alice, start)
+        self.assertTrue(body['reset'])
+        self.assertEqual(body['events'], [])
+        events = self.stream(alice, 'reset', since=json.dumps(start))
+        self.assertEqual([name for name, _ in events], ['ready', 'reset'])
+
+        print('>>> Watching from a recent token works again')
+        self.assertFalse(self.poll(alice, metadata, seconds=0.1)['reset'])
+
+
+if __name__ == '__main__':
+    unittest.main()